@@ -0,0 +1,6 @@
+"""
+cursor_control
+
+Shared code for the cursor-control nodes and the offline tools that work on
+the sessions they record.
+"""
@@ -0,0 +1,133 @@
+"""
+align.py
+
+Align recorded streams on integer sync counts or timestamps. Matching is
+done with a stable sort of the right-hand keys and `np.searchsorted`, and
+the result is an array of row indices into each stream, so no stream data
+is copied.
+
+Two kinds of matches are supported:
+
+    exact       rows with equal keys, e.g. entries with the same sync count
+    backward    the latest row at or before each key (nearest earlier),
+                optionally within a tolerance, e.g. the cursor entry that
+                was current when a frame was drawn
+
+Keys that appear more than once on the right are resolved explicitly with
+`duplicates`: 'first' or 'last' picks one of the rows, and 'error' raises
+a ValueError.
+"""
+import numpy as np
+
+UNMATCHED = -1
+
+
+def duplicated(keys):
+    """Keys that appear more than once, sorted"""
+    keys = np.sort(np.asarray(keys), kind='stable')
+    dup = keys[1:][keys[1:] == keys[:-1]]
+    return np.unique(dup)
+
+
+def match(left, right, how='exact', tolerance=None, duplicates='last'):
+    """
+    For each left key, find the matching row of `right`
+
+    Parameters
+    ----------
+    left, right : array-like of shape (n_left, ) and (n_right, )
+        Keys to match, e.g. sync counts or timestamps. They do not need to
+        be sorted.
+    how : {'exact', 'backward'}, optional
+        'exact' matches equal keys. 'backward' matches the largest right key
+        that is less than or equal to the left key.
+    tolerance : number, optional
+        For 'backward', the largest allowed difference between the left and
+        the matched right key
+    duplicates : {'first', 'last', 'error'}, optional
+        Which row to use when a right key appears more than once (in the
+        order of `right`)
+
+    Returns
+    -------
+    rows : array of shape (n_left, )
+        Row of `right` matched to each left key, or -1 if there is no match
+    """
+    if how not in ('exact', 'backward'):
+        raise ValueError(f"how must be 'exact' or 'backward', not {how!r}")
+    if duplicates not in ('first', 'last', 'error'):
+        raise ValueError("duplicates must be 'first', 'last' or 'error', "
+                         f"not {duplicates!r}")
+    left = np.asarray(left)
+    right = np.asarray(right)
+    rows = np.full(left.shape[0], UNMATCHED, dtype=np.int64)
+    if right.shape[0] == 0:
+        return rows
+    order = np.argsort(right, kind='stable')
+    right_sorted = right[order]
+    if duplicates == 'error':
+        dup = right_sorted[1:] == right_sorted[:-1]
+        if dup.any():
+            raise ValueError(f'{np.count_nonzero(dup)} duplicate keys, e.g. '
+                             f'{right_sorted[1:][dup][0]}')
+
+    # last row with a key <= each left key
+    pos = np.searchsorted(right_sorted, left, side='right') - 1
+    valid = pos >= 0
+    pos = np.maximum(pos, 0)
+    if how == 'exact':
+        valid &= right_sorted[pos] == left
+    elif tolerance is not None:
+        valid &= (left - right_sorted[pos]) <= tolerance
+    if duplicates == 'first':
+        # move to the first of the rows with the same key
+        pos = np.searchsorted(right_sorted, right_sorted[pos], side='left')
+
+    rows[valid] = order[pos[valid]]
+    return rows
+
+
+def align_streams(base,
+                  others,
+                  how='exact',
+                  tolerance=None,
+                  duplicates='last',
+                  inner=True):
+    """
+    Align several streams to a base stream
+
+    Parameters
+    ----------
+    base : array-like
+        Keys of the base stream, e.g. cursorData sync counts
+    others : dict
+        Maps stream names to their keys
+    how, tolerance, duplicates
+        See `match`
+    inner : bool, optional
+        Only keep base rows that matched in every stream (like chained
+        inner joins). Otherwise unmatched rows are -1.
+
+    Returns
+    -------
+    base_rows : array
+        Rows of the base stream
+    rows : dict
+        Maps each stream name to its rows, aligned with `base_rows`
+    """
+    rows = {
+        name: match(base,
+                    keys,
+                    how=how,
+                    tolerance=tolerance,
+                    duplicates=duplicates)
+        for name, keys in others.items()
+    }
+    base_rows = np.arange(np.asarray(base).shape[0])
+    if inner:
+        keep = np.ones(base_rows.shape[0], dtype=bool)
+        for r in rows.values():
+            keep &= r != UNMATCHED
+        base_rows = base_rows[keep]
+        rows = {name: r[keep] for name, r in rows.items()}
+    return base_rows, rows
@@ -0,0 +1,265 @@
+"""
+audit.py
+
+Allocation audit of a node's main loop. The nodes run with `gc.disable()`,
+so any reference cycle a loop iteration creates is never freed, and the
+dicts, bytes and numpy temporaries allocated on every tick only stay flat
+as long as none of them is kept. With the `audit` node parameter set, every
+`interval` seconds the loop is traced with `tracemalloc` for `iterations`
+consecutive iterations, and the memory allocated during those iterations
+that is still alive at the end of them is reported per source line and per
+iteration. Transient allocations freed within the window cancel out, so
+what is left is what the loop keeps: growing containers and uncollected
+cyclic garbage. Tracing slows every allocation down, so it is only running
+during the windows.
+
+Each window writes an entry to the `<nickname>_audit` stream:
+
+    ts                  time of the report (time.monotonic_ns(), uint64)
+    iterations          iterations traced (uint64)
+    rss                 resident memory of the process in bytes (uint64)
+    rss_rate            resident memory growth since the first report, in
+                        bytes per second (float64)
+    gc_count            objects tracked by gc allocated and not freed since
+                        the last collection (uint64)
+    gc_rate             growth of gc_count per iteration during the window
+                        (float64)
+    collections         gc.collect calls at safe points since the last
+                        report (uint64)
+    collected           unreachable objects they freed (uint64)
+    collect_max_ns      longest of those calls (uint64)
+    lines               JSON list of [file:line, bytes, blocks] retained
+                        per iteration, largest first
+
+With `gc_threshold` set, `safe_point()` runs `gc.collect()` when gc_count
+is above it. Nodes call it where a pause of a few milliseconds does not
+matter, e.g. between trials in radialFSM, so garbage the loop could not
+avoid is bounded without re-enabling the collector in the hot loop:
+
+    audit:
+      # seconds between traced windows
+      interval: 60
+      # iterations traced per window
+      iterations: 1000
+    gc_threshold: 100000
+
+Usage:
+    python -m cursor_control.audit -i 127.0.0.1 -p 6379
+    python -m cursor_control.audit -i 127.0.0.1 -p 6379 -n radialFSM \\
+        --top 20 --json
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, __file__),
+)
+
+
+def rss_bytes():
+    """Resident memory of this process, in bytes"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+class AllocationAudit():
+    # allocation tracing of a node's main loop and gc.collect at safe
+    # points. Call tick() once per loop iteration and safe_point() where
+    # the loop can afford a collection
+
+    def __init__(self, r, stream, interval=60., iterations=1000, top=10,
+                 frames=1, gc_threshold=None, maxlen=1000):
+        self.r = r
+        self.stream = stream
+        self.interval_ns = int(interval * 1e9) if interval else 0
+        self.iterations = iterations
+        self.top = top
+        self.frames = frames
+        self.gc_threshold = gc_threshold
+        self.maxlen = maxlen
+        self.t_next = time.monotonic_ns() + self.interval_ns
+        self.tracing = False
+        self.n_traced = 0
+        self.snapshot = None
+        self.gc_start = 0
+        self.rss_first = None
+        self.t_first = 0
+        self.collections = 0
+        self.collected = 0
+        self.collect_max = 0
+
+    def tick(self):
+        """End of a loop iteration"""
+        if not self.interval_ns:
+            return
+        if self.tracing:
+            self.n_traced += 1
+            if self.n_traced >= self.iterations:
+                self.report()
+        elif time.monotonic_ns() >= self.t_next:
+            self.begin()
+
+    def begin(self):
+        """Start tracing a window"""
+        tracemalloc.start(self.frames)
+        self.snapshot = tracemalloc.take_snapshot()
+        self.gc_start = gc.get_count()[0]
+        self.n_traced = 0
+        self.tracing = True
+
+    def report(self):
+        """Stop tracing, then write and log the report of the window"""
+        snapshot = tracemalloc.take_snapshot()
+        gc_count = gc.get_count()[0]
+        tracemalloc.stop()
+        self.tracing = False
+        n = max(self.n_traced, 1)
+        stats = snapshot.filter_traces(TRACE_FILTERS).compare_to(
+            self.snapshot.filter_traces(TRACE_FILTERS), 'lineno')
+        self.snapshot = None
+        lines = [[
+            f'{s.traceback[0].filename}:{s.traceback[0].lineno}',
+            s.size_diff / n, s.count_diff / n
+        ] for s in stats if s.size_diff > 0][:self.top]
+
+        t = time.monotonic_ns()
+        rss = rss_bytes()
+        if self.rss_first is None:
+            self.rss_first, self.t_first = rss, t
+        rss_rate = (rss - self.rss_first) / max((t - self.t_first) / 1e9,
+                                                1e-9)
+        gc_rate = (gc_count - self.gc_start) / n
+        entry = {
+            b'ts': np.uint64(t).tobytes(),
+            b'iterations': np.uint64(n).tobytes(),
+            b'rss': np.uint64(rss).tobytes(),
+            b'rss_rate': np.float64(rss_rate).tobytes(),
+            b'gc_count': np.uint64(gc_count).tobytes(),
+            b'gc_rate': np.float64(gc_rate).tobytes(),
+            b'collections': np.uint64(self.collections).tobytes(),
+            b'collected': np.uint64(self.collected).tobytes(),
+            b'collect_max_ns': np.uint64(self.collect_max).tobytes(),
+            b'lines': json.dumps(lines).encode(),
+        }
+        self.r.xadd(self.stream, entry, maxlen=self.maxlen, approximate=True)
+        self.collections = 0
+        self.collected = 0
+        self.collect_max = 0
+
+        retained = sum(line[1] for line in lines)
+        logging.info(f'Audit: {retained:.0f} B and {gc_rate:.2f} gc objects '
+                     f'retained per iteration, RSS {rss / 2**20:.1f} MiB '
+                     f'({rss_rate / 1024:+.1f} KiB/s)')
+        for where, size, count in lines[:3]:
+            logging.info(f'Audit: {where} retains {size:.0f} B in '
+                         f'{count:.2f} blocks per iteration')
+        # the next window starts `interval` after the end of this one
+        self.t_next = time.monotonic_ns() + self.interval_ns
+
+    def safe_point(self):
+        """
+        Run gc.collect if more than `gc_threshold` objects are pending,
+        returning the number of unreachable objects it found
+        """
+        if not self.gc_threshold or gc.get_count()[0] <= self.gc_threshold:
+            return 0
+        t = time.monotonic_ns()
+        collected = gc.collect()
+        dt = time.monotonic_ns() - t
+        self.collections += 1
+        self.collected += collected
+        if dt > self.collect_max:
+            self.collect_max = dt
+        logging.debug(f'gc.collect freed {collected} objects in '
+                      f'{dt / 1e6:.2f} ms')
+        return collected
+
+
+def node_audit(node):
+    """
+    AllocationAudit writing to `<nickname>_audit` for a BRAND node, or None
+    if neither its `audit` parameter (a dict of AllocationAudit arguments)
+    nor its `gc_threshold` parameter is set
+    """
+    audit = node.parameters.get('audit')
+    gc_threshold = node.parameters.get('gc_threshold')
+    if not audit and not gc_threshold:
+        return None
+    kwargs = dict(audit) if isinstance(audit, dict) else {}
+    if not audit:
+        # only collect at safe points
+        kwargs['interval'] = None
+    return AllocationAudit(node.r,
+                           f'{node.NAME}_audit',
+                           gc_threshold=gc_threshold,
+                           **kwargs)
+
+
+def decode_audit(entry):
+    """Decode an `<nickname>_audit` entry into a dict"""
+    decoded = {}
+    for key, value in entry.items():
+        name = key.decode()
+        if name == 'lines':
+            decoded[name] = json.loads(value)
+        elif name in ('rss_rate', 'gc_rate'):
+            decoded[name] = float(np.frombuffer(value, np.float64)[0])
+        else:
+            decoded[name] = int(np.frombuffer(value, np.uint64)[0])
+    return decoded
+
+
+def main():
+    import redis
+
+    parser = argparse.ArgumentParser(
+        description='Latest allocation audit of each node')
+    parser.add_argument('-i', '--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=6379)
+    parser.add_argument('-n',
+                        '--nodes',
+                        nargs='+',
+                        default=None,
+                        help='node nicknames, by default every node with an '
+                        'audit stream')
+    parser.add_argument('--top', type=int, default=5, help='lines per node')
+    parser.add_argument('--json', action='store_true', help='print JSON')
+    args = parser.parse_args()
+
+    r = redis.Redis(host=args.host, port=args.port)
+    if args.nodes:
+        streams = [f'{node}_audit' for node in args.nodes]
+    else:
+        streams = sorted(
+            s.decode() for s in r.scan_iter(match='*_audit', _type='stream'))
+    report = {}
+    for stream in streams:
+        last = r.xrevrange(stream, '+', '-', count=1)
+        if last:
+            report[stream[:-len('_audit')]] = decode_audit(last[0][1])
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return
+    for node, audit in report.items():
+        print(f"{node}: RSS {audit['rss'] / 2**20:.1f} MiB "
+              f"({audit['rss_rate'] / 1024:+.1f} KiB/s), "
+              f"{audit['gc_rate']:.2f} gc objects per iteration, "
+              f"{audit['gc_count']} pending, "
+              f"{audit['collections']} collections")
+        for where, size, count in audit['lines'][:args.top]:
+            print(f'    {size:10.1f} B {count:8.2f} blocks  {where}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,546 @@
+"""
+benchmark.py
+
+Throughput and latency benchmark of the cursor-control pipeline. For every
+combination of channel count and bin size, the harness starts a private
+redis-server, runs `bin_multiple` -> `wiener_filter` -> `radialFSM`
+(optionally with `auto_cue` and a headless `display_centerOut`) with the
+parameters from the graph YAMLs, injects synthetic `threshold_values` at a
+fixed rate, and measures over a fixed window:
+
+    throughput_hz   entries written per second to each stream
+    latency_ms      per-hop and end-to-end latency percentiles, from the
+                    `trace` records of cursorData (see cursor_control.trace)
+    loop_ms         wait/compute/write timing of each node's loop (see
+                    cursor_control.metrics)
+    cpu_percent     CPU time of each node, the injector and redis-server, in
+                    percent of one core
+    redis_memory    Redis used_memory at the start and end of the window
+
+Nodes are started directly (not through supervisor) with the graph
+published to `supervisor_ipstream` the way supervisor publishes it, so the
+benchmark needs BRAND installed but not sudo. Results are written as JSON,
+with one record per run, and can be compared against an earlier file.
+
+A short run checks that the nodes start and the pipeline flows before a
+full sweep:
+
+    python -m cursor_control.benchmark --channels 192 --bin-sizes 10 \\
+        --duration 5 -o smoke.json
+
+Usage:
+    python -m cursor_control.benchmark -o benchmark.json
+    python -m cursor_control.benchmark --channels 192 1024 --bin-sizes 10 \\
+        --duration 30 --display --compare benchmark.json -o benchmark2.json
+"""
+import argparse
+import copy
+import json
+import logging
+import multiprocessing as mp
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import yaml
+
+from .metrics import decode_metrics, summarize_metrics
+from .trace import analyze
+
+MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                          '..', '..')
+NODES_DIR = os.path.join(MODULE_DIR, 'nodes')
+GRAPHS_DIR = os.path.join(MODULE_DIR, '..', '..', 'notebooks', 'graphs')
+CHANNELS = (192, 512, 1024, 4096)
+BIN_SIZES = (5, 10, 20)
+PIPELINE = ('bin_multiple', 'wiener_filter', 'radialFSM')
+INPUT_STREAM = 'threshold_values'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class RedisServer():
+    # redis-server on a free local port, without persistence
+
+    def __init__(self, redis_server='redis-server', port=None):
+        import redis
+
+        self.port = port or free_port()
+        self.proc = subprocess.Popen([
+            redis_server, '--port',
+            str(self.port), '--bind', '127.0.0.1', '--save', '',
+            '--appendonly', 'no'
+        ],
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL)
+        self.r = redis.Redis(host='127.0.0.1', port=self.port)
+        for _ in range(100):
+            try:
+                self.r.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.05)
+        else:
+            self.stop()
+            raise RuntimeError(f'redis-server did not start on {self.port}')
+
+    def used_memory(self):
+        return int(self.r.info('memory')['used_memory'])
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def benchmark_graph(channels,
+                    bin_size,
+                    rate=1000,
+                    auto_cue=False,
+                    display=False,
+                    metrics_interval=1.,
+                    graph_path=None,
+                    ol_graph_path=None):
+    """
+    Graph of the benchmarked nodes, with parameters from the closed-loop
+    graph (and auto_cue from the open-loop graph) adjusted for the run
+
+    Returns
+    -------
+    graph : dict
+    """
+    graph_path = graph_path or os.path.join(GRAPHS_DIR, 'sim_graph_cl.yaml')
+    ol_graph_path = ol_graph_path or os.path.join(GRAPHS_DIR,
+                                                  'sim_graph_ol.yaml')
+    with open(graph_path, 'r') as f:
+        graph = yaml.safe_load(f)
+    names = list(PIPELINE) + (['display_centerOut'] if display else [])
+    nodes = {n['name']: n for n in graph['nodes'] if n['name'] in names}
+    if auto_cue:
+        with open(ol_graph_path, 'r') as f:
+            ol_graph = yaml.safe_load(f)
+        nodes.update({
+            n['name']: n
+            for n in ol_graph['nodes'] if n['name'] == 'auto_cue'
+        })
+    missing = set(names) - set(nodes)
+    if missing:
+        raise ValueError(f'{sorted(missing)} not in {graph_path}')
+    nodes = copy.deepcopy(nodes)
+
+    nodes['bin_multiple']['parameters'].update(
+        chan_per_stream=channels,
+        total_channels=channels,
+        bin_size=bin_size,
+        input_streams=[INPUT_STREAM],
+        sync_field=None)
+    nodes['wiener_filter']['parameters'].update(n_features=channels,
+                                                model_path=None)
+    if auto_cue:
+        # runs alongside wiener_filter, from the same bins
+        nodes['auto_cue']['parameters'].update(input_rate=rate / bin_size)
+    if display:
+        nodes['display_centerOut']['parameters'].update(backend='headless',
+                                                        fullscreen=False)
+    for node in nodes.values():
+        node['parameters'].update(trace=True,
+                                  metrics_interval=metrics_interval)
+    graph['parameters'] = dict(graph.get('parameters') or {},
+                               total_channels=channels)
+    graph['nodes'] = list(nodes.values())
+    return graph
+
+
+def publish_graph(r, graph, host, port):
+    """Publish node parameters the way supervisor does before startGraph"""
+    model = {
+        'redis_host': host,
+        'redis_port': port,
+        'graph_name': graph.get('graph_name', 'benchmark'),
+        'graph_loaded_ts': time.monotonic_ns(),
+        'parameters': graph.get('parameters') or {},
+        'nodes': {node['nickname']: node
+                  for node in graph['nodes']},
+    }
+    r.xadd('supervisor_ipstream', {'data': json.dumps(model)})
+
+
+def node_command(node, host, port, nodes_dir=NODES_DIR):
+    """Command that runs a node: its compiled binary, or the script"""
+    base = os.path.join(nodes_dir, node['name'], node['name'])
+    if os.path.exists(base + '.bin'):
+        cmd = [base + '.bin']
+    else:
+        cmd = [sys.executable, base + '.py']
+    return cmd + ['-n', node['nickname'], '-i', host, '-p', str(port)]
+
+
+def cpu_seconds(pid):
+    """User + system CPU time of a process, from /proc"""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            # fields after the command name, which may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+    except FileNotFoundError:
+        return np.nan
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def inject(host, port, channels, rate, stop, count, seed=0, pool_size=256,
+           spike_prob=0.05, max_batch=100):
+    """
+    Write synthetic threshold crossings to `threshold_values` at `rate` Hz
+    until `stop` is set. Payloads come from a pool generated up front, and
+    samples that are due at the same time are written in one pipeline.
+    """
+    import redis
+
+    r = redis.Redis(host=host, port=port)
+    rng = np.random.default_rng(seed)
+    pool = [(rng.random(channels) < spike_prob).astype(np.int8).tobytes()
+            for _ in range(pool_size)]
+    period = int(1e9 / rate)
+    i = 0
+    t_next = time.monotonic_ns()
+    p = r.pipeline(transaction=False)
+    while not stop.is_set():
+        t = time.monotonic_ns()
+        if t < t_next:
+            time.sleep((t_next - t) / 1e9)
+            continue
+        n = min((t - t_next) // period + 1, max_batch)
+        for _ in range(n):
+            p.xadd(
+                INPUT_STREAM, {
+                    b'thresholds': pool[i % pool_size],
+                    b'sync': b'{"count": %d}' % i,
+                    b'ts': np.uint64(time.monotonic_ns()).tobytes(),
+                })
+            i += 1
+        p.execute()
+        t_next += n * period
+        count.value = i
+
+
+def _log_tail(path, n=5):
+    try:
+        with open(path, 'r', errors='replace') as f:
+            return ''.join(f.readlines()[-n:]).strip()
+    except OSError:
+        return ''
+
+
+def _exited(procs, log_paths):
+    # errors of the nodes that are no longer running, with their last output
+    return [
+        f"{name} exited with code {proc.returncode}: "
+        f"{_log_tail(log_paths[name])}" for name, proc in procs.items()
+        if proc.poll() is not None
+    ]
+
+
+def _xlen(r, streams):
+    return {s: r.xlen(s) if r.exists(s) else 0 for s in streams}
+
+
+def _last_id(r, stream):
+    last = r.xrevrange(stream, '+', '-', count=1)
+    return last[0][0] if last else None
+
+
+def _entries_after(r, stream, start_id):
+    # entries added after start_id (or all of them if it is None)
+    if start_id is None:
+        return r.xrange(stream)
+    entries = r.xrange(stream, min=start_id)
+    return entries[1:] if entries and entries[0][0] == start_id else entries
+
+
+def run_once(channels,
+             bin_size,
+             rate=1000,
+             duration=10.,
+             warmup=3.,
+             startup=5.,
+             auto_cue=False,
+             display=False,
+             redis_server='redis-server',
+             log_dir=None,
+             graph_path=None,
+             nodes_dir=NODES_DIR):
+    """
+    Benchmark one channel count and bin size
+
+    Returns
+    -------
+    result : dict
+        Machine-readable measurements of the run. If a node exits or a
+        stream gets no entries before the window, the run stops there and
+        `errors` says why
+    """
+    host = '127.0.0.1'
+    graph = benchmark_graph(channels,
+                            bin_size,
+                            rate=rate,
+                            auto_cue=auto_cue,
+                            display=display,
+                            graph_path=graph_path)
+    streams = [INPUT_STREAM, 'binned_spikes', 'wiener_filter', 'cursorData']
+    expected = {
+        INPUT_STREAM: rate,
+        'binned_spikes': rate / bin_size,
+        'wiener_filter': rate / bin_size,
+        'cursorData': rate / bin_size,
+    }
+    if auto_cue:
+        streams.append('control')
+        expected['control'] = rate / bin_size
+    if display:
+        streams.append('display_sync_pulse')
+
+    # node output goes to log files, which errors quote from
+    log_dir = log_dir or tempfile.mkdtemp(prefix='benchmark_')
+    os.makedirs(log_dir, exist_ok=True)
+
+    server = RedisServer(redis_server)
+    r = server.r
+    procs = {}
+    log_paths = {}
+    logs = []
+    stop = mp.Event()
+    count = mp.Value('q', 0)
+    injector = mp.Process(target=inject,
+                          args=(host, server.port, channels, rate, stop,
+                                count),
+                          daemon=True)
+    result = {
+        'channels': channels,
+        'bin_size': bin_size,
+        'rate_hz': rate,
+        'duration_s': duration,
+        'nodes': [node['nickname'] for node in graph['nodes']],
+        'log_dir': log_dir,
+        'errors': [],
+    }
+    try:
+        publish_graph(r, graph, host, server.port)
+        for node in graph['nodes']:
+            name = node['nickname']
+            log_paths[name] = os.path.join(
+                log_dir, f'{name}_{channels}ch_{bin_size}bin.log')
+            logs.append(open(log_paths[name], 'w'))
+            procs[name] = subprocess.Popen(
+                node_command(node, host, server.port, nodes_dir),
+                stdout=logs[-1],
+                stderr=subprocess.STDOUT)
+        time.sleep(startup)
+        # a node that could not start or read its parameters has exited
+        result['errors'] = _exited(procs, log_paths)
+        if result['errors']:
+            return result
+        injector.start()
+        time.sleep(warmup)
+        # and one that is stuck leaves its output stream empty
+        result['errors'] = _exited(procs, log_paths) + [
+            f'no entries on {stream} after {warmup} s'
+            for stream, n in _xlen(r, streams).items() if not n
+        ]
+        if result['errors']:
+            return result
+
+        # measurement window
+        pids = {name: proc.pid for name, proc in procs.items()}
+        pids['injector'] = injector.pid
+        pids['redis-server'] = server.proc.pid
+        cpu0 = {name: cpu_seconds(pid) for name, pid in pids.items()}
+        len0 = _xlen(r, streams)
+        start_ids = {s: _last_id(r, s) for s in streams}
+        metrics_ids = {n: _last_id(r, f'{n}_metrics') for n in procs}
+        mem0 = server.used_memory()
+        t0 = time.monotonic()
+        time.sleep(duration)
+        elapsed = time.monotonic() - t0
+        mem1 = server.used_memory()
+        len1 = _xlen(r, streams)
+        cpu1 = {name: cpu_seconds(pid) for name, pid in pids.items()}
+
+        result['elapsed_s'] = elapsed
+        result['injected'] = count.value
+        result['throughput_hz'] = {
+            s: (len1[s] - len0[s]) / elapsed
+            for s in streams
+        }
+        result['expected_hz'] = expected
+        result['cpu_percent'] = {
+            name: 100 * (cpu1[name] - cpu0[name]) / elapsed
+            for name in pids
+        }
+        result['redis_memory'] = {
+            'start_bytes': mem0,
+            'end_bytes': mem1,
+            'growth_bytes_per_s': (mem1 - mem0) / elapsed,
+        }
+
+        # latency of the entries written during the window
+        trace_stream = 'display_sync_pulse' if display else 'cursorData'
+        entries = _entries_after(r, trace_stream, start_ids[trace_stream])
+        report = analyze(entries)
+        if report:
+            path = max(report, key=lambda p: report[p]['n'])
+            result['trace_path'] = path
+            result['latency_ms'] = report[path]['latency_ms']
+        result['loop_ms'] = {}
+        for name, start_id in metrics_ids.items():
+            entries = _entries_after(r, f'{name}_metrics', start_id)
+            if entries:
+                result['loop_ms'][name] = summarize_metrics(
+                    decode_metrics(entries))
+        result['errors'] = _exited(procs, log_paths)
+    finally:
+        stop.set()
+        if injector.is_alive():
+            injector.join(timeout=5)
+        for proc in procs.values():
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGINT)
+        for proc in procs.values():
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        for log in logs:
+            log.close()
+        server.stop()
+    return result
+
+
+def _meta():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                cwd=MODULE_DIR,
+                                capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit,
+    }
+
+
+def _key_metrics(run):
+    latency = run.get('latency_ms', {}).get('end-to-end', {})
+    return {
+        'cursorData_hz': run.get('throughput_hz', {}).get('cursorData'),
+        'e2e_p50_ms': latency.get('p50'),
+        'e2e_p99_ms': latency.get('p99'),
+        'redis_growth_kb_s':
+        run.get('redis_memory', {}).get('growth_bytes_per_s', 0) / 1e3,
+    }
+
+
+def print_summary(runs, baseline=None):
+    """Key metrics of each run, and their ratio to a baseline run"""
+    baseline = {(b['channels'], b['bin_size']): b for b in (baseline or [])}
+    for run in runs:
+        key = (run['channels'], run['bin_size'])
+        metrics = _key_metrics(run)
+        cpu = ', '.join(f'{name} {pct:.0f}%'
+                        for name, pct in run.get('cpu_percent', {}).items())
+        line = (f"{key[0]:5d} ch, bin {key[1]:3d}: " + ', '.join(
+            f'{name} {value:.3f}' for name, value in metrics.items()
+            if value is not None))
+        if key in baseline:
+            old = _key_metrics(baseline[key])
+            line += ' | vs baseline: ' + ', '.join(
+                f'{name} x{metrics[name] / old[name]:.2f}'
+                for name in metrics if metrics[name] is not None
+                and old[name])
+        print(line)
+        print(f'    cpu: {cpu}')
+        for error in run['errors']:
+            print(f'    error: {error}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the cursor-control pipeline against a local '
+        'redis-server')
+    parser.add_argument('--channels', type=int, nargs='+', default=CHANNELS)
+    parser.add_argument('--bin-sizes', type=int, nargs='+', default=BIN_SIZES)
+    parser.add_argument('--rate',
+                        type=float,
+                        default=1000,
+                        help='threshold_values rate (Hz)')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=10,
+                        help='measurement window (s)')
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--startup',
+                        type=float,
+                        default=5,
+                        help='time (s) for the nodes to start')
+    parser.add_argument('--auto-cue', action='store_true')
+    parser.add_argument('--display',
+                        action='store_true',
+                        help='run a headless display_centerOut')
+    parser.add_argument('--graph',
+                        default=None,
+                        help='graph YAML to take node parameters from')
+    parser.add_argument('--redis-server', default='redis-server')
+    parser.add_argument('--log-dir',
+                        default=None,
+                        help='directory of node output, by default a new '
+                        'temporary directory')
+    parser.add_argument('--compare',
+                        default=None,
+                        help='earlier results file to compare against')
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    results = {'meta': _meta(), 'config': vars(args), 'runs': []}
+    for channels in args.channels:
+        for bin_size in args.bin_sizes:
+            logging.info(f'{channels} channels, bin size {bin_size}')
+            results['runs'].append(
+                run_once(channels,
+                         bin_size,
+                         rate=args.rate,
+                         duration=args.duration,
+                         warmup=args.warmup,
+                         startup=args.startup,
+                         auto_cue=args.auto_cue,
+                         display=args.display,
+                         redis_server=args.redis_server,
+                         log_dir=args.log_dir,
+                         graph_path=args.graph))
+            # save after every run so a partial sweep is kept
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=1)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['runs']
+    print_summary(results['runs'], baseline)
+    logging.info(f'Saved {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""
+decode.py
+
+Decode recorded Redis streams into columnar NumPy arrays. Field types come
+from a stream spec (see `notebooks/stream_spec_*.yaml`), which maps each
+field name to a NumPy dtype or to one of these special types:
+
+    sync        JSON sync dict, decoded to its `count` value
+    str         UTF-8 string
+    timeval     struct timeval (int64 seconds, int64 microseconds)
+    timespec    struct timespec (int64 seconds, int64 nanoseconds)
+
+Instead of decoding entry by entry, each field's bytes are joined across the
+whole stream and decoded with one `np.frombuffer` call, and all sync dicts
+are parsed with one `json.loads` call.
+
+Usage:
+    python -m cursor_control.decode data/230101T1200_sim_graph_ol.pkl \\
+        --spec stream_spec_ol.yaml --benchmark
+"""
+import argparse
+import json
+import pickle
+import time
+from operator import itemgetter
+
+import numpy as np
+
+
+def timevals_to_seconds(data):
+    """Convert packed struct timeval bytes to seconds"""
+    tv = np.frombuffer(data, dtype=np.int64).reshape(-1, 2)
+    return tv[:, 0] + tv[:, 1] / 1e6
+
+
+def timespecs_to_seconds(data):
+    """Convert packed struct timespec bytes to seconds"""
+    ts = np.frombuffer(data, dtype=np.int64).reshape(-1, 2)
+    return ts[:, 0] + ts[:, 1] / 1e9
+
+
+def stream_columns(entries, keys=None):
+    """
+    Join the raw bytes of each field across a list of (entry_id, entry_dict)
+    tuples
+
+    Parameters
+    ----------
+    entries : list
+        Stream entries in the format returned by `xrange`
+    keys : list of str, optional
+        Fields to join, by default all fields
+
+    Returns
+    -------
+    columns : dict
+        Maps each field name to a (data, lengths) tuple: the concatenated
+        bytes and the byte length of the field in each entry (-1 if the
+        entry does not have it). This is the same layout as the chunks
+        written by `cursor_control.recorder`.
+    """
+    if keys is None:
+        keys = {}
+        for _, entry_dict in entries:
+            for key in entry_dict:
+                keys[key.decode()] = None
+    dicts = [entry_dict for _, entry_dict in entries]
+    columns = {}
+    for name in keys:
+        get = itemgetter(name.encode())
+        try:
+            values = list(map(get, dicts))
+        except KeyError:
+            # some entries do not have this field
+            values = [entry_dict.get(name.encode()) for entry_dict in dicts]
+            if all(v is None for v in values):
+                continue
+            lengths = np.array([-1 if v is None else len(v) for v in values],
+                               dtype=np.int64)
+            data = b''.join(v for v in values if v is not None)
+        else:
+            lengths = np.fromiter(map(len, values),
+                                  dtype=np.int64,
+                                  count=len(values))
+            data = b''.join(values)
+        columns[name] = (data, lengths)
+    return columns
+
+
+def _split(data, lengths):
+    # per-entry byte strings of a joined column
+    offsets = np.concatenate([[0], np.cumsum(np.maximum(lengths,
+                                                         0))]).tolist()
+    return [
+        data[start:end] if length >= 0 else None
+        for start, end, length in zip(offsets[:-1], offsets[1:],
+                                      lengths.tolist())
+    ]
+
+
+def decode_column(data, lengths, dtype, sync_key='count'):
+    """
+    Decode one joined column (see `stream_columns`)
+
+    Returns
+    -------
+    values : array
+        Array of shape (n_entries,) for fields with one value per entry, or
+        (n_entries, n_values) for vector fields. Entries that do not have
+        the field are NaN (numeric fields are converted to float) or None.
+        Fields whose length changes between entries are returned as an
+        object array of per-entry arrays.
+    """
+    if isinstance(data, np.ndarray):
+        data = data.tobytes()
+    n = lengths.shape[0]
+    present = lengths >= 0
+
+    if dtype == 'sync':
+        # sync dicts are flat, so adjacent dicts can be split on '}{'
+        parsed = json.loads(b'[' + data.replace(b'}{', b'},{') + b']')
+        if len(parsed) != present.sum():
+            values = _split(data, lengths)
+            parsed = json.loads(b'[' + b','.join(v for v in values
+                                                 if v is not None) + b']')
+        counts = [d[sync_key] for d in parsed]
+        if present.all():
+            return np.array(counts, dtype=np.int64)
+        out = np.full(n, np.nan)
+        out[present] = counts
+        return out
+    if dtype == 'str':
+        return np.array([v.decode() if v is not None else None
+                         for v in _split(data, lengths)],
+                        dtype=object)
+    if dtype in ('timeval', 'timespec'):
+        to_seconds = (timevals_to_seconds
+                      if dtype == 'timeval' else timespecs_to_seconds)
+        itemsize = 16
+        out_dtype = np.float64
+    else:
+        to_seconds = None
+        itemsize = np.dtype(dtype).itemsize
+        out_dtype = np.dtype(dtype)
+
+    sizes = lengths[present] if not present.all() else lengths
+    if sizes.size == 0:
+        # empty stream, or no entry has the field
+        if n == 0:
+            return np.empty(0, dtype=out_dtype)
+        return np.full(n, np.nan, dtype=np.result_type(out_dtype, np.float32))
+    size = sizes[0]
+    if (sizes != size).any() or size % itemsize:
+        # ragged field: fall back to decoding each entry
+        out = np.empty(n, dtype=object)
+        for i, v in enumerate(_split(data, lengths)):
+            if v is not None:
+                out[i] = (to_seconds(v)
+                          if to_seconds else np.frombuffer(v, dtype=dtype))
+        return out
+
+    width = size // itemsize
+    if to_seconds:
+        flat = to_seconds(data)
+    else:
+        flat = np.frombuffer(data, dtype=dtype)
+    flat = flat.reshape(-1, width)
+    if width == 1:
+        flat = flat[:, 0]
+    if present.all():
+        return flat
+    # missing entries: promote to float so they can hold NaN
+    out_dtype = np.result_type(out_dtype, np.float32)
+    out = np.full((n, ) + flat.shape[1:], np.nan, dtype=out_dtype)
+    out[present] = flat
+    return out
+
+
+def decode_columns(columns, spec, sync_key='count'):
+    """Decode the fields of `columns` that are listed in `spec`"""
+    return {
+        name: decode_column(data, lengths, spec[name], sync_key=sync_key)
+        for name, (data, lengths) in columns.items() if name in spec
+    }
+
+
+def decode_stream(entries, spec, sync_key='count'):
+    """
+    Decode a list of stream entries
+
+    Parameters
+    ----------
+    entries : list
+        Stream entries in the format returned by `xrange`
+    spec : dict
+        Maps field names to dtypes, e.g. `stream_spec['cursorData']`.
+        Fields not in the spec are skipped.
+    sync_key : str, optional
+        Key of the sync dict to decode, by default 'count'
+
+    Returns
+    -------
+    decoded : dict of arrays
+        One array per field, with one row per entry
+    """
+    columns = stream_columns(entries, keys=[k for k in spec])
+    return decode_columns(columns, spec, sync_key=sync_key)
+
+
+def to_dataframe(decoded):
+    """
+    Convert the output of `decode_stream` to a DataFrame. Vector fields
+    become columns of per-entry arrays, like in the calibration notebook.
+    """
+    import pandas as pd
+    return pd.DataFrame({
+        name: list(values) if values.ndim > 1 else values
+        for name, values in decoded.items()
+    })
+
+
+def decode_stream_loop(entries, spec, sync_key='count'):
+    """
+    Entry-by-entry decoder used by the notebooks before this module. Kept
+    as a reference for `benchmark`.
+    """
+    out = [None] * len(entries)
+    for i, (_, entry_data) in enumerate(entries):
+        entry_dec = {}
+        for key, val in entry_data.items():
+            if key.decode() in spec:
+                dtype = spec[key.decode()]
+                if dtype == 'str':
+                    entry_dec[key.decode()] = val.decode()
+                elif dtype == 'sync':
+                    entry_dec[key.decode()] = json.loads(val)[sync_key]
+                elif dtype == 'timeval':
+                    entry_dec[key.decode()] = timevals_to_seconds(val)
+                elif dtype == 'timespec':
+                    entry_dec[key.decode()] = timespecs_to_seconds(val)
+                else:
+                    dat = np.frombuffer(val, dtype=dtype)
+                    entry_dec[key.decode()] = dat[0] if dat.size == 1 else dat
+        out[i] = entry_dec
+    return out
+
+
+def benchmark(graph_data, stream_spec, streams=None, repeat=3):
+    """
+    Time `decode_stream` against `decode_stream_loop` and check that they
+    agree
+
+    Returns
+    -------
+    results : dict
+        Maps each stream name to a dict with the number of entries, the
+        best time of each decoder in seconds and whether the outputs match
+    """
+    if streams is None:
+        streams = [
+            name for name in stream_spec if name.encode() in graph_data
+        ]
+    results = {}
+    for name in streams:
+        entries = graph_data[name.encode()]
+        spec = stream_spec[name]
+        t_loop, t_vec = np.inf, np.inf
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            loop = decode_stream_loop(entries, spec)
+            t_loop = min(t_loop, time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            vec = decode_stream(entries, spec)
+            t_vec = min(t_vec, time.perf_counter() - t0)
+        match = True
+        for key, values in vec.items():
+            ref = [e.get(key) for e in loop]
+            if values.dtype == object:
+                match &= all(
+                    np.array_equal(a, b) for a, b in zip(values, ref))
+            else:
+                match &= np.array_equal(values, np.array(ref))
+        results[name] = {
+            'n_entries': len(entries),
+            'loop_s': t_loop,
+            'vectorized_s': t_vec,
+            'match': bool(match),
+        }
+    return results
+
+
+def main():
+    import yaml
+
+    parser = argparse.ArgumentParser(
+        description='Decode the streams of a recorded session')
+    parser.add_argument('session', help='pickled session saved by a notebook')
+    parser.add_argument('--spec', required=True, help='stream spec YAML file')
+    parser.add_argument('-s', '--streams', nargs='+', default=None)
+    parser.add_argument('--benchmark',
+                        action='store_true',
+                        help='compare against the entry-by-entry decoder')
+    parser.add_argument('-o',
+                        '--output',
+                        default=None,
+                        help='save the decoded streams to this .pkl file')
+    args = parser.parse_args()
+
+    with open(args.session, 'rb') as f:
+        graph_data = pickle.load(f)
+    with open(args.spec, 'r') as f:
+        stream_spec = yaml.safe_load(f)
+    streams = args.streams or [
+        name for name in stream_spec if name.encode() in graph_data
+    ]
+
+    if args.benchmark:
+        results = benchmark(graph_data, stream_spec, streams=streams)
+        print(f'{"stream":<16}{"entries":>10}{"loop (s)":>12}'
+              f'{"vectorized (s)":>16}{"speedup":>10}  match')
+        for name, res in results.items():
+            speedup = res['loop_s'] / max(res['vectorized_s'], 1e-9)
+            print(f'{name:<16}{res["n_entries"]:>10}{res["loop_s"]:>12.4f}'
+                  f'{res["vectorized_s"]:>16.4f}{speedup:>9.1f}x  '
+                  f'{res["match"]}')
+
+    if args.output:
+        decoded = {
+            name: decode_stream(graph_data[name.encode()], stream_spec[name])
+            for name in streams
+        }
+        with open(args.output, 'wb') as f:
+            pickle.dump(decoded, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""
+frame_latency.py
+
+Frame timing and input-to-photon latency from a recorded session.
+display_centerOut writes one `display_sync_pulse` entry per rendered frame
+with the IDs and sync counts of the cursorData and targetData entries it
+showed, and monotonic timestamps taken before drawing (`t_draw`) and after
+the buffer flip (`t_flip`). This module links those records back to the
+cursor entries and, through the sync count, to an upstream input stream.
+A display that reads the `scene` stream (see cursor_control.scene) records
+the IDs of scene entries instead, so their latency is measured from the
+`ts` of the scene records.
+
+Latencies are only meaningful when the display and the nodes that wrote
+the other streams run on the same machine, since they compare
+`time.monotonic_ns()` values.
+
+Usage:
+    python -m cursor_control.frame_latency data/230101T1200_sim_graph_cl
+    python -m cursor_control.frame_latency data/230101T1200_sim_graph_cl.pkl
+"""
+import argparse
+import json
+import logging
+import os
+import pickle
+
+import numpy as np
+
+from .align import UNMATCHED, match
+from .scene import HEADER_DTYPE, SCENE_FIELD, SCENE_STREAM
+
+
+def _field(entries, key, dtype):
+    return np.frombuffer(b''.join(e[key] for _, e in entries), dtype=dtype)
+
+
+def _sync_counts(entries, sync_key=b'sync'):
+    return np.array([json.loads(e[sync_key])['count'] for _, e in entries],
+                    dtype=np.int64)
+
+
+def frame_table(frames):
+    """
+    Decode `display_sync_pulse` entries
+
+    Returns
+    -------
+    table : dict of arrays
+        `frame`, `t_draw`, `t_flip`, `cursor_sync`, `target_sync` and
+        `cursor_id` columns, one row per frame
+    """
+    frames = [f for f in frames if b't_flip' in f[1]]
+    return {
+        'frame': _field(frames, b'frame', np.uint64),
+        't_draw': _field(frames, b't_draw', np.uint64).astype(np.int64),
+        't_flip': _field(frames, b't_flip', np.uint64).astype(np.int64),
+        'cursor_sync': _field(frames, b'cursor_sync', np.int64),
+        'target_sync': _field(frames, b'target_sync', np.int64),
+        'cursor_id': np.array([f[1][b'cursor_id'] for f in frames],
+                              dtype=object),
+    }
+
+
+def _shown_latency(table, entries, ts, stream):
+    # flip time of the first frame showing each entry, minus its ts
+    ts_by_id = {entry_id: t for (entry_id, _), t in zip(entries, ts)}
+    _, first = np.unique(table['cursor_id'], return_index=True)
+    first.sort()
+    t_flip, t_cursor = [], []
+    for i in first:
+        entry_id = table['cursor_id'][i]
+        if entry_id in ts_by_id:
+            t_flip.append(table['t_flip'][i])
+            t_cursor.append(ts_by_id[entry_id])
+    if first.size and not t_flip:
+        logging.warning(f'None of the {first.size} entries shown by the '
+                        f'display are in {stream}. Was the display reading '
+                        'a different stream?')
+    return (np.array(t_flip, dtype=np.int64) -
+            np.array(t_cursor, dtype=np.int64)) / 1e6
+
+
+def cursor_latency(table, cursor_entries, time_key=b'ts'):
+    """
+    Time from radialFSM writing each displayed cursor entry to the end of
+    the flip that showed it, in ms. Only the first frame showing each entry
+    is counted.
+    """
+    ts = _field(cursor_entries, time_key, np.uint64).astype(np.int64)
+    return _shown_latency(table, cursor_entries, ts, 'cursorData')
+
+
+def scene_latency(table, scene_entries):
+    """
+    Like `cursor_latency`, for a display that read the `scene` stream: time
+    from radialFSM packing each displayed scene record to the end of the
+    flip that showed it, in ms
+    """
+    ts = np.array([
+        np.frombuffer(entry[SCENE_FIELD], HEADER_DTYPE, count=1)['ts'][0]
+        for _, entry in scene_entries
+    ]).astype(np.int64)
+    return _shown_latency(table, scene_entries, ts, SCENE_STREAM.decode())
+
+
+def shown_stream(table, graph_data):
+    """
+    Stream whose entries the display showed: `scene` if the frames hold
+    scene entry IDs, otherwise cursorData
+    """
+    shown = set(table['cursor_id'])
+    if any(entry_id in shown
+           for entry_id, _ in graph_data.get(SCENE_STREAM, [])):
+        return SCENE_STREAM
+    return b'cursorData'
+
+
+def input_latency(table, input_entries, time_key=b'ts', sync_key=b'sync'):
+    """
+    Time from an upstream stream's entry (e.g. binned_spikes) to the end of
+    the first flip that showed a cursor computed from it, in ms. Entries are
+    matched on the sync count.
+    """
+    sync = _sync_counts(input_entries, sync_key)
+    ts = _field(input_entries, time_key, np.uint64).astype(np.int64)
+    _, first = np.unique(table['cursor_sync'], return_index=True)
+    first.sort()
+    rows = match(table['cursor_sync'][first], sync, duplicates='first')
+    found = rows != UNMATCHED
+    return (table['t_flip'][first][found] - ts[rows[found]]) / 1e6
+
+
+def frame_stats(table):
+    """Flip intervals, draw-to-flip times and repeated/skipped entries"""
+    flip_interval = np.diff(table['t_flip']) / 1e6
+    draw_to_flip = (table['t_flip'] - table['t_draw']) / 1e6
+    sync_step = np.diff(table['cursor_sync'])
+    return {
+        'flip_interval_ms': flip_interval,
+        'draw_to_flip_ms': draw_to_flip,
+        # frames that showed the same cursor entry as the previous frame
+        'repeated_frames': int(np.sum(sync_step == 0)),
+        # cursor entries that were never shown
+        'skipped_entries': int(np.sum(np.maximum(sync_step - 1, 0))),
+    }
+
+
+def summarize(x):
+    if x.size == 0:
+        return 'no samples'
+    p50, p90, p99 = np.percentile(x, [50, 90, 99])
+    return (f'n={x.size} mean={x.mean():.3f} std={x.std():.3f} '
+            f'p50={p50:.3f} p90={p90:.3f} p99={p99:.3f} max={x.max():.3f}')
+
+
+def print_histogram(x, bin_width=1., width=50):
+    if x.size == 0:
+        return
+    edges = np.arange(np.floor(x.min()), x.max() + bin_width, bin_width)
+    if edges.size < 2:
+        edges = np.array([x.min(), x.min() + bin_width])
+    counts, edges = np.histogram(x, bins=edges)
+    scale = width / max(counts.max(), 1)
+    for count, lo in zip(counts, edges[:-1]):
+        print(f'{lo:8.1f} ms | {"#" * int(round(count * scale)):<{width}} '
+              f'{count}')
+
+
+def _load(path, streams):
+    # entries of `streams` from a recording or a pickled session
+    if not os.path.isdir(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    from .recorder import list_streams, read_entries
+    recorded = list_streams(path)
+    return {
+        stream: read_entries(path, stream.decode())
+        for stream in streams if stream.decode() in recorded
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Frame timing and input-to-photon latency')
+    parser.add_argument(
+        'session',
+        help='directory written by cursor_control.recorder, or a pickled '
+        'session')
+    parser.add_argument('--input-stream',
+                        default='binned_spikes',
+                        help='upstream stream to measure latency from')
+    parser.add_argument('--bin-width',
+                        type=float,
+                        default=1.,
+                        help='histogram bin width in ms')
+    parser.add_argument('--plot',
+                        default=None,
+                        help='save histograms to this image file')
+    args = parser.parse_args()
+
+    graph_data = _load(
+        args.session,
+        [b'display_sync_pulse', b'cursorData', SCENE_STREAM,
+         args.input_stream.encode()])
+
+    table = frame_table(graph_data[b'display_sync_pulse'])
+    stats = frame_stats(table)
+    stream = shown_stream(table, graph_data)
+    if stream == SCENE_STREAM:
+        latencies = {'scene': scene_latency(table, graph_data[stream])}
+    else:
+        latencies = {
+            'cursorData': cursor_latency(table,
+                                         graph_data.get(stream, []))
+        }
+    input_stream = args.input_stream.encode()
+    if input_stream in graph_data:
+        latencies[args.input_stream] = input_latency(table,
+                                                     graph_data[input_stream])
+
+    print(f"{table['frame'].shape[0]} frames, "
+          f"{stats['repeated_frames']} repeated, "
+          f"{stats['skipped_entries']} cursor entries never shown")
+    print(f"flip interval (ms): {summarize(stats['flip_interval_ms'])}")
+    print(f"draw to flip (ms): {summarize(stats['draw_to_flip_ms'])}")
+    for name, lat in latencies.items():
+        print(f'\n{name} to photon (ms): {summarize(lat)}')
+        print_histogram(lat, bin_width=args.bin_width)
+
+    if args.plot:
+        import matplotlib.pyplot as plt
+        fig, axes = plt.subplots(nrows=len(latencies) + 1,
+                                 ncols=1,
+                                 figsize=(6, 2.5 * (len(latencies) + 1)))
+        axes[0].hist(stats['flip_interval_ms'], bins=100)
+        axes[0].set_xlabel('flip interval (ms)')
+        for ax, (name, lat) in zip(axes[1:], latencies.items()):
+            ax.hist(lat, bins=100)
+            ax.set_xlabel(f'{name} to photon latency (ms)')
+        fig.tight_layout()
+        fig.savefig(args.plot)
+
+
+if __name__ == '__main__':
+    main()
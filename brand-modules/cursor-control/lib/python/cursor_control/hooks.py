@@ -0,0 +1,101 @@
+"""
+hooks.py
+
+The optional features of a node's main loop, set up from the node's
+parameters with one call. A feature whose parameters are not set costs one
+method call per use. A node creates its hooks in `__init__`, reads through
+them, trims its outputs with them and marks the phases of each loop
+iteration:
+
+    self.hooks = node_hooks(self)
+    self.input_ids = {input_stream: '$'}
+    ...
+    hooks = self.hooks
+    hooks.start()
+    while True:
+        replies = hooks.xread(r, self.input_ids, count=1)
+        hooks.lap(WAIT)
+        ...
+        p.xadd(output_stream, entry, **hooks.trim(output_stream))
+        hooks.lap(COMPUTE)
+        p.execute()
+        hooks.after_tick(self.input_ids, safe_point=between_trials)
+
+Features:
+
+    trim        approximate trimming of the output streams, from
+                `max_samples` and `max_age` (see cursor_control.trim)
+    realtime    CPU affinity, memory locking, BLAS threads and busy-poll
+                reads, from `realtime` (see cursor_control.realtime)
+    metrics     timing histograms of the wait, compute and write phases,
+                from `metrics_interval` (see cursor_control.metrics)
+    audit       allocation audit of the loop and gc.collect at safe points,
+                from `audit` and `gc_threshold` (see cursor_control.audit)
+    profiler    stack sampling on commands from the profiler_control
+                stream, from `profiler` (see cursor_control.profiler)
+    lag         consumer lag of the input streams, written to consumer_lag
+                every `lag_interval` seconds (see cursor_control.lag)
+"""
+from .audit import node_audit
+from .lag import node_lag
+from .metrics import WRITE, node_metrics
+from .profiler import node_profiler
+from .realtime import node_realtime
+from .trim import node_trim
+
+
+class NodeHooks():
+    # optional features of a node, each None unless its parameters are set.
+    # trim and realtime are always set, and change nothing by default
+
+    def __init__(self, node):
+        self.trim = node_trim(node)
+        # applied first, so that the profiler thread runs on the same CPUs
+        self.realtime = node_realtime(node)
+        self.metrics = node_metrics(node)
+        self.audit = node_audit(node)
+        # runs in its own thread, so the loop never calls it
+        self.profiler = node_profiler(node)
+        self.lag = node_lag(node)
+
+    def xread(self, r, streams, count=1):
+        """Wait for new entries of `streams`, as RealtimeProfile.xread"""
+        return self.realtime.xread(r, streams, count=count)
+
+    def start(self):
+        """Start timing the loop, right before its first iteration"""
+        if self.metrics:
+            self.metrics.start()
+
+    def lap(self, phase):
+        """End of the `phase` (WAIT or COMPUTE) of the current iteration"""
+        if self.metrics:
+            self.metrics.lap(phase)
+
+    def after_tick(self, stream_ids=None, safe_point=False):
+        """
+        End of a loop iteration, once its outputs are written
+
+        Parameters
+        ----------
+        stream_ids : dict, optional
+            last ID read from each input stream, as passed to XREAD. When a
+            lag check is due, it is reported and updated in place with the
+            IDs to read from next
+        safe_point : bool
+            whether the loop can afford a gc.collect before the next
+            iteration
+        """
+        if self.metrics:
+            self.metrics.lap(WRITE)
+        if self.audit:
+            self.audit.tick()
+            if safe_point:
+                self.audit.safe_point()
+        if self.lag and stream_ids is not None and self.lag.due():
+            self.lag.check(stream_ids)
+
+
+def node_hooks(node):
+    """NodeHooks of a BRAND node, from its parameters"""
+    return NodeHooks(node)
@@ -0,0 +1,366 @@
+"""
+lag.py
+
+Consumer lag of the nodes that read streams in order. A node that cannot
+keep up with its input falls further and further behind the tail of the
+stream, which only shows as a cursor that feels late. With the `lag_interval`
+node parameter set, every `lag_interval` seconds each reading node compares
+the last ID it read from each input stream with the stream's last entry, and
+writes one entry per input stream to the graph-wide `consumer_lag` stream:
+
+    node        nickname of the reading node
+    stream      input stream
+    entries     entries added after the last one read (uint64), counted up
+                to `max_count`
+    capped      1 if `entries` reached `max_count` (uint8)
+    lag_ms      time between the last entry read and the stream's last
+                entry, from their IDs (int64)
+    age_ms      time since the stream's last entry was added (int64), which
+                grows when the input stops
+    skipped     times the node skipped to the tail of the stream (uint64)
+
+A check costs a pipelined XREVRANGE per input stream and HGET of the skip
+setting, plus an XRANGE of at most `max_count` entries per stream that is
+behind, and the XADD of the report, once per interval. In between, the node
+only compares the time.
+
+The watchdog (the `lag_watchdog` node, or `python -m cursor_control.lag
+watch`) reads `consumer_lag` and warns when a node is behind by more than
+`max_lag_ms` or `max_entries`, when its input has not had a new entry for
+`max_age_ms`, or when it has not reported for `stale_s` seconds. The alerts
+are also written to `lag_alerts`. With `skip_ms` set, a node that is behind
+for `after` reports in a row is switched to skip-to-latest mode by setting
+its field in the `consumer_lag_skip` hash. At each check, a node in that
+mode that is more than `skip_ms` behind continues from the stream's last
+entry, dropping what it has not read. The field is removed once the node is
+no longer behind for `after` reports in a row.
+
+Usage:
+    python -m cursor_control.lag watch -i 127.0.0.1 -p 6379 \\
+        --max-lag-ms 50 --skip-ms 20
+    python -m cursor_control.lag show -i 127.0.0.1 -p 6379
+"""
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+
+from .recorder import parse_id
+
+LAG_STREAM = b'consumer_lag'
+ALERT_STREAM = b'lag_alerts'
+SKIP_KEY = b'consumer_lag_skip'
+
+
+class ConsumerLag():
+    # periodic lag reports of a node's sequential reads, and skip-to-latest
+    # when the watchdog asks for it. Call due() every iteration and check()
+    # with the last read IDs when it returns True
+
+    def __init__(self, r, nickname, interval=1., max_count=100,
+                 stream=LAG_STREAM, maxlen=10000):
+        self.r = r
+        self.nickname = nickname
+        self.interval_ns = int(interval * 1e9)
+        self.max_count = max_count
+        self.stream = stream
+        self.maxlen = maxlen
+        self.t_next = time.monotonic_ns() + self.interval_ns
+        self.skipped = {}
+
+    def due(self):
+        """Whether a check is due"""
+        return time.monotonic_ns() >= self.t_next
+
+    def check(self, stream_ids):
+        """
+        Report the lag of each stream in `stream_ids` (a dict of stream
+        names to the last ID read, as passed to XREAD) and skip to the tail
+        of the streams that are more than the skip setting behind
+
+        Returns
+        -------
+        stream_ids : dict
+            `stream_ids`, updated in place with the IDs to read from next
+        """
+        self.t_next = time.monotonic_ns() + self.interval_ns
+        streams = [
+            stream for stream, last_id in stream_ids.items()
+            if last_id != '$'
+        ]
+        if not streams:
+            return stream_ids
+        p = self.r.pipeline()
+        for stream in streams:
+            p.xrevrange(stream, '+', '-', count=1)
+        p.hget(SKIP_KEY, self.nickname)
+        replies = p.execute()
+        skip_ms = replies[-1]
+        skip_ms = float(skip_ms) if skip_ms is not None else None
+        now_ms = int(time.time() * 1000)
+
+        p = self.r.pipeline()
+        behind = []
+        for stream, tail in zip(streams, replies):
+            if not tail:
+                continue
+            tail_id = tail[0][0]
+            last = parse_id(stream_ids[stream])
+            if parse_id(tail_id) > last:
+                p.xrange(stream, stream_ids[stream], '+',
+                         count=self.max_count + 1)
+            behind.append((stream, tail_id, parse_id(tail_id) > last))
+        ranges = iter(p.execute())
+
+        p = self.r.pipeline()
+        for stream, tail_id, is_behind in behind:
+            last_id = stream_ids[stream]
+            entries = 0
+            if is_behind:
+                # the range starts at the last entry read, if it still exists
+                entries = [
+                    entry_id for entry_id, _ in next(ranges)
+                    if parse_id(entry_id) != parse_id(last_id)
+                ]
+                entries = min(len(entries), self.max_count)
+            lag_ms = parse_id(tail_id)[0] - parse_id(last_id)[0]
+            if skip_ms is not None and is_behind and lag_ms > skip_ms:
+                stream_ids[stream] = tail_id
+                self.skipped[stream] = self.skipped.get(stream, 0) + 1
+                logging.warning(f'Skipped {entries} entries ({lag_ms} ms) of '
+                                f'{_name(stream)} to the latest')
+            report = {
+                b'node': self.nickname.encode(),
+                b'stream': _name(stream).encode(),
+                b'entries': np.uint64(entries).tobytes(),
+                b'capped': np.uint8(entries >= self.max_count).tobytes(),
+                b'lag_ms': np.int64(lag_ms).tobytes(),
+                b'age_ms': np.int64(now_ms - parse_id(tail_id)[0]).tobytes(),
+                b'skipped': np.uint64(self.skipped.get(stream, 0)).tobytes(),
+            }
+            p.xadd(self.stream, report, maxlen=self.maxlen, approximate=True)
+        p.execute()
+        return stream_ids
+
+
+def _name(stream):
+    return stream.decode() if isinstance(stream, bytes) else stream
+
+
+def node_lag(node):
+    """
+    ConsumerLag of a BRAND node, or None if its `lag_interval` parameter
+    (seconds between checks) is not set or 0
+    """
+    if not node.parameters.get('lag_interval'):
+        return None
+    return ConsumerLag(node.r,
+                       node.NAME,
+                       interval=node.parameters['lag_interval'])
+
+
+def decode_lag(entry):
+    """Decode a `consumer_lag` entry into a dict"""
+    return {
+        'node': entry[b'node'].decode(),
+        'stream': entry[b'stream'].decode(),
+        'entries': int(np.frombuffer(entry[b'entries'], np.uint64)[0]),
+        'capped': bool(np.frombuffer(entry[b'capped'], np.uint8)[0]),
+        'lag_ms': int(np.frombuffer(entry[b'lag_ms'], np.int64)[0]),
+        'age_ms': int(np.frombuffer(entry[b'age_ms'], np.int64)[0]),
+        'skipped': int(np.frombuffer(entry[b'skipped'], np.uint64)[0]),
+    }
+
+
+class LagWatchdog():
+    # aggregates the lag reports of all nodes, raises alerts and switches
+    # nodes that stay behind to skip-to-latest
+
+    def __init__(self, r, max_lag_ms=100, max_entries=None, max_age_ms=None,
+                 stale_s=5., skip_ms=None, after=3, maxlen=1000):
+        self.r = r
+        self.max_lag_ms = max_lag_ms
+        self.max_entries = max_entries
+        self.max_age_ms = max_age_ms
+        self.stale_ns = int(stale_s * 1e9)
+        self.skip_ms = skip_ms
+        self.after = after
+        self.maxlen = maxlen
+        self.last_id = '$'
+        # latest report of each (node, stream) and when it was read
+        self.latest = {}
+        self.t_report = {}
+        # active alerts of each (node, stream), and consecutive reports of
+        # each node that are behind (> 0) or not (< 0)
+        self.alerts = {}
+        self.streak = {}
+        self.skipping = set()
+
+    def reasons(self, report):
+        """Alert reasons of a lag report, as a dict of kinds to messages"""
+        reasons = {}
+        if self.max_lag_ms is not None and report['lag_ms'] > self.max_lag_ms:
+            reasons['lag_ms'] = f"behind by {report['lag_ms']} ms"
+        if (self.max_entries is not None
+                and report['entries'] > self.max_entries):
+            more = '+' if report['capped'] else ''
+            reasons['entries'] = (f"behind by {report['entries']}{more} "
+                                  'entries')
+        if self.max_age_ms is not None and report['age_ms'] > self.max_age_ms:
+            reasons['age_ms'] = f"no input for {report['age_ms']} ms"
+        return reasons
+
+    def alert(self, key, reasons):
+        # only changes in the kinds of a (node, stream)'s alerts are logged
+        # and written
+        if reasons.keys() == self.alerts.get(key, {}).keys():
+            return
+        node, stream = key
+        if reasons:
+            logging.warning(f"{node} reading {stream}: "
+                            f"{', '.join(reasons.values())}")
+        else:
+            logging.info(f'{node} reading {stream}: recovered')
+        self.alerts[key] = reasons
+        entry = {
+            b'node': node.encode(),
+            b'stream': stream.encode(),
+            b'reasons': json.dumps(reasons).encode(),
+        }
+        self.r.xadd(ALERT_STREAM, entry, maxlen=self.maxlen, approximate=True)
+
+    def update_skip(self, node, behind):
+        streak = self.streak.get(node, 0)
+        if behind:
+            streak = streak + 1 if streak > 0 else 1
+        else:
+            streak = streak - 1 if streak < 0 else -1
+        self.streak[node] = streak
+        if self.skip_ms is None:
+            return
+        if streak >= self.after and node not in self.skipping:
+            self.r.hset(SKIP_KEY, node, self.skip_ms)
+            self.skipping.add(node)
+            logging.warning(f'Switched {node} to skip-to-latest')
+        elif streak <= -self.after and node in self.skipping:
+            self.r.hdel(SKIP_KEY, node)
+            self.skipping.discard(node)
+            logging.info(f'Switched {node} back to reading every entry')
+
+    def poll(self, block_ms=1000):
+        """Read new lag reports and check them, returning how many"""
+        reply = self.r.xread({LAG_STREAM: self.last_id}, block=block_ms)
+        t = time.monotonic_ns()
+        n = 0
+        behind = {}
+        for _, entries in reply:
+            for entry_id, entry in entries:
+                self.last_id = entry_id
+                report = decode_lag(entry)
+                key = (report['node'], report['stream'])
+                self.latest[key] = report
+                self.t_report[key] = t
+                reasons = self.reasons(report)
+                self.alert(key, reasons)
+                behind[key[0]] = behind.get(key[0], False) or (
+                    self.max_lag_ms is not None
+                    and report['lag_ms'] > self.max_lag_ms)
+                n += 1
+        for node, is_behind in behind.items():
+            self.update_skip(node, is_behind)
+        for key, t_report in self.t_report.items():
+            if t - t_report > self.stale_ns:
+                self.alert(key, {'stale': 'not reporting'})
+        return n
+
+    def close(self):
+        """Switch all nodes back to reading every entry"""
+        for node in self.skipping:
+            self.r.hdel(SKIP_KEY, node)
+        self.skipping.clear()
+
+    def run(self):
+        """Watch until interrupted"""
+        while True:
+            self.poll()
+
+
+def main():
+    import redis
+
+    parser = argparse.ArgumentParser(
+        description='Consumer lag of the nodes that read streams in order')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    watch = subparsers.add_parser('watch',
+                                  help='raise alerts on lagging nodes')
+    show = subparsers.add_parser('show',
+                                 help='print the latest lag of each node')
+    for p in (watch, show):
+        p.add_argument('-i', '--host', default='127.0.0.1')
+        p.add_argument('-p', '--port', type=int, default=6379)
+    watch.add_argument('--max-lag-ms', type=float, default=100.)
+    watch.add_argument('--max-entries', type=int, default=None)
+    watch.add_argument('--max-age-ms', type=float, default=None)
+    watch.add_argument('--stale-s',
+                       type=float,
+                       default=5.,
+                       help='alert when a node has not reported for this '
+                       'long')
+    watch.add_argument('--skip-ms',
+                       type=float,
+                       default=None,
+                       help='switch lagging nodes to skip-to-latest, when '
+                       'more than SKIP_MS behind')
+    watch.add_argument('--after',
+                       type=int,
+                       default=3,
+                       help='reports in a row before switching')
+    show.add_argument('--last',
+                      type=int,
+                      default=1000,
+                      help='reports to read')
+    show.add_argument('--json', action='store_true', help='print JSON')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    r = redis.Redis(host=args.host, port=args.port)
+    if args.command == 'show':
+        report = {}
+        for _, entry in r.xrevrange(LAG_STREAM, '+', '-',
+                                    count=args.last)[::-1]:
+            lag = decode_lag(entry)
+            report[f"{lag['node']} {lag['stream']}"] = lag
+        if args.json:
+            print(json.dumps(report, indent=1))
+            return
+        skipping = {node.decode() for node in r.hkeys(SKIP_KEY)}
+        print(f"{'node':24}{'stream':24}{'entries':>9}{'lag_ms':>9}"
+              f"{'age_ms':>9}{'skipped':>9}")
+        for lag in report.values():
+            entries = f"{lag['entries']}{'+' if lag['capped'] else ''}"
+            mode = '  skip-to-latest' if lag['node'] in skipping else ''
+            print(f"{lag['node']:24}{lag['stream']:24}{entries:>9}"
+                  f"{lag['lag_ms']:9}{lag['age_ms']:9}{lag['skipped']:9}"
+                  f'{mode}')
+        return
+
+    watchdog = LagWatchdog(r,
+                           max_lag_ms=args.max_lag_ms,
+                           max_entries=args.max_entries,
+                           max_age_ms=args.max_age_ms,
+                           stale_s=args.stale_s,
+                           skip_ms=args.skip_ms,
+                           after=args.after)
+    logging.info('Watching consumer lag')
+    try:
+        watchdog.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watchdog.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+metrics.py
+
+Hot-loop timing histograms. Each node loop iteration is split into phases
+(by default `wait` for the blocking XREAD, `compute` for decoding and
+processing, and `write` for the XADD or pipeline execute), and the duration
+of each phase is counted in a log-linear (HDR-style) histogram: 32
+sub-buckets per power of two, so every bucket is within ~3% of the values
+it holds, from 1 ns to ~68 s in 1024 buckets.
+
+The histograms are preallocated and only touched by the node's own loop, so
+recording a sample is a few integer operations with no locking and no
+containers created or grown. Every `interval` seconds the histograms are
+written to the `<nickname>_metrics` stream and reset, so each entry covers
+one interval:
+
+    ts                  time of the flush (time.monotonic_ns(), uint64)
+    interval_ns         length of the interval (uint64)
+    <phase>_n           number of samples (uint64)
+    <phase>_max         largest sample in ns (uint64)
+    <phase>_p50, _p99   percentiles in ns (uint64)
+    <phase>_buckets     indices of the non-empty buckets (uint16)
+    <phase>_counts      counts of the non-empty buckets (uint32)
+
+Usage:
+    python -m cursor_control.metrics -i 127.0.0.1 -p 6379
+    python -m cursor_control.metrics -i 127.0.0.1 -p 6379 -n wiener_filter \\
+        --last 60 --json
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+SUB_BITS = 5
+SUB_BUCKETS = 1 << SUB_BITS
+N_BUCKETS = 1024
+PHASES = ('wait', 'compute', 'write')
+WAIT, COMPUTE, WRITE = range(len(PHASES))
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def bucket_index(value):
+    """Histogram bucket of a non-negative integer"""
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BITS - 1
+    index = SUB_BUCKETS * shift + (value >> shift)
+    return index if index < N_BUCKETS else N_BUCKETS - 1
+
+
+def bucket_bounds(n_buckets=N_BUCKETS):
+    """Lower and upper (exclusive) value of each bucket"""
+    index = np.arange(n_buckets, dtype=np.int64)
+    shift = np.maximum(index // SUB_BUCKETS - 1, 0)
+    lower = (index - SUB_BUCKETS * shift) << shift
+    upper = lower + (np.int64(1) << shift)
+    return lower, upper
+
+
+def histogram_percentiles(counts, percentiles=PERCENTILES):
+    """
+    Percentiles of a bucket histogram, at the middle of the bucket that
+    holds each one
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    total = counts.sum()
+    if total == 0:
+        return np.full(len(percentiles), np.nan)
+    lower, upper = bucket_bounds(counts.shape[0])
+    rank = np.ceil(np.asarray(percentiles) / 100 * total).clip(1, total)
+    i = np.searchsorted(np.cumsum(counts), rank)
+    return (lower[i] + upper[i]) / 2
+
+
+class LoopMetrics():
+    # phase timing of a node's main loop. Call lap(phase) at the end of each
+    # phase; a phase lasts from the previous lap to this one
+
+    def __init__(self, r, stream, interval=1., phases=PHASES, maxlen=3600):
+        self.r = r
+        self.stream = stream
+        self.interval_ns = int(interval * 1e9)
+        self.phases = tuple(phases)
+        self.maxlen = maxlen
+        self.last_phase = len(self.phases) - 1
+        self.counts = [[0] * N_BUCKETS for _ in self.phases]
+        self.n = [0] * len(self.phases)
+        self.max = [0] * len(self.phases)
+        self.t_last = 0
+        self.t_flush = time.monotonic_ns()
+
+    def phase(self, name):
+        """Index of a phase, to pass to `lap`"""
+        return self.phases.index(name)
+
+    def start(self):
+        """Start timing from now, e.g. before the first loop iteration"""
+        self.t_last = time.monotonic_ns()
+
+    def lap(self, phase):
+        t = time.monotonic_ns()
+        if self.t_last:
+            dt = t - self.t_last
+            self.counts[phase][bucket_index(dt)] += 1
+            self.n[phase] += 1
+            if dt > self.max[phase]:
+                self.max[phase] = dt
+        self.t_last = t
+        if phase == self.last_phase and t - self.t_flush >= self.interval_ns:
+            self.flush(t)
+            # time spent flushing is not counted in the next phase
+            self.t_last = time.monotonic_ns()
+
+    def flush(self, t=None):
+        """Write the histograms of the current interval and reset them"""
+        t = time.monotonic_ns() if t is None else t
+        entry = {
+            b'ts': np.uint64(t).tobytes(),
+            b'interval_ns': np.uint64(t - self.t_flush).tobytes(),
+        }
+        for i, name in enumerate(self.phases):
+            counts = np.array(self.counts[i], dtype=np.uint32)
+            buckets = np.flatnonzero(counts)
+            p50, p99 = histogram_percentiles(counts, (50, 99))
+            entry[f'{name}_n'.encode()] = np.uint64(self.n[i]).tobytes()
+            entry[f'{name}_max'.encode()] = np.uint64(self.max[i]).tobytes()
+            entry[f'{name}_p50'.encode()] = np.uint64(
+                np.nan_to_num(p50)).tobytes()
+            entry[f'{name}_p99'.encode()] = np.uint64(
+                np.nan_to_num(p99)).tobytes()
+            entry[f'{name}_buckets'.encode()] = buckets.astype(
+                np.uint16).tobytes()
+            entry[f'{name}_counts'.encode()] = counts[buckets].tobytes()
+            for b in buckets:
+                self.counts[i][b] = 0
+            self.n[i] = 0
+            self.max[i] = 0
+        self.r.xadd(self.stream,
+                    entry,
+                    maxlen=self.maxlen,
+                    approximate=True)
+        self.t_flush = t
+
+
+def node_metrics(node, phases=PHASES):
+    """
+    LoopMetrics writing to `<nickname>_metrics` for a BRAND node, or None if
+    its `metrics_interval` parameter (seconds between flushes) is not set
+    or 0
+    """
+    if not node.parameters.get('metrics_interval'):
+        return None
+    return LoopMetrics(node.r,
+                       f'{node.NAME}_metrics',
+                       interval=node.parameters['metrics_interval'],
+                       phases=phases)
+
+
+def decode_metrics(entries, phases=None):
+    """
+    Decode `<nickname>_metrics` entries
+
+    Returns
+    -------
+    decoded : dict
+        `ts` and `interval_ns` arrays of shape (n_entries, ), and for each
+        phase a dict with `n` and `max` arrays of shape (n_entries, ) and
+        `counts` of shape (n_entries, N_BUCKETS)
+    """
+    if phases is None:
+        phases = list(
+            dict.fromkeys(key[:-len(b'_counts')].decode() for _, e in entries
+                          for key in e if key.endswith(b'_counts')))
+    decoded = {
+        'ts':
+        np.array([np.frombuffer(e[b'ts'], np.uint64)[0] for _, e in entries],
+                 dtype=np.int64),
+        'interval_ns':
+        np.array([
+            np.frombuffer(e[b'interval_ns'], np.uint64)[0] for _, e in entries
+        ],
+                 dtype=np.int64),
+    }
+    for name in phases:
+        key = name.encode()
+        counts = np.zeros((len(entries), N_BUCKETS), dtype=np.int64)
+        n = np.zeros(len(entries), dtype=np.int64)
+        peak = np.zeros(len(entries), dtype=np.int64)
+        for row, (_, e) in enumerate(entries):
+            if key + b'_counts' not in e:
+                continue
+            buckets = np.frombuffer(e[key + b'_buckets'], np.uint16)
+            counts[row, buckets] = np.frombuffer(e[key + b'_counts'],
+                                                 np.uint32)
+            n[row] = np.frombuffer(e[key + b'_n'], np.uint64)[0]
+            peak[row] = np.frombuffer(e[key + b'_max'], np.uint64)[0]
+        decoded[name] = {'n': n, 'max': peak, 'counts': counts}
+    return decoded
+
+
+def summarize_metrics(decoded):
+    """
+    Percentiles (ms) of each phase over all decoded intervals, and the
+    interval with the largest sample
+
+    Returns
+    -------
+    summary : dict
+        Maps phase names to dicts of statistics
+    """
+    summary = {}
+    for name, phase in decoded.items():
+        if not isinstance(phase, dict):
+            continue
+        n = int(phase['n'].sum())
+        stats = {'n': n}
+        if n:
+            values = histogram_percentiles(phase['counts'].sum(axis=0))
+            for p, v in zip(PERCENTILES, values):
+                stats[f'p{p:g}'] = float(v) / 1e6
+            worst = int(np.argmax(phase['max']))
+            stats['max'] = float(phase['max'][worst]) / 1e6
+            # seconds before the last flush
+            stats['max_age_s'] = float(decoded['ts'][-1] -
+                                       decoded['ts'][worst]) / 1e9
+        summary[name] = stats
+    return summary
+
+
+def main():
+    import redis
+
+    parser = argparse.ArgumentParser(
+        description='Hot-loop timing of each node from its metrics stream')
+    parser.add_argument('-i', '--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=6379)
+    parser.add_argument('-n',
+                        '--nodes',
+                        nargs='+',
+                        default=None,
+                        help='node nicknames, by default every node with a '
+                        'metrics stream')
+    parser.add_argument('--last',
+                        type=int,
+                        default=None,
+                        help='only use the latest LAST intervals')
+    parser.add_argument('--json', action='store_true', help='print JSON')
+    args = parser.parse_args()
+
+    r = redis.Redis(host=args.host, port=args.port)
+    if args.nodes:
+        streams = [f'{node}_metrics' for node in args.nodes]
+    else:
+        streams = sorted(
+            s.decode()
+            for s in r.scan_iter(match='*_metrics', _type='stream'))
+    report = {}
+    for stream in streams:
+        if args.last:
+            entries = r.xrevrange(stream, '+', '-', count=args.last)[::-1]
+        else:
+            entries = r.xrange(stream)
+        if entries:
+            report[stream[:-len('_metrics')]] = summarize_metrics(
+                decode_metrics(entries))
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return
+    columns = [f'p{p:g}' for p in PERCENTILES] + ['max']
+    print(f"{'node':24}{'phase':>10}{'n':>10}" +
+          ''.join(f'{c:>9}' for c in columns) + '  (ms)')
+    for node, summary in report.items():
+        for name, stats in summary.items():
+            print(f"{node:24}{name:>10}{stats['n']:>10}" +
+                  ''.join(f'{stats.get(c, np.nan):9.3f}' for c in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+"""
+nwb_export.py
+
+Export a memory-mapped session (see `cursor_control.session`) to NWB, using
+the `RedisStreams: Outputs` declarations in each node's YAML file. Every
+output stream with `enable_nwb: True` is written according to its
+`type_nwb`:
+
+    TimeSeries  one TimeSeries per field, in acquisition
+    Position    one SpatialSeries per field in a Position container of the
+                'behavior' processing module
+    Trial       the trials table, from the start/end/other trial
+                indicators of the stream's state field
+    TrialInfo   one trials table column per field
+
+Field metadata (unit, description, reference_frame, ...) comes from each
+field's `nwb` section. Continuous data is read from the memory-mapped
+session a buffer at a time and written to chunked, gzip-compressed HDF5
+datasets, so memory use does not grow with the session length.
+
+Timestamps are the `ts` field of each entry (time.monotonic_ns() when it was
+written) relative to the earliest exported entry, or the Redis entry time
+for streams without `ts`.
+
+Requires pynwb.
+
+Usage:
+    python -m cursor_control.nwb_export data/230101T1200_sim_graph_ol \\
+        -o data/230101T1200_sim_graph_ol.nwb
+"""
+import argparse
+import logging
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+import yaml
+
+from .align import UNMATCHED, match
+from .session import load_session
+from .trials import build_trial_table
+
+NODES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                         '..', '..', 'nodes')
+# trial table columns of each radialFSM trial indicator
+TRIAL_EVENTS = {
+    'start_time': 'start_ts',
+    'go_cue_time': 'go_ts',
+    'end_time': 'end_ts',
+}
+
+
+def node_output_specs(graph, nodes_dir=NODES_DIR, sources=None):
+    """
+    NWB-enabled output streams declared by the nodes of a graph
+
+    Stream names in the node YAML files are replaced by the node's
+    `output_stream` parameter when the node has a single output stream.
+
+    Parameters
+    ----------
+    sources : dict, optional
+        Filled with the path of the node YAML file declaring each stream
+
+    Returns
+    -------
+    specs : dict
+        Maps stream names to their declarations
+    """
+    specs = {}
+    for node in graph['nodes']:
+        path = os.path.join(nodes_dir, node['name'], f"{node['name']}.yaml")
+        if not os.path.exists(path):
+            logging.info(f"No stream declarations for {node['name']}")
+            continue
+        with open(path, 'r') as f:
+            node_yaml = yaml.safe_load(f)
+        outputs = (node_yaml.get('RedisStreams') or {}).get('Outputs') or {}
+        params = node.get('parameters') or {}
+        for stream, spec in outputs.items():
+            if len(outputs) == 1 and 'output_stream' in params:
+                stream = params['output_stream']
+            if spec.get('enable_nwb'):
+                specs[stream] = spec
+                if sources is not None:
+                    sources[stream] = path
+    return specs
+
+
+def _fields(spec):
+    # field declarations of a stream
+    return {
+        name: field
+        for name, field in spec.items()
+        if isinstance(field, dict) and 'sample_type' in field
+    }
+
+
+def _nwb_args(field):
+    return dict(field.get('nwb') or {})
+
+
+class _TimeOrigin():
+    # maps each stream's timestamps to seconds since the session start
+
+    def __init__(self, session, streams):
+        self.t0_ns = None
+        self.t0_ms = None
+        for stream in streams:
+            view = session[stream]
+            if len(view) == 0:
+                continue
+            if 'ts' in view.fields:
+                t = int(view['ts'][0])
+                if self.t0_ns is None or t < self.t0_ns:
+                    self.t0_ns = t
+                    self.t0_ms = int(view['id_ms'][0])
+        if self.t0_ms is None:
+            self.t0_ms = min(
+                int(session[s]['id_ms'][0]) for s in streams
+                if len(session[s]))
+
+    def start_time(self):
+        return datetime.fromtimestamp(self.t0_ms / 1e3, tz=timezone.utc)
+
+    def column(self, view):
+        # name of the time column of a stream and a function that converts
+        # it to seconds
+        if 'ts' in view.fields and self.t0_ns is not None:
+            return 'ts', lambda t: (t.astype(np.int64) - self.t0_ns) / 1e9
+        return 'id_ms', lambda t: (t.astype(np.int64) - self.t0_ms) / 1e3
+
+
+def _chunked(array, transform=None, buffer_gb=0.05):
+    # lazily read, chunked and compressed dataset
+    from hdmf.backends.hdf5.h5_utils import H5DataIO
+    from hdmf.data_utils import GenericDataChunkIterator
+
+    class ArrayIterator(GenericDataChunkIterator):
+
+        def __init__(self, array, transform, **kwargs):
+            self.array = array
+            self.transform = transform
+            super().__init__(**kwargs)
+
+        def _get_data(self, selection):
+            data = np.asarray(self.array[selection])
+            return self.transform(data) if self.transform else data
+
+        def _get_maxshape(self):
+            return self.array.shape
+
+        def _get_dtype(self):
+            if self.transform:
+                return np.dtype(np.float64)
+            return self.array.dtype
+
+    return H5DataIO(ArrayIterator(array, transform, buffer_gb=buffer_gb),
+                    compression='gzip')
+
+
+def add_continuous(nwbfile, session, stream, spec, origin, buffer_gb=0.05):
+    """Add a TimeSeries or Position stream"""
+    from pynwb import TimeSeries
+    from pynwb.behavior import Position
+
+    view = session[stream]
+    time_col, to_seconds = origin.column(view)
+    fields = {
+        name: field
+        for name, field in _fields(spec).items() if name in view.fields
+        and view[name].dtype.kind in 'biuf'
+    }
+    if spec['type_nwb'] == 'Position':
+        if 'behavior' in nwbfile.processing:
+            behavior = nwbfile.processing['behavior']
+        else:
+            behavior = nwbfile.create_processing_module(
+                name='behavior', description='task state and kinematics')
+        container = Position(name=stream)
+        behavior.add(container)
+    for name, field in fields.items():
+        args = _nwb_args(field)
+        kwargs = dict(
+            name=name if spec['type_nwb'] == 'Position' else
+            f'{stream}_{name}',
+            data=_chunked(view[name], buffer_gb=buffer_gb),
+            timestamps=_chunked(view[time_col],
+                                transform=to_seconds,
+                                buffer_gb=buffer_gb),
+            unit=args.pop('unit', 'n.a.'),
+            description=args.pop('description', name),
+        )
+        if 'resolution' in args:
+            kwargs['resolution'] = float(args.pop('resolution'))
+        if spec['type_nwb'] == 'Position':
+            container.create_spatial_series(
+                reference_frame=args.pop('reference_frame', 'unknown'),
+                **kwargs)
+        else:
+            nwbfile.add_acquisition(TimeSeries(**kwargs))
+        logging.info(f'Added {stream}.{name} ({spec["type_nwb"]})')
+
+
+def trial_columns(session, table, info_specs):
+    """
+    Trial columns from the TrialInfo streams: each entry is assigned to the
+    latest trial that started at or before its sync count, and each trial
+    takes the first entry assigned to it
+
+    Returns
+    -------
+    columns : dict
+        Maps column names to (values, description) tuples
+    """
+    columns = {}
+    for stream, spec in info_specs.items():
+        if stream not in session:
+            continue
+        view = session[stream]
+        trial = match(np.asarray(view['sync']),
+                      table['start_sync'],
+                      how='backward')
+        # first entry of each trial
+        entries = np.flatnonzero(trial != UNMATCHED)
+        trials, first = np.unique(trial[entries], return_index=True)
+        rows = np.full(table['trial'].shape[0], UNMATCHED)
+        rows[trials] = entries[first]
+        found = rows != UNMATCHED
+        for name, field in _fields(spec).items():
+            if name not in view.fields:
+                continue
+            values = np.asarray(view[name])
+            if values.dtype.kind == 'S':
+                values = values.astype(str)
+                out = np.full(rows.shape[0], '', dtype=values.dtype)
+            elif field['sample_type'] == 'bool':
+                values = values.astype(bool)
+                out = np.zeros(rows.shape[0], dtype=bool)
+            else:
+                out = np.full(rows.shape[0], np.nan)
+            out[found] = values[rows[found]]
+            description = _nwb_args(field).get('description', name)
+            columns[name] = (out, description)
+    return columns
+
+
+def check_trial_indicators(args, source):
+    """
+    Check that the `nwb` section of a Trial stream's state field starts
+    trials at `start_time` and ends them at `end_time`
+
+    Raises
+    ------
+    ValueError
+        Naming the node YAML file `source` and the missing indicator
+    """
+    for key, indicator in (('start_trial_indicators', 'start_time'),
+                           ('end_trial_indicators', 'end_time')):
+        listed = args.get(key) or []
+        if indicator not in listed:
+            raise ValueError(f'{key} of the Trial stream in {source} must '
+                             f'include {indicator!r}, got {listed}')
+
+
+def add_trials(nwbfile,
+               session,
+               trial_spec,
+               info_specs,
+               origin,
+               source='the node YAML'):
+    """Add the trials table"""
+    state_field = next(iter(_fields(trial_spec).values()))
+    args = _nwb_args(state_field)
+    check_trial_indicators(args, source)
+    table = session.trials
+    if table is None:
+        table = build_trial_table(session)
+    # trial event times come from the state stream's ts field
+    to_seconds = origin.column(session['state'])[1]
+
+    events = {}
+    for key in ('start_trial_indicators', 'end_trial_indicators',
+                'other_trial_indicators'):
+        for indicator in args.get(key, []):
+            if indicator not in TRIAL_EVENTS:
+                logging.warning(f'Unknown trial indicator {indicator}')
+                continue
+            events[indicator] = to_seconds(table[TRIAL_EVENTS[indicator]])
+            # events that did not happen are NaN
+            events[indicator][table[TRIAL_EVENTS[indicator]] < 0] = np.nan
+    start = events.pop('start_time')
+    stop = events.pop('end_time')
+    # trials that did not end are dropped
+    keep = ~np.isnan(stop)
+
+    columns = {
+        name: (values, args.get(f'{name}_description', name))
+        for name, values in events.items()
+    }
+    columns.update(trial_columns(session, table, info_specs))
+    for name, (_, description) in columns.items():
+        nwbfile.add_trial_column(name=name, description=description)
+    for i in np.flatnonzero(keep):
+        nwbfile.add_trial(start_time=start[i],
+                          stop_time=stop[i],
+                          **{
+                              name: values[i]
+                              for name, (values, _) in columns.items()
+                          })
+    logging.info(f'Added {np.count_nonzero(keep)} trials')
+
+
+def export_nwb(session_dir,
+               output,
+               graph=None,
+               nodes_dir=NODES_DIR,
+               buffer_gb=0.05):
+    """
+    Write a memory-mapped session to an NWB file
+
+    Parameters
+    ----------
+    session_dir : str
+        Session written by `cursor_control.session`
+    output : str
+        Path of the NWB file
+    graph : dict, optional
+        Graph the session was recorded with, by default the one saved with
+        the session
+    nodes_dir : str, optional
+        Directory containing the node YAML files
+    buffer_gb : float, optional
+        Size of the buffer used to copy each dataset
+    """
+    from pynwb import NWBHDF5IO, NWBFile
+
+    session = load_session(session_dir)
+    graph = graph or session.graph
+    if graph is None:
+        raise ValueError('The session has no graph, pass one explicitly')
+    sources = {}
+    specs = node_output_specs(graph, nodes_dir, sources=sources)
+    continuous = {
+        stream: spec
+        for stream, spec in specs.items()
+        if spec['type_nwb'] in ('TimeSeries', 'Position') and stream in session
+    }
+    origin = _TimeOrigin(session, list(continuous) or session.streams)
+
+    nwbfile = NWBFile(
+        session_description=graph.get('session_description') or
+        graph.get('graph_name', 'BRAND session'),
+        identifier=os.path.basename(os.path.normpath(session_dir)),
+        session_start_time=origin.start_time(),
+        experiment_description=graph.get('graph_name'),
+    )
+    if graph.get('participant_id'):
+        from pynwb.file import Subject
+        nwbfile.subject = Subject(subject_id=str(graph['participant_id']))
+
+    for stream, spec in continuous.items():
+        add_continuous(nwbfile,
+                       session,
+                       stream,
+                       spec,
+                       origin,
+                       buffer_gb=buffer_gb)
+    trial_specs = [
+        s for s, spec in specs.items()
+        if spec['type_nwb'] == 'Trial' and s in session
+    ]
+    if trial_specs:
+        info_specs = {
+            stream: spec
+            for stream, spec in specs.items() if spec['type_nwb'] == 'TrialInfo'
+        }
+        add_trials(nwbfile,
+                   session,
+                   specs[trial_specs[0]],
+                   info_specs,
+                   origin,
+                   source=sources[trial_specs[0]])
+    for stream in specs:
+        if stream not in session:
+            logging.info(f'{stream} is not in the session, skipping')
+
+    with NWBHDF5IO(output, 'w') as io:
+        io.write(nwbfile)
+    logging.info(f'Saved {output}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export a memory-mapped session to NWB')
+    parser.add_argument('session_dir')
+    parser.add_argument('-o', '--output', required=True)
+    parser.add_argument('--graph',
+                        default=None,
+                        help='graph YAML, if not saved with the session')
+    parser.add_argument('--nodes-dir', default=NODES_DIR)
+    parser.add_argument('--buffer-gb', type=float, default=0.05)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    graph = None
+    if args.graph:
+        with open(args.graph, 'r') as f:
+            graph = yaml.safe_load(f)
+    export_nwb(args.session_dir,
+               args.output,
+               graph=graph,
+               nodes_dir=args.nodes_dir,
+               buffer_gb=args.buffer_gb)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""
+profiler.py
+
+On-demand sampling profiler for running nodes. A node with the `profiler`
+node parameter set to true installs handlers for SIGPROF and SIGALRM and
+starts a thread that waits, in a blocking XREAD, for commands on the
+`profiler_control` stream. The thread does not wake while no command is
+sent, and the node's loop is not touched. Nodes without the parameter do
+neither. A command starts a signal-based stack sampler for a number of
+seconds:
+
+    nodes       nicknames of the nodes to profile, separated by spaces, or
+                `*` for every node (default)
+    seconds     how long to sample (default 10)
+    hz          samples per second (default 200)
+    mode        `cpu` samples per CPU time used by the process (SIGPROF),
+                `wall` per elapsed time, so that time spent blocked in
+                reads shows up too (SIGALRM) (default `cpu`)
+    file        path to write the collapsed stacks to on the node's machine,
+                with `{nickname}` replaced (default: the stream only)
+
+The interval timer delivers a signal `hz` times per second. The handler runs
+in the node's main thread and counts the stack of the frame it interrupted.
+Handlers are installed when the node starts, and the timer only runs while
+sampling. At the end, the stacks are written to the `<nickname>_profile`
+stream in collapsed format, one `file:function;...;file:function count` line
+per stack from the outermost frame. That format is what flamegraph.pl and
+speedscope read. Only the main thread is sampled, where all the nodes run
+their loops. Threads such as the display's stream reader are not sampled.
+
+Stacks are made of Python frames. Nodes built with `cython -3 --embed` run
+their own code as C, which has no Python frames, so their stacks only show
+the library and other Python functions they call, under whatever called
+them. Samples taken in compiled code with no Python frame at all are
+counted as `[native]`. To see a node's own functions, run it from its
+`.py` script instead of the `.bin` while profiling.
+
+Usage:
+    python -m cursor_control.profiler start -i 127.0.0.1 -p 6379 \\
+        -n wiener_filter -s 10 --hz 500 --wait -o profiles
+    python -m cursor_control.profiler dump -i 127.0.0.1 -p 6379 \\
+        -n wiener_filter -o wiener_filter.folded
+    flamegraph.pl wiener_filter.folded > wiener_filter.svg
+"""
+import argparse
+import logging
+import os
+import signal
+import threading
+import time
+
+import numpy as np
+
+from .realtime import _last_id
+
+CONTROL_STREAM = b'profiler_control'
+# name of the stacks with no Python frame
+NATIVE = '[native]'
+TIMERS = {
+    'cpu': (signal.ITIMER_PROF, signal.SIGPROF),
+    'wall': (signal.ITIMER_REAL, signal.SIGALRM),
+}
+
+
+class StackSampler():
+    # counts the stacks of the main thread on interval timer signals. Must be
+    # created in the main thread, which is where signal handlers are set
+
+    def __init__(self):
+        self.counts = None
+        self.timer = None
+        for _, signum in TIMERS.values():
+            signal.signal(signum, self._sample)
+
+    def _sample(self, signum, frame):
+        counts = self.counts
+        if counts is None:
+            return
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        key = tuple(stack)
+        counts[key] = counts.get(key, 0) + 1
+
+    def start(self, hz=200., mode='cpu'):
+        """Start sampling `hz` times per second"""
+        if mode not in TIMERS:
+            raise ValueError(f'Unknown profiler mode {mode}')
+        self.counts = {}
+        self.timer = TIMERS[mode][0]
+        signal.setitimer(self.timer, 1 / hz, 1 / hz)
+
+    def stop(self):
+        """Stop sampling and return the stack counts"""
+        signal.setitimer(self.timer, 0)
+        counts, self.counts = self.counts, None
+        return counts
+
+
+def collapse(counts):
+    """
+    Stack counts in collapsed format, one `frame;...;frame count` line per
+    stack from the outermost frame. Empty stacks are counted as `[native]`
+    """
+    merged = {}
+    for stack, n in counts.items():
+        frames = ';'.join(f'{os.path.basename(code.co_filename)}:'
+                          f'{code.co_name}'
+                          for code in reversed(stack)) or NATIVE
+        merged[frames] = merged.get(frames, 0) + n
+    lines = [f'{frames} {n}' for frames, n in merged.items()]
+    return '\n'.join(sorted(lines)) + '\n' if lines else ''
+
+
+def _field(entry, key, default):
+    value = entry.get(key)
+    return value.decode() if value is not None else default
+
+
+class ProfilerListener(threading.Thread):
+    # waits for commands on the profiler control stream and runs the stack
+    # sampler for the requested time
+
+    def __init__(self, r, nickname, stream=CONTROL_STREAM, maxlen=100):
+        super().__init__(daemon=True)
+        self.r = r
+        self.nickname = nickname
+        self.stream = stream
+        self.output_stream = f'{nickname}_profile'
+        self.maxlen = maxlen
+        self.sampler = StackSampler()
+
+    def run(self):
+        last_id = '$'
+        while True:
+            try:
+                reply = self.r.xread({self.stream: last_id}, block=0)
+            except Exception as exc:
+                logging.warning(f'Profiler stopped listening: {exc}')
+                return
+            for last_id, entry in reply[0][1]:
+                nodes = _field(entry, b'nodes', '*').split()
+                if '*' in nodes or self.nickname in nodes:
+                    self.profile(entry)
+
+    def profile(self, command):
+        """Sample the main thread as the command says and write the result"""
+        seconds = float(_field(command, b'seconds', 10))
+        hz = float(_field(command, b'hz', 200))
+        mode = _field(command, b'mode', 'cpu')
+        path = _field(command, b'file', None)
+        logging.info(f'Profiling for {seconds} s at {hz} Hz ({mode})')
+        try:
+            self.sampler.start(hz, mode)
+        except ValueError as exc:
+            logging.warning(str(exc))
+            return
+        time.sleep(seconds)
+        counts = self.sampler.stop()
+        collapsed = collapse(counts)
+        samples = sum(counts.values())
+        entry = {
+            b'ts': np.uint64(time.monotonic_ns()).tobytes(),
+            b'seconds': str(seconds).encode(),
+            b'hz': str(hz).encode(),
+            b'mode': mode.encode(),
+            b'samples': str(samples).encode(),
+        }
+        if path:
+            path = os.path.expanduser(path.format(nickname=self.nickname))
+            with open(path, 'w') as f:
+                f.write(collapsed)
+            entry[b'file'] = path.encode()
+        else:
+            entry[b'collapsed'] = collapsed.encode()
+        self.r.xadd(self.output_stream,
+                    entry,
+                    maxlen=self.maxlen,
+                    approximate=True)
+        logging.info(f'Profiled {samples} samples in {len(counts)} stacks, '
+                     f'written to {path or self.output_stream}')
+
+
+def node_profiler(node):
+    """
+    ProfilerListener of a BRAND node, started, or None unless its
+    `profiler` parameter is true. Call from the node's main thread
+    """
+    if not node.parameters.get('profiler', False):
+        return None
+    listener = ProfilerListener(node.r, node.NAME)
+    listener.start()
+    return listener
+
+
+def main():
+    import redis
+
+    parser = argparse.ArgumentParser(
+        description='Sample the stacks of running nodes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    start = subparsers.add_parser('start', help='start profiling nodes')
+    dump = subparsers.add_parser('dump',
+                                 help='write the latest profile of a node')
+    for p in (start, dump):
+        p.add_argument('-i', '--host', default='127.0.0.1')
+        p.add_argument('-p', '--port', type=int, default=6379)
+    start.add_argument('-n',
+                       '--nodes',
+                       nargs='+',
+                       default=['*'],
+                       help='node nicknames, by default every node')
+    start.add_argument('-s', '--seconds', type=float, default=10.)
+    start.add_argument('--hz', type=float, default=200.)
+    start.add_argument('--mode', choices=sorted(TIMERS), default='cpu')
+    start.add_argument('--file',
+                       default=None,
+                       help='write the stacks to this path on each node\'s '
+                       'machine instead, {nickname} is replaced')
+    start.add_argument('--wait',
+                       action='store_true',
+                       help='wait for the profiles and write them to OUTPUT')
+    start.add_argument('-o',
+                       '--output',
+                       default='.',
+                       help='directory of <nickname>.folded files')
+    dump.add_argument('-n', '--node', required=True, help='node nickname')
+    dump.add_argument('-o',
+                      '--output',
+                      default=None,
+                      help='file to write, by default stdout')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    r = redis.Redis(host=args.host, port=args.port)
+    if args.command == 'dump':
+        last = r.xrevrange(f'{args.node}_profile', '+', '-', count=1)
+        if not last:
+            parser.error(f'No profile of {args.node}')
+        entry = last[0][1]
+        if b'collapsed' not in entry:
+            logging.info(f"Profile written to {entry[b'file'].decode()}")
+            return
+        if args.output:
+            with open(args.output, 'wb') as f:
+                f.write(entry[b'collapsed'])
+        else:
+            print(entry[b'collapsed'].decode(), end='')
+        return
+
+    streams = {}
+    if args.wait:
+        if args.nodes == ['*']:
+            parser.error('--wait needs the node nicknames')
+        streams = {
+            f'{node}_profile': _last_id(r, f'{node}_profile')
+            for node in args.nodes
+        }
+    command = {
+        b'nodes': ' '.join(args.nodes).encode(),
+        b'seconds': str(args.seconds).encode(),
+        b'hz': str(args.hz).encode(),
+        b'mode': args.mode.encode(),
+    }
+    if args.file:
+        command[b'file'] = args.file.encode()
+    r.xadd(CONTROL_STREAM, command, maxlen=100, approximate=True)
+    logging.info(f"Profiling {' '.join(args.nodes)} for {args.seconds} s")
+
+    if streams:
+        os.makedirs(args.output, exist_ok=True)
+    deadline = time.monotonic() + args.seconds + 10
+    while streams and time.monotonic() < deadline:
+        reply = r.xread(streams, block=1000)
+        for stream, entries in reply:
+            stream = stream.decode()
+            del streams[stream]
+            entry = entries[-1][1]
+            node = stream[:-len('_profile')]
+            if b'collapsed' not in entry:
+                logging.info(f"{node}: written to {entry[b'file'].decode()}")
+                continue
+            path = os.path.join(args.output, f'{node}.folded')
+            with open(path, 'wb') as f:
+                f.write(entry[b'collapsed'])
+            logging.info(f"{node}: {entry[b'samples'].decode()} samples "
+                         f'written to {path}')
+    for stream in streams:
+        logging.warning(f"No profile from {stream[:-len('_profile')]}. Is "
+                        'its profiler parameter true?')
+
+
+if __name__ == '__main__':
+    main()
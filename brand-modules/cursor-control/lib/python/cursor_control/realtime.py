@@ -0,0 +1,350 @@
+"""
+realtime.py
+
+Real-time execution profile for the cursor-control nodes, enabled with a
+`realtime` node parameter, usually shared between nodes with a YAML anchor
+in the graph and extended per node with a merge key:
+
+    parameters:
+      realtime: &realtime
+        # lock all current and future memory (mlockall)
+        mlock: true
+        # threads of the BLAS and OpenMP pools (needs threadpoolctl)
+        blas_threads: 1
+        # spin on non-blocking reads for this long before blocking
+        busy_poll_us: 200
+
+    nodes:
+      - name: wiener_filter
+        parameters:
+          realtime:
+            <<: *realtime
+            # CPUs to run on
+            cpus: [3]
+
+`run_priority` already gives the nodes a real-time scheduling priority, but
+a node blocked in XREAD still pays the scheduler's wakeup latency when its
+input arrives. With `busy_poll_us` set, `RealtimeProfile.xread` first polls
+with non-blocking XREADs for up to that long and only then blocks, so an
+entry that arrives within the spin budget is picked up without a wakeup, at
+the cost of a busy core and extra Redis round trips while spinning. The
+shared-memory ring reader (`cursor_control.shm`) spins on its sequence
+number instead, which costs no syscalls.
+
+Measure the wake-to-process latency (from XADD or ring write to the reader
+having the entry) of each read mode on this machine, against a running
+Redis or a private redis-server started for the run, and save the report
+with the machine it ran on:
+
+    python -m cursor_control.realtime bench -i 127.0.0.1 -p 6379 \\
+        --cpus 3 --mlock
+    python -m cursor_control.realtime bench --redis-server redis-server \\
+        --cpus 3 --producer-cpus 2 -o realtime_bench.json
+"""
+import argparse
+import ctypes
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from .metrics import PERCENTILES
+from .shm import RING_SUPPORTED
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+BLAS_ENV = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+def set_affinity(cpus):
+    """Run this process on `cpus` only"""
+    os.sched_setaffinity(0, cpus)
+    logging.info(f'Running on CPUs {sorted(os.sched_getaffinity(0))}')
+
+
+def lock_memory():
+    """
+    Lock all current and future pages of this process in memory, returning
+    False if the kernel refused (see `ulimit -l`)
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        error = ctypes.get_errno()
+        logging.warning(f'mlockall failed: {os.strerror(error)}. Raise the '
+                        'memlock limit (ulimit -l) or grant CAP_IPC_LOCK')
+        return False
+    logging.info('Locked memory')
+    return True
+
+
+def limit_blas_threads(n_threads):
+    """
+    Limit the BLAS and OpenMP thread pools of this process to `n_threads`.
+    The environment variables only reach libraries loaded after this call
+    (and child processes), so the pools numpy has already loaded are
+    limited with threadpoolctl if it is installed
+    """
+    for name in BLAS_ENV:
+        os.environ[name] = str(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        logging.warning('threadpoolctl is not installed, so the BLAS threads '
+                        'of numpy are not limited')
+        return None
+    limits = threadpool_limits(limits=n_threads)
+    logging.info(f'Limited BLAS and OpenMP threads to {n_threads}')
+    return limits
+
+
+class RealtimeProfile():
+    # CPU affinity, memory locking, BLAS threads and busy-poll reads of a
+    # node. The default profile changes nothing and reads block
+
+    def __init__(self, cpus=None, mlock=False, blas_threads=None,
+                 busy_poll_us=0):
+        self.cpus = cpus
+        self.mlock = mlock
+        self.blas_threads = blas_threads
+        self.busy_poll_ns = int(busy_poll_us * 1000)
+        # reads answered while spinning, and reads that had to block
+        self.n_spin = 0
+        self.n_block = 0
+        self._limits = None
+
+    def apply(self):
+        """Apply the profile to this process"""
+        if self.cpus:
+            set_affinity(self.cpus)
+        if self.blas_threads:
+            self._limits = limit_blas_threads(self.blas_threads)
+        # lock memory last, after the thread pools have been set up
+        if self.mlock:
+            lock_memory()
+
+    def xread(self, r, streams, count=1):
+        """
+        XREAD that waits for new entries like `r.xread(streams, count,
+        block=0)`, spinning for up to `busy_poll_us` with non-blocking reads
+        before it blocks
+        """
+        if not self.busy_poll_ns:
+            return r.xread(streams, count=count, block=0)
+        if '$' in streams.values():
+            # '$' only means "new entries" to a blocking XREAD
+            streams = {
+                stream: _last_id(r, stream) if last_id == '$' else last_id
+                for stream, last_id in streams.items()
+            }
+        t_end = time.monotonic_ns() + self.busy_poll_ns
+        while True:
+            reply = r.xread(streams, count=count)
+            if reply:
+                self.n_spin += 1
+                return reply
+            if time.monotonic_ns() > t_end:
+                break
+        self.n_block += 1
+        return r.xread(streams, count=count, block=0)
+
+
+def _last_id(r, stream):
+    last = r.xrevrange(stream, '+', '-', count=1)
+    return last[0][0] if last else '0-0'
+
+
+def node_realtime(node):
+    """
+    RealtimeProfile of a BRAND node from its `realtime` parameter, applied
+    to the node's process
+    """
+    profile = RealtimeProfile(**(node.parameters.get('realtime') or {}))
+    profile.apply()
+    return profile
+
+
+def _produce(kind, target, rate, n, cpus):
+    # write n timestamped entries at `rate` Hz, from a separate process
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    if kind == 'redis':
+        import redis
+        host, port, stream = target
+        r = redis.Redis(host=host, port=port)
+
+        def write(t):
+            r.xadd(stream, {b'ts': np.uint64(t).tobytes()})
+    else:
+        from .shm import RingWriter
+        ring = RingWriter(target, [('ts', np.uint64, ())], n_slots=1024)
+
+        def write(t):
+            ring.write({'ts': t})
+    # give the reader time to start waiting
+    time.sleep(0.5)
+    period = int(1e9 / rate)
+    t_next = time.monotonic_ns()
+    for _ in range(n):
+        t_next += period
+        while time.monotonic_ns() < t_next:
+            remaining = t_next - time.monotonic_ns()
+            if remaining > 200000:
+                time.sleep((remaining - 200000) / 1e9)
+        write(time.monotonic_ns())
+
+
+def bench_mode(mode, profile, n=2000, rate=1000., host='127.0.0.1', port=6379,
+               producer_cpus=None):
+    """
+    Wake-to-process latency (ns) of `n` entries written at `rate` Hz and
+    read in one of the modes 'redis-block', 'redis-poll', 'ring-futex' or
+    'ring-spin'
+    """
+    kind = mode.split('-')[0]
+    if kind == 'redis':
+        import redis
+        r = redis.Redis(host=host, port=port)
+        stream = f'realtime_bench_{os.getpid()}'
+        r.delete(stream)
+        target = (host, port, stream)
+    else:
+        from .shm import SHM_DIR, RingReader
+        target = os.path.join(SHM_DIR, f'cursor_control.bench_{os.getpid()}')
+    producer = multiprocessing.Process(target=_produce,
+                                       args=(kind, target, rate, n,
+                                             producer_cpus))
+    producer.start()
+    latency = np.zeros(n, dtype=np.int64)
+    try:
+        if kind == 'redis':
+            last_id = '$'
+            for i in range(n):
+                if mode == 'redis-poll':
+                    reply = profile.xread(r, {stream: last_id}, count=1)
+                else:
+                    reply = r.xread({stream: last_id}, count=1, block=0)
+                t = time.monotonic_ns()
+                last_id, entry = reply[0][1][0]
+                latency[i] = t - int(
+                    np.frombuffer(entry[b'ts'], dtype=np.uint64)[0])
+        else:
+            reader = RingReader(
+                target,
+                from_start=True,
+                spin_us=profile.busy_poll_ns / 1000 if mode == 'ring-spin'
+                else 0)
+            for i in range(n):
+                _, entry = reader.read(timeout=10.)
+                t = time.monotonic_ns()
+                latency[i] = t - int(
+                    np.frombuffer(entry[b'ts'], dtype=np.uint64)[0])
+    finally:
+        producer.join()
+        if kind == 'redis':
+            r.delete(stream)
+        elif os.path.exists(target):
+            os.unlink(target)
+    return latency
+
+
+def summarize_latency(latency):
+    """Percentiles and maximum of a latency array (ns), in us"""
+    values = np.percentile(latency, PERCENTILES) / 1e3
+    summary = {f'p{p:g}': float(v) for p, v in zip(PERCENTILES, values)}
+    summary['max'] = float(latency.max()) / 1e3
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Real-time profile tools for the cursor-control nodes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench = subparsers.add_parser(
+        'bench', help='measure the wake-to-process latency of each read mode')
+    bench.add_argument('-i', '--host', default='127.0.0.1')
+    bench.add_argument('-p', '--port', type=int, default=6379)
+    bench.add_argument('-m',
+                       '--modes',
+                       nargs='+',
+                       default=['redis-block', 'redis-poll', 'ring-futex',
+                                'ring-spin'])
+    bench.add_argument('-n', type=int, default=2000, help='entries per mode')
+    bench.add_argument('--rate', type=float, default=1000., help='Hz')
+    bench.add_argument('--cpus', type=int, nargs='+', default=None,
+                       help='CPUs of the reader')
+    bench.add_argument('--producer-cpus', type=int, nargs='+', default=None)
+    bench.add_argument('--mlock', action='store_true')
+    bench.add_argument('--blas-threads', type=int, default=None)
+    bench.add_argument('--busy-poll-us', type=float, default=2000.)
+    bench.add_argument('--redis-server',
+                       default=None,
+                       help='start this redis-server on a free port for the '
+                       'run instead of using HOST and PORT')
+    bench.add_argument('--json', action='store_true', help='print JSON')
+    bench.add_argument('--markdown',
+                       action='store_true',
+                       help='print a Markdown table, as in the README')
+    bench.add_argument('-o',
+                       '--output',
+                       default=None,
+                       help='save the report and the machine it ran on')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    profile = RealtimeProfile(cpus=args.cpus,
+                              mlock=args.mlock,
+                              blas_threads=args.blas_threads,
+                              busy_poll_us=args.busy_poll_us)
+    profile.apply()
+    server = None
+    if args.redis_server and any(m.startswith('redis') for m in args.modes):
+        from .benchmark import RedisServer
+        server = RedisServer(args.redis_server)
+        args.host, args.port = '127.0.0.1', server.port
+    report = {}
+    try:
+        for mode in args.modes:
+            if mode.startswith('ring') and not RING_SUPPORTED:
+                logging.warning(f'Skipping {mode}: shared-memory rings need '
+                                'x86-64')
+                continue
+            latency = bench_mode(mode,
+                                 profile,
+                                 n=args.n,
+                                 rate=args.rate,
+                                 host=args.host,
+                                 port=args.port,
+                                 producer_cpus=args.producer_cpus)
+            report[mode] = summarize_latency(latency)
+    finally:
+        if server:
+            server.stop()
+
+    if args.output:
+        from .benchmark import _meta
+        results = {'meta': _meta(), 'config': vars(args), 'latency_us': report}
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        logging.info(f'Saved {args.output}')
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return
+    columns = [f'p{p:g}' for p in PERCENTILES] + ['max']
+    if args.markdown:
+        print('| mode | ' + ' | '.join(columns) + ' |')
+        print('|---' * (len(columns) + 1) + '|')
+        for mode, summary in report.items():
+            print(f'| `{mode}` | ' +
+                  ' | '.join(f'{summary[c]:.1f}' for c in columns) + ' |')
+        return
+    print(f"{'mode':14}" + ''.join(f'{c:>10}' for c in columns) + '  (us)')
+    for mode, summary in report.items():
+        print(f'{mode:14}' + ''.join(f'{summary[c]:10.1f}' for c in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+"""
+recorder.py
+
+Record Redis streams to disk while a graph runs. Each stream is paged with
+XRANGE ... COUNT and written to its own directory as a sequence of chunk
+files, so memory use is bounded by the chunk size no matter how long the
+session is. Progress is saved after every chunk, and a restarted recorder
+resumes from the last recorded entry of each stream.
+
+With `keep_s` set, the recorder also archives: once a chunk is on disk, the
+entries it holds are trimmed from Redis (XTRIM ... MINID ~), except for the
+last `keep_s` seconds of each stream, so Redis memory stays flat while the
+recording stays complete.
+
+Layout of a recorded session:
+
+    <session_dir>/
+        recorder_state.json         last recorded ID of each stream
+        <stream>/
+            chunk_000000.npz
+            chunk_000001.npz
+            ...
+
+Each chunk is columnar: `id_ms` and `id_seq` hold the entry IDs, and each
+field of the stream is stored as its raw bytes concatenated into a
+`data:<field>` uint8 array, with per-entry byte lengths in `len:<field>`
+(-1 where an entry does not have the field).
+
+Usage:
+    python -m cursor_control.recorder -i 127.0.0.1 -p 6379 -o data/session
+    python -m cursor_control.recorder -i 127.0.0.1 -p 6379 -o data/session \\
+        --keep 60
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import time
+
+import numpy as np
+
+STATE_FILE = 'recorder_state.json'
+
+
+def parse_id(entry_id):
+    """Split a stream entry ID into its millisecond and sequence parts"""
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    ms, seq = entry_id.split('-')
+    return int(ms), int(seq)
+
+
+def _write_atomic(path, write):
+    # write to a temporary file and move it into place so that a crash never
+    # leaves a partial file behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def write_chunk(path, entries):
+    """
+    Write a list of (entry_id, entry_dict) tuples to a columnar chunk file
+    """
+    n = len(entries)
+    ids = np.array([parse_id(entry_id) for entry_id, _ in entries],
+                   dtype=np.uint64).reshape(n, 2)
+    fields = []
+    for _, entry_dict in entries:
+        for key in entry_dict:
+            if key not in fields:
+                fields.append(key)
+    columns = {'id_ms': ids[:, 0], 'id_seq': ids[:, 1]}
+    for key in fields:
+        values = [entry_dict.get(key) for _, entry_dict in entries]
+        lengths = np.array([-1 if v is None else len(v) for v in values],
+                           dtype=np.int64)
+        data = b''.join(v for v in values if v is not None)
+        name = key.decode() if isinstance(key, bytes) else key
+        columns[f'data:{name}'] = np.frombuffer(data, dtype=np.uint8)
+        columns[f'len:{name}'] = lengths
+    _write_atomic(path, lambda f: np.savez(f, **columns))
+
+
+def read_chunk(path):
+    """
+    Read a chunk file
+
+    Returns
+    -------
+    ids : array of shape (n_entries, 2)
+        Millisecond and sequence parts of each entry ID
+    fields : dict
+        Maps each field name to a (data, lengths) tuple: the concatenated
+        raw bytes as a uint8 array and the byte length of each entry (-1 if
+        missing)
+    """
+    with np.load(path) as chunk:
+        ids = np.stack([chunk['id_ms'], chunk['id_seq']], axis=1)
+        fields = {}
+        for key in chunk.files:
+            if key.startswith('data:'):
+                name = key[len('data:'):]
+                fields[name] = (chunk[key], chunk[f'len:{name}'])
+    return ids, fields
+
+
+def list_streams(session_dir):
+    """Names of the streams recorded in a session"""
+    return sorted(name for name in os.listdir(session_dir)
+                  if os.path.isdir(os.path.join(session_dir, name)))
+
+
+def chunk_paths(session_dir, stream):
+    stream_dir = os.path.join(session_dir, stream)
+    return [
+        os.path.join(stream_dir, f) for f in sorted(os.listdir(stream_dir))
+        if f.startswith('chunk_') and f.endswith('.npz')
+    ]
+
+
+def iter_chunks(session_dir, stream):
+    """Iterate over the chunks of a recorded stream with `read_chunk`"""
+    for path in chunk_paths(session_dir, stream):
+        yield read_chunk(path)
+
+
+def chunk_entries(ids, fields):
+    """
+    Iterate over the entries of a chunk read with `read_chunk` as
+    (entry_id, entry_dict) tuples, the same format as `xrange`
+    """
+    offsets, data_bytes = {}, {}
+    for name, (data, lengths) in fields.items():
+        offsets[name] = np.concatenate(
+            [[0], np.cumsum(np.maximum(lengths, 0))])
+        data_bytes[name] = data.tobytes()
+    keys = {name: name.encode() for name in fields}
+    for i, (ms, seq) in enumerate(ids):
+        entry = {}
+        for name, (_, lengths) in fields.items():
+            if lengths[i] >= 0:
+                start = offsets[name][i]
+                entry[keys[name]] = data_bytes[name][start:start + lengths[i]]
+        yield f'{ms}-{seq}'.encode(), entry
+
+
+def read_entries(session_dir, stream):
+    """
+    Load a recorded stream as a list of (entry_id, entry_dict) tuples, the
+    same format as `xrange`. This loads the whole stream into memory.
+    """
+    entries = []
+    for ids, fields in iter_chunks(session_dir, stream):
+        entries.extend(chunk_entries(ids, fields))
+    return entries
+
+
+class SessionRecorder():
+    # pages new entries out of Redis streams and writes them to disk in
+    # chunks
+
+    def __init__(self,
+                 r,
+                 session_dir,
+                 streams=None,
+                 exclude_streams=None,
+                 start_id='$',
+                 count=1000,
+                 chunk_size=10000,
+                 flush_interval=10.,
+                 discover_interval=1.,
+                 keep_s=None):
+        self.r = r
+        self.session_dir = session_dir
+        self.streams = ([s.encode() if isinstance(s, str) else s
+                         for s in streams] if streams else None)
+        self.exclude_streams = set(
+            s.encode() if isinstance(s, str) else s
+            for s in (exclude_streams or []))
+        self.count = count  # entries per XRANGE call
+        self.chunk_size = chunk_size  # entries per chunk file
+        # write slow streams to disk at least this often (seconds)
+        self.flush_interval = flush_interval
+        self.discover_interval = discover_interval  # seconds
+        # seconds of recorded entries left in Redis, or None to not trim
+        self.keep_ms = None if keep_s is None else int(keep_s * 1000)
+
+        os.makedirs(self.session_dir, exist_ok=True)
+        self.state_path = os.path.join(self.session_dir, STATE_FILE)
+        # per-stream progress: last ID read from Redis, last ID written to
+        # disk and next chunk index
+        self.last_id = {}
+        self.recorded_id = {}
+        self.n_chunks = {}
+        self.buffers = {}
+        self.t_flush = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            for stream, info in state.items():
+                self.recorded_id[stream.encode()] = info['last_id'].encode()
+                self.n_chunks[stream.encode()] = info['n_chunks']
+            logging.info(f'Resuming recording of {len(state)} streams in '
+                         f'{self.session_dir}')
+
+        # with start_id='$', only record entries added after startup to
+        # streams that already exist
+        self.start_ids = {}
+        if start_id == '$':
+            for stream in self.discover():
+                if stream not in self.recorded_id:
+                    last = self.r.xrevrange(stream, '+', '-', count=1)
+                    if last:
+                        self.start_ids[stream] = last[0][0]
+        self.t_discover = 0
+
+    def discover(self):
+        """Find the streams to record"""
+        if self.streams is not None:
+            return [s for s in self.streams if self.r.exists(s)]
+        streams = []
+        for stream in self.r.scan_iter(_type='stream'):
+            if stream not in self.exclude_streams:
+                streams.append(stream)
+        return streams
+
+    def add_stream(self, stream):
+        self.buffers[stream] = []
+        self.t_flush[stream] = time.monotonic()
+        if stream not in self.recorded_id:
+            self.recorded_id[stream] = self.start_ids.get(stream, None)
+            self.n_chunks[stream] = 0
+        self.last_id[stream] = self.recorded_id[stream]
+        os.makedirs(os.path.join(self.session_dir, stream.decode()),
+                    exist_ok=True)
+
+    def poll(self):
+        """
+        Read the next page of every stream
+
+        Returns
+        -------
+        n_new : int
+            Number of entries read
+        """
+        now = time.monotonic()
+        if now - self.t_discover > self.discover_interval:
+            for stream in self.discover():
+                if stream not in self.buffers:
+                    self.add_stream(stream)
+            self.t_discover = now
+
+        n_new = 0
+        for stream, buffer in self.buffers.items():
+            last_id = self.last_id[stream]
+            # XRANGE is inclusive, so drop the entry we already have
+            entries = self.r.xrange(stream,
+                                    min=last_id if last_id else '-',
+                                    count=self.count + 1)
+            if entries and last_id:
+                if entries[0][0] == last_id:
+                    entries = entries[1:]
+                else:
+                    logging.warning(
+                        f'{stream.decode()} was trimmed past the last '
+                        f'recorded entry {last_id.decode()}, entries up to '
+                        f'{entries[0][0].decode()} may be missing')
+            if entries:
+                buffer.extend(entries)
+                self.last_id[stream] = entries[-1][0]
+                n_new += len(entries)
+            if (len(buffer) >= self.chunk_size
+                    or now - self.t_flush[stream] > self.flush_interval):
+                self.flush(stream)
+        return n_new
+
+    def flush(self, stream):
+        """Write the buffered entries of a stream to a new chunk file"""
+        buffer = self.buffers[stream]
+        self.t_flush[stream] = time.monotonic()
+        if not buffer:
+            return
+        path = os.path.join(self.session_dir, stream.decode(),
+                            f'chunk_{self.n_chunks[stream]:06d}.npz')
+        write_chunk(path, buffer)
+        self.recorded_id[stream] = buffer[-1][0]
+        self.n_chunks[stream] += 1
+        self.buffers[stream] = []
+        self.save_state()
+        if self.keep_ms is not None:
+            self.trim(stream)
+
+    def trim(self, stream):
+        """
+        Trim the recorded entries of a stream from Redis, except for the last
+        `keep_s` seconds. The last recorded entry is kept, so the next XRANGE
+        can start from it
+        """
+        recorded_id = self.recorded_id[stream]
+        recorded_ms, _ = parse_id(recorded_id)
+        keep_from_ms = parse_id(self.last_id[stream])[0] - self.keep_ms
+        minid = keep_from_ms if keep_from_ms < recorded_ms else recorded_id
+        self.r.xtrim(stream, minid=minid, approximate=True)
+
+    def save_state(self):
+        # only entries that have been written to a chunk count as recorded
+        state = {
+            stream.decode(): {
+                'last_id': last_id.decode(),
+                'n_chunks': self.n_chunks[stream]
+            }
+            for stream, last_id in self.recorded_id.items()
+            if last_id is not None
+        }
+        _write_atomic(self.state_path,
+                      lambda f: f.write(json.dumps(state).encode()))
+
+    def drain(self):
+        """
+        Read what is left in the streams, including streams created since
+        the last discovery
+        """
+        self.t_discover = 0
+        while self.poll():
+            pass
+
+    def close(self):
+        """Write all buffered entries to disk"""
+        for stream in self.buffers:
+            self.flush(stream)
+        self.save_state()
+
+    def run(self, poll_interval=0.1):
+        """Record until interrupted"""
+        while True:
+            if self.poll() == 0:
+                time.sleep(poll_interval)
+
+
+def main():
+    import redis
+
+    parser = argparse.ArgumentParser(
+        description='Record Redis streams to chunked files on disk')
+    parser.add_argument('-i', '--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=6379)
+    parser.add_argument('-o',
+                        '--output',
+                        required=True,
+                        help='session directory')
+    parser.add_argument('-s',
+                        '--streams',
+                        nargs='+',
+                        default=None,
+                        help='streams to record (default: all)')
+    parser.add_argument('--exclude', nargs='+', default=[])
+    parser.add_argument('--from-start',
+                        action='store_true',
+                        help='record entries that existed before startup')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--keep',
+                        type=float,
+                        default=None,
+                        help='trim recorded entries from Redis, keeping the '
+                        'last KEEP seconds of each stream')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    r = redis.Redis(host=args.host, port=args.port)
+    recorder = SessionRecorder(r,
+                               args.output,
+                               streams=args.streams,
+                               exclude_streams=args.exclude,
+                               start_id='0' if args.from_start else '$',
+                               count=args.count,
+                               chunk_size=args.chunk_size,
+                               keep_s=args.keep)
+
+    def stop(sig, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    logging.info(f'Recording to {args.output}')
+    try:
+        recorder.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+        logging.info('Recording stopped')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,475 @@
+"""
+replay.py
+
+Replay a recorded session into Redis with its original timing, at 1x, Nx or
+as fast as possible, to feed a real session back into a graph.
+
+Sources:
+    - a directory written by `cursor_control.recorder`. Streams are read
+      lazily, one chunk per stream at a time, by a read-ahead thread, so the
+      session does not have to fit in memory.
+    - a pickled session saved by a notebook. A pickle can only be loaded
+      whole; convert it once with `python -m cursor_control.replay split` to
+      replay large sessions lazily.
+
+The entries of the replayed streams are merged in the order of their
+original entry IDs, and each one is due at its original time (the
+millisecond part of its entry ID, or the `time_field` of the entry, in ns)
+relative to the first one, divided by the speed-up. Entries due within
+`batch_us` of each other are written in one pipeline. Pacing is hybrid:
+the replayer sleeps until `spin_us` before a batch is due and busy-waits for
+the rest, so it holds its schedule to a few microseconds without spinning
+for the whole interval.
+
+Whenever a batch is written more than `tolerance_ms` after it was due, the
+timing error is logged, and every `report_interval` seconds a summary is
+written to the report stream:
+
+    ts              time of the report (time.monotonic_ns(), uint64)
+    entries         entries written since the last report (uint64)
+    batches         pipelines written since the last report (uint64)
+    late            batches written more than `tolerance_ms` late (uint64)
+    error_p50/p99   timing error of the batches in ns (uint64)
+    error_max       largest timing error in ns (uint64)
+    position_ms     recorded time replayed so far, in ms (float64)
+
+Usage:
+    python -m cursor_control.replay play data/230101T1200_sim_graph_cl \\
+        -i 127.0.0.1 -p 6379 -s threshold_values --speed 1
+    python -m cursor_control.replay split data/230101T1200_sim_graph_cl.pkl \\
+        -o data/230101T1200_sim_graph_cl
+"""
+import argparse
+import heapq
+import logging
+import os
+import pickle
+import queue
+import threading
+import time
+
+import numpy as np
+
+from .metrics import (COMPUTE, N_BUCKETS, WAIT, WRITE, bucket_index,
+                      histogram_percentiles)
+from .recorder import (chunk_entries, iter_chunks, list_streams, parse_id,
+                       write_chunk)
+from .trim import StreamTrim
+
+# recorded entries passed from the read-ahead thread at a time
+BLOCK_SIZE = 1024
+
+
+def _recorded_stream(session_dir, stream, index):
+    # entries of a recorded stream, one chunk in memory at a time
+    for ids, fields in iter_chunks(session_dir, stream):
+        for (ms, seq), (_, entry) in zip(ids.tolist(),
+                                         chunk_entries(ids, fields)):
+            yield ms, seq, index, entry
+
+
+def _pickled_stream(entries, index):
+    for entry_id, entry in entries:
+        ms, seq = parse_id(entry_id)
+        yield ms, seq, index, entry
+
+
+def iter_session(source, streams):
+    """
+    Merge the entries of several recorded streams in entry ID order
+
+    Parameters
+    ----------
+    source : str
+        Directory written by `cursor_control.recorder` or pickled session
+    streams : list of str
+        Streams to read
+
+    Yields
+    ------
+    ms, seq : int
+        Entry ID
+    index : int
+        Index of the entry's stream in `streams`
+    entry : dict
+        Entry fields, as returned by `xrange`
+    """
+    if os.path.isdir(source):
+        recorded = set(list_streams(source))
+        missing = [s for s in streams if s not in recorded]
+        if missing:
+            raise ValueError(f'{source} has no recorded streams {missing}')
+        iterators = [
+            _recorded_stream(source, stream, i)
+            for i, stream in enumerate(streams)
+        ]
+    else:
+        logging.warning(f'Loading all of {source}. Convert it with '
+                        '`python -m cursor_control.replay split` to replay '
+                        'it lazily')
+        with open(source, 'rb') as f:
+            graph_data = pickle.load(f)
+        iterators = [
+            _pickled_stream(graph_data.pop(stream.encode(), []), i)
+            for i, stream in enumerate(streams)
+        ]
+        del graph_data
+    return heapq.merge(*iterators)
+
+
+def split_pickle(path, session_dir, chunk_size=10000):
+    """
+    Write a pickled session in the chunked layout of
+    `cursor_control.recorder`, so it can be replayed lazily
+    """
+    with open(path, 'rb') as f:
+        graph_data = pickle.load(f)
+    for stream, entries in graph_data.items():
+        name = stream.decode() if isinstance(stream, bytes) else stream
+        stream_dir = os.path.join(session_dir, name)
+        os.makedirs(stream_dir, exist_ok=True)
+        for i, start in enumerate(range(0, len(entries), chunk_size)):
+            write_chunk(os.path.join(stream_dir, f'chunk_{i:06d}.npz'),
+                        entries[start:start + chunk_size])
+
+
+class Pacer():
+    # hybrid sleep/spin scheduler. Recorded times are mapped to deadlines on
+    # time.monotonic_ns() from the first recorded time
+
+    def __init__(self, speed=1., spin_us=200):
+        self.speed = speed
+        self.spin_ns = int(spin_us * 1000)
+        self.t0 = 0
+        self.t0_recorded = 0
+
+    def start(self, t_recorded):
+        """Make `t_recorded` (ns) due now"""
+        self.t0 = time.monotonic_ns()
+        self.t0_recorded = t_recorded
+
+    def deadline(self, t_recorded):
+        return self.t0 + int((t_recorded - self.t0_recorded) / self.speed)
+
+    def wait(self, deadline):
+        """Wait until `deadline` and return how late (ns) the wait returned"""
+        remaining = deadline - time.monotonic_ns()
+        if remaining > self.spin_ns:
+            time.sleep((remaining - self.spin_ns) / 1e9)
+        t = time.monotonic_ns()
+        while t < deadline:
+            t = time.monotonic_ns()
+        return t - deadline
+
+
+class TimingReport():
+    # timing error of the written batches, summarized every `interval`
+    # seconds in `stream` and in the log
+
+    def __init__(self, r, stream, interval=1., tolerance_ms=1., maxlen=3600):
+        self.r = r
+        self.stream = stream
+        self.interval_ns = int(interval * 1e9)
+        self.tolerance_ns = int(tolerance_ms * 1e6)
+        self.maxlen = maxlen
+        self.counts = [0] * N_BUCKETS
+        self.entries = 0
+        self.batches = 0
+        self.late = 0
+        self.max = 0
+        self.t_flush = time.monotonic_ns()
+
+    def record(self, error_ns, n_entries):
+        self.counts[bucket_index(error_ns)] += 1
+        self.entries += n_entries
+        self.batches += 1
+        if error_ns > self.tolerance_ns:
+            self.late += 1
+        if error_ns > self.max:
+            self.max = error_ns
+
+    def due(self, t):
+        return t - self.t_flush >= self.interval_ns
+
+    def flush(self, position_ms, t=None):
+        """Write the summary of the current interval and reset it"""
+        t = time.monotonic_ns() if t is None else t
+        p50, p99 = np.nan_to_num(histogram_percentiles(self.counts, (50, 99)))
+        if self.late:
+            logging.warning(
+                f'{self.late} of {self.batches} batches late by more than '
+                f'{self.tolerance_ns / 1e6:g} ms, p99 {p99 / 1e6:.3f} ms, '
+                f'max {self.max / 1e6:.3f} ms at {position_ms / 1e3:.3f} s')
+        if self.stream:
+            self.r.xadd(self.stream, {
+                b'ts': np.uint64(t).tobytes(),
+                b'entries': np.uint64(self.entries).tobytes(),
+                b'batches': np.uint64(self.batches).tobytes(),
+                b'late': np.uint64(self.late).tobytes(),
+                b'error_p50': np.uint64(p50).tobytes(),
+                b'error_p99': np.uint64(p99).tobytes(),
+                b'error_max': np.uint64(self.max).tobytes(),
+                b'position_ms': np.float64(position_ms).tobytes(),
+            },
+                        maxlen=self.maxlen,
+                        approximate=True)
+        self.counts = [0] * N_BUCKETS
+        self.entries = self.batches = self.late = self.max = 0
+        self.t_flush = t
+
+
+class Replayer():
+    # replays recorded streams into Redis
+
+    def __init__(self,
+                 r,
+                 source,
+                 streams=('threshold_values', ),
+                 speed=1.,
+                 spin_us=200,
+                 batch_us=500,
+                 max_batch=256,
+                 time_field=None,
+                 start_s=0.,
+                 stop_s=None,
+                 prefix='',
+                 trim=None,
+                 report_stream='replay_timing',
+                 report_interval=1.,
+                 tolerance_ms=1.,
+                 metrics=None,
+                 hooks=None):
+        """
+        Parameters
+        ----------
+        r : redis.Redis
+        source : str
+            Directory written by `cursor_control.recorder` or pickled session
+        streams : list of str
+            Streams to replay
+        speed : float
+            Speed-up relative to the recorded timing, or 0 to replay as fast
+            as possible
+        spin_us : float
+            Time before each deadline spent busy-waiting instead of sleeping
+        batch_us : float
+            Entries due within this time (after the speed-up) of the first
+            entry of a batch are written with it
+        max_batch : int
+            Largest number of entries written in one pipeline
+        time_field : str, optional
+            Field holding each entry's time in ns as a uint64, to pace by
+            instead of the millisecond part of the entry ID. Entries without
+            it are written with the entry before them
+        start_s, stop_s : float, optional
+            Recorded time (s) after the first entry to start and stop at
+        prefix : str
+            Prefix added to the name of each replayed stream
+        trim : cursor_control.trim.StreamTrim, optional
+            Trimming of the replayed streams, by their names with `prefix`
+        report_stream : str, optional
+            Stream to write timing error reports to
+        report_interval : float
+            Seconds between timing error reports
+        tolerance_ms : float
+            Timing error (ms) above which a batch is reported as late
+        metrics : cursor_control.metrics.LoopMetrics, optional
+            Timing of each batch: `compute` (reading and queueing its
+            entries), `wait` (pacing) and `write` (pipeline execute)
+        hooks : cursor_control.hooks.NodeHooks, optional
+            Hooks of a replay node, ticked after each batch is written. Their
+            metrics are used in place of `metrics`
+        """
+        self.r = r
+        self.source = source
+        self.streams = list(streams)
+        self.outputs = [(prefix + s).encode() for s in self.streams]
+        self.speed = speed
+        self.batch_ns = int(batch_us * 1000)
+        self.max_batch = max_batch
+        self.time_field = time_field.encode() if time_field else None
+        self.start_ns = int(start_s * 1e9)
+        self.stop_ns = None if stop_s is None else int(stop_s * 1e9)
+        self.trim = trim or StreamTrim()
+        self.pacer = Pacer(speed, spin_us) if speed else None
+        self.report = TimingReport(r,
+                                   report_stream,
+                                   interval=report_interval,
+                                   tolerance_ms=tolerance_ms)
+        self.metrics = hooks.metrics if hooks else metrics
+        self.hooks = hooks
+        self.position_ns = 0
+        self.n_written = 0
+
+    def _read_ahead(self, blocks):
+        # read and merge entries in a thread so that loading a chunk does
+        # not stall the schedule
+        block = []
+        try:
+            for item in iter_session(self.source, self.streams):
+                block.append(item)
+                if len(block) == BLOCK_SIZE:
+                    blocks.put(block)
+                    block = []
+            blocks.put(block)
+            blocks.put(None)
+        except Exception as exc:
+            blocks.put(exc)
+
+    def entries(self):
+        """
+        Recorded entries to replay as (t_recorded, index, entry) tuples,
+        with t_recorded in ns since the first entry
+        """
+        blocks = queue.Queue(maxsize=8)
+        reader = threading.Thread(target=self._read_ahead,
+                                  args=(blocks, ),
+                                  daemon=True)
+        reader.start()
+        field = self.time_field
+        t_first = None
+        t = 0
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            for ms, _, index, entry in block:
+                if field is None:
+                    t_entry = ms * 1000000
+                elif field in entry:
+                    t_entry = int.from_bytes(entry[field][:8], 'little')
+                else:
+                    t_entry = None
+                if t_entry is not None:
+                    if t_first is None:
+                        t_first = t_entry
+                    t = max(t_entry - t_first, t)
+                if t < self.start_ns:
+                    continue
+                if self.stop_ns is not None and t > self.stop_ns:
+                    return
+                yield t, index, entry
+
+    def run(self):
+        """Replay the session once and return the number of entries written"""
+        p = self.r.pipeline(transaction=False)
+        outputs = self.outputs
+        trim = self.trim
+        metrics = self.metrics
+        # recorded time spanned by a batch
+        window = self.batch_ns * self.speed if self.speed else np.inf
+        batch_t = None
+        n = 0
+        self.n_written = 0
+        if metrics:
+            metrics.start()
+        for t, index, entry in self.entries():
+            if batch_t is not None and (n == self.max_batch
+                                        or t - batch_t > window):
+                self.write(p, batch_t, n)
+                batch_t = None
+                n = 0
+            if batch_t is None:
+                batch_t = t
+                if self.pacer and not self.n_written:
+                    self.pacer.start(t)
+            p.xadd(outputs[index], entry, **trim(outputs[index]))
+            n += 1
+        if n:
+            self.write(p, batch_t, n)
+        self.report.flush(self.position_ns / 1e6)
+        return self.n_written
+
+    def write(self, p, t_recorded, n):
+        """Write a pipeline of `n` entries when `t_recorded` is due"""
+        metrics = self.metrics
+        if metrics:
+            metrics.lap(COMPUTE)
+        error = 0
+        if self.pacer:
+            error = self.pacer.wait(self.pacer.deadline(t_recorded))
+        if metrics:
+            metrics.lap(WAIT)
+        p.execute()
+        if self.hooks:
+            self.hooks.after_tick()
+        elif metrics:
+            metrics.lap(WRITE)
+        self.n_written += n
+        self.position_ns = t_recorded
+        self.report.record(error, n)
+        t = time.monotonic_ns()
+        if self.report.due(t):
+            self.report.flush(t_recorded / 1e6, t)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a recorded session into Redis with its original '
+        'timing')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    play = subparsers.add_parser('play')
+    play.add_argument(
+        'session',
+        help='directory written by cursor_control.recorder or pickled session')
+    play.add_argument('-i', '--host', default='127.0.0.1')
+    play.add_argument('-p', '--port', type=int, default=6379)
+    play.add_argument('-s',
+                      '--streams',
+                      nargs='+',
+                      default=['threshold_values'])
+    play.add_argument('--speed',
+                      type=float,
+                      default=1.,
+                      help='speed-up, or 0 to replay as fast as possible')
+    play.add_argument('--spin-us', type=float, default=200)
+    play.add_argument('--batch-us', type=float, default=500)
+    play.add_argument('--max-batch', type=int, default=256)
+    play.add_argument('--time-field', default=None)
+    play.add_argument('--start', type=float, default=0., help='seconds')
+    play.add_argument('--stop', type=float, default=None, help='seconds')
+    play.add_argument('--prefix', default='')
+    play.add_argument('--maxlen', type=int, default=None)
+    play.add_argument('--max-age',
+                      type=float,
+                      default=None,
+                      help='seconds of entries to keep in each stream')
+    play.add_argument('--tolerance-ms', type=float, default=1.)
+    split = subparsers.add_parser('split')
+    split.add_argument('session', help='pickled session saved by a notebook')
+    split.add_argument('-o', '--output', required=True)
+    split.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'split':
+        split_pickle(args.session, args.output, chunk_size=args.chunk_size)
+        print(f'Wrote {", ".join(list_streams(args.output))} to {args.output}')
+        return
+
+    import redis
+    r = redis.Redis(host=args.host, port=args.port)
+    replayer = Replayer(r,
+                        args.session,
+                        streams=args.streams,
+                        speed=args.speed,
+                        spin_us=args.spin_us,
+                        batch_us=args.batch_us,
+                        max_batch=args.max_batch,
+                        time_field=args.time_field,
+                        start_s=args.start,
+                        stop_s=args.stop,
+                        prefix=args.prefix,
+                        trim=StreamTrim(max_samples=args.maxlen,
+                                        max_age=args.max_age),
+                        tolerance_ms=args.tolerance_ms)
+    t = time.monotonic()
+    n = replayer.run()
+    logging.info(f'Replayed {n} entries ({replayer.position_ns / 1e9:.3f} s '
+                 f'recorded) in {time.monotonic() - t:.3f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""
+scene.py
+
+Compact scene-state records. `cursorData` and `targetData` entries repeat
+their field names, a JSON sync string and separately packed floats on every
+tick. A display on another machine (`sim_graph_cl_mm.yaml`) pulls both of
+them over the network for every update. With the `scene` parameter set,
+radialFSM also packs everything the display draws into one little-endian
+binary record per tick. It writes the record to the `scene` stream, under
+the `scene` field, and sets it as the value of the `scene_latest` key.
+`display_centerOut` with the same parameter reads that one stream instead
+of the two. It reads the key once at startup, so that it can draw before the
+next tick.
+
+Record layout:
+
+    ts              time.monotonic_ns() of the tick (uint64)
+    sync            `count` of the tick's sync dict, -1 if it has none
+                    (int64)
+    i               FSM tick (uint32)
+    state           FSM state (uint8)
+    n_targets       number of target records that follow (uint8)
+    cursor_x, _y    cursor position (float32)
+    cursor_radius   (float32)
+    cursor_state    (uint8)
+    targets         n_targets records of x, y, radius (float32) and state
+                    (uint8)
+    trace           the rest of the record, if any: the cursor trace of
+                    cursor_control.trace
+
+To compare the bytes a display moves per update, as command and reply, with
+the two streams and with the scene record:
+
+    python -m cursor_control.scene size
+    python -m cursor_control.scene size --trace --json
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+SCENE_STREAM = b'scene'
+SCENE_KEY = b'scene_latest'
+SCENE_FIELD = b'scene'
+
+HEADER_DTYPE = np.dtype([
+    ('ts', '<u8'),
+    ('sync', '<i8'),
+    ('i', '<u4'),
+    ('state', 'u1'),
+    ('n_targets', 'u1'),
+    ('cursor_x', '<f4'),
+    ('cursor_y', '<f4'),
+    ('cursor_radius', '<f4'),
+    ('cursor_state', 'u1'),
+])
+TARGET_DTYPE = np.dtype([
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('radius', '<f4'),
+    ('state', 'u1'),
+])
+
+
+def scene_dtype(n_targets=1):
+    """Record dtype of a scene with `n_targets` targets, without the trace"""
+    return np.dtype(HEADER_DTYPE.descr + [('targets', TARGET_DTYPE,
+                                           (n_targets, ))])
+
+
+class ScenePacker():
+    # packs the cursor and targets of a tick into a preallocated scene
+    # record, so that a tick allocates only the bytes it returns
+
+    def __init__(self, n_targets=1):
+        self.record = np.zeros((), dtype=scene_dtype(n_targets))
+        self.record['n_targets'] = n_targets
+        self.targets = self.record['targets']
+
+    def pack(self, i, state, sync_dict, cursor, targets, trace=None):
+        """
+        Scene record of a tick, from the FSM's Cursor and Target objects
+
+        Returns
+        -------
+        record : bytes
+        """
+        record = self.record
+        record['ts'] = time.monotonic_ns()
+        record['sync'] = sync_dict.get('count', -1)
+        record['i'] = i
+        record['state'] = state
+        record['cursor_x'] = cursor.x
+        record['cursor_y'] = cursor.y
+        record['cursor_radius'] = cursor.radius
+        record['cursor_state'] = cursor.state
+        for row, target in zip(self.targets, targets):
+            row['x'] = target.x
+            row['y'] = target.y
+            row['radius'] = target.radius
+            row['state'] = target.state
+        data = record.tobytes()
+        return data + trace if trace else data
+
+
+def unpack_scene(data):
+    """
+    Decode a scene record
+
+    Returns
+    -------
+    scene : dict
+        `ts`, `sync`, `i` and `state`, `cursor` and each of `targets` as
+        dicts of `X`, `Y`, `radius` and `state` like decoded cursorData and
+        targetData entries, and `trace` (bytes, or None)
+    """
+    header = np.frombuffer(data, HEADER_DTYPE, count=1)[0]
+    n_targets = int(header['n_targets'])
+    targets = np.frombuffer(data,
+                            TARGET_DTYPE,
+                            count=n_targets,
+                            offset=HEADER_DTYPE.itemsize)
+    end = HEADER_DTYPE.itemsize + n_targets * TARGET_DTYPE.itemsize
+    return {
+        'ts': int(header['ts']),
+        'sync': int(header['sync']),
+        'i': int(header['i']),
+        'state': int(header['state']),
+        'cursor': {
+            'X': float(header['cursor_x']),
+            'Y': float(header['cursor_y']),
+            'radius': float(header['cursor_radius']),
+            'state': int(header['cursor_state']),
+        },
+        'targets': [{
+            'X': float(t['x']),
+            'Y': float(t['y']),
+            'radius': float(t['radius']),
+            'state': int(t['state']),
+        } for t in targets],
+        'trace': data[end:] if len(data) > end else None,
+    }
+
+
+def resp_size(value):
+    """Bytes of a reply in the Redis protocol (RESP2)"""
+    if value is None:
+        return len(b'$-1\r\n')
+    if isinstance(value, (list, tuple)):
+        return (len(f'*{len(value)}\r\n') +
+                sum(resp_size(item) for item in value))
+    if isinstance(value, dict):
+        return resp_size([item for pair in value.items() for item in pair])
+    if isinstance(value, int):
+        return len(f':{value}\r\n')
+    if isinstance(value, str):
+        value = value.encode()
+    return len(f'${len(value)}\r\n') + len(value) + 2
+
+
+def command_size(*args):
+    """Bytes of a command as redis-py sends it"""
+    from redis.connection import Connection
+    return sum(len(chunk) for chunk in Connection().pack_command(*args))
+
+
+def _example(trace):
+    # a tick of the centre-out task: the FSM entries and the scene record
+    from types import SimpleNamespace
+
+    from .trace import HOP, NODES, TRACE_KEY
+
+    cursor = SimpleNamespace(x=-123.456, y=78.9, radius=25., state=1)
+    target = SimpleNamespace(x=400., y=0., radius=50., state=2)
+    sync_dict = {'count': 1234567}
+    t = np.uint64(time.monotonic_ns()).tobytes()
+    trace_bytes = bytes(HOP.size * len(NODES)) if trace else None
+
+    def shape(obj):
+        return {
+            b'X': np.float32(obj.x).tobytes(),
+            b'Y': np.float32(obj.y).tobytes(),
+            b'radius': np.float32(obj.radius).tobytes(),
+            b'state': np.int32(obj.state).tobytes(),
+            b'i': np.uint32(98765).tobytes(),
+            b'sync': json.dumps(sync_dict).encode(),
+            b'ts': t,
+        }
+
+    cursor_entry = shape(cursor)
+    if trace:
+        cursor_entry[TRACE_KEY] = trace_bytes
+    record = ScenePacker().pack(98765, 2, sync_dict, cursor, [target],
+                                trace_bytes)
+    return cursor_entry, shape(target), record
+
+
+def frame_bytes(trace=False):
+    """
+    Bytes per display update (command and reply) of reading cursorData and
+    targetData with one XREAD, and of reading the scene stream
+    """
+    entry_id = b'1700000000000-0'
+    cursor_entry, target_entry, record = _example(trace)
+    before_command = command_size('XREAD', 'BLOCK', 100, 'STREAMS',
+                                  'cursorData', 'targetData', entry_id,
+                                  entry_id)
+    before_reply = resp_size([[b'cursorData', [[entry_id, cursor_entry]]],
+                              [b'targetData', [[entry_id, target_entry]]]])
+    after_command = command_size('XREAD', 'BLOCK', 100, 'STREAMS',
+                                 SCENE_STREAM, entry_id)
+    after_reply = resp_size([[SCENE_STREAM,
+                              [[entry_id, {
+                                  SCENE_FIELD: record
+                              }]]]])
+    return {
+        'before': {
+            'command': before_command,
+            'reply': before_reply,
+            'total': before_command + before_reply,
+        },
+        'after': {
+            'command': after_command,
+            'reply': after_reply,
+            'total': after_command + after_reply,
+            'record': len(record),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Scene-state records for remote displays')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    size = subparsers.add_parser(
+        'size', help='bytes per display update, before and after')
+    size.add_argument('--trace',
+                      action='store_true',
+                      help='with cursor traces')
+    size.add_argument('--json', action='store_true', help='print JSON')
+    args = parser.parse_args()
+
+    report = frame_bytes(trace=args.trace)
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return
+    print(f"{'':28}{'command':>9}{'reply':>9}{'total':>9}  (bytes)")
+    for name, label in (('before', 'cursorData + targetData'),
+                        ('after', 'scene')):
+        sizes = report[name]
+        print(f'{label:28}' +
+              ''.join(f'{sizes[c]:9}' for c in ('command', 'reply', 'total')))
+    print(f"scene record: {report['after']['record']} bytes")
+
+
+if __name__ == '__main__':
+    main()
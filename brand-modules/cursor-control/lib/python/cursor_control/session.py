@@ -0,0 +1,358 @@
+"""
+session.py
+
+On-disk session format that can be memory-mapped. Every field of every
+stream is decoded once (see `cursor_control.decode`) and saved as a
+fixed-dtype `.npy` file, so a session of any length can be opened without
+reading it into memory. Only the streams, fields and rows that are accessed
+are paged in from disk.
+
+Layout:
+
+    <session_dir>/
+        session.json        streams, fields, dtypes and shapes, and the graph
+        <stream>/
+            id_ms.npy       Redis entry ID, millisecond part  (index column)
+            id_seq.npy      Redis entry ID, sequence part     (index column)
+            <field>.npy     one row per entry
+
+`sync` fields are stored as int64 sync counts and also serve as an index
+column. `str` fields are stored as fixed-width byte strings and
+`timeval`/`timespec` fields as float64 seconds. Numeric fields that are
+missing from some entries are stored as float64 with NaN.
+
+Usage:
+    python -m cursor_control.session convert data/230101T1200_sim_graph_ol.pkl \\
+        --spec stream_spec_ol.yaml -o data/230101T1200_sim_graph_ol
+    python -m cursor_control.session info data/230101T1200_sim_graph_ol
+"""
+import argparse
+import json
+import os
+import pickle
+
+import numpy as np
+
+from .decode import decode_column, decode_stream
+from .recorder import chunk_paths, list_streams, read_chunk
+from .trials import (build_trial_table, load_trial_table, save_trial_table,
+                     trial_rows)
+
+INFO_FILE = 'session.json'
+INDEX_COLUMNS = ('id_ms', 'id_seq')
+
+
+def _graph(graph_data):
+    # graph loaded by the supervisor, if it was recorded
+    entries = graph_data.get(b'booter', [])
+    graphs = [json.loads(e[b'graph']) for _, e in entries if b'graph' in e]
+    return graphs[-1] if graphs else None
+
+
+def _field_info(values):
+    return {'dtype': values.dtype.str, 'shape': list(values.shape)}
+
+
+def _storable(values):
+    # object arrays of strings can not be memory-mapped
+    if values.dtype == object and all(v is None or isinstance(v, str)
+                                      for v in values):
+        return np.array([b'' if v is None else v.encode() for v in values])
+    return values
+
+
+def _save_stream(stream_dir, ids, decoded):
+    os.makedirs(stream_dir, exist_ok=True)
+    info = {}
+    columns = {'id_ms': ids[:, 0], 'id_seq': ids[:, 1]}
+    columns.update(decoded)
+    for name, values in columns.items():
+        values = _storable(values)
+        if values.dtype == object:
+            raise ValueError(f'Field {name} has entries of different sizes '
+                             'and can not be stored as a flat array')
+        np.save(os.path.join(stream_dir, f'{name}.npy'), values)
+        info[name] = _field_info(values)
+    return info
+
+
+def _write_info(session_dir, streams, graph=None):
+    with open(os.path.join(session_dir, INFO_FILE), 'w') as f:
+        json.dump({'streams': streams, 'graph': graph}, f, indent=1)
+
+
+def write_session(graph_data, stream_spec, session_dir, streams=None):
+    """
+    Convert streams loaded in memory (the pickled format saved by the
+    notebooks) to a memory-mappable session
+
+    Parameters
+    ----------
+    graph_data : dict
+        Maps stream names (bytes) to lists of (entry_id, entry_dict) tuples
+    stream_spec : dict
+        Field types of each stream, as in `notebooks/stream_spec_*.yaml`
+    session_dir : str
+        Directory to write the session to
+    streams : list of str, optional
+        Streams to convert, by default all streams in both `graph_data` and
+        `stream_spec`
+    """
+    if streams is None:
+        streams = [s for s in stream_spec if s.encode() in graph_data]
+    os.makedirs(session_dir, exist_ok=True)
+    info = {}
+    for stream in streams:
+        entries = graph_data[stream.encode()]
+        ids = np.array([[int(i) for i in entry_id.split(b'-')]
+                        for entry_id, _ in entries],
+                       dtype=np.uint64).reshape(-1, 2)
+        decoded = decode_stream(entries, stream_spec[stream])
+        info[stream] = _save_stream(os.path.join(session_dir, stream), ids,
+                                    decoded)
+    _write_info(session_dir, info, graph=_graph(graph_data))
+    _save_trials(session_dir)
+
+
+def convert_recording(recording_dir, stream_spec, session_dir, streams=None):
+    """
+    Convert a session written by `cursor_control.recorder` one chunk at a
+    time, so memory use is bounded by the chunk size
+    """
+    if streams is None:
+        streams = [s for s in list_streams(recording_dir) if s in stream_spec]
+    os.makedirs(session_dir, exist_ok=True)
+    info = {}
+    for stream in streams:
+        spec = stream_spec[stream]
+        paths = chunk_paths(recording_dir, stream)
+        # first pass: number of entries and the dtype and width of each field
+        n = 0
+        widths, max_len, missing = {}, {}, set()
+        chunk_fields = []
+        for path in paths:
+            with np.load(path) as chunk:
+                n += chunk['id_ms'].shape[0]
+                chunk_fields.append(set(chunk.files))
+                for key in chunk.files:
+                    name = key[len('len:'):]
+                    if not key.startswith('len:') or name not in spec:
+                        continue
+                    lengths = chunk[key]
+                    if (lengths < 0).any():
+                        missing.add(name)
+                    if (lengths >= 0).any() and name not in widths:
+                        widths[name] = lengths[lengths >= 0][0]
+                    max_len[name] = max(max_len.get(name, 0),
+                                        int(lengths.max(initial=0)))
+        # fields that some chunks do not have at all
+        for name in widths:
+            if any(f'len:{name}' not in files for files in chunk_fields):
+                missing.add(name)
+        stream_dir = os.path.join(session_dir, stream)
+        os.makedirs(stream_dir, exist_ok=True)
+
+        # second pass: decode each chunk into preallocated files
+        out = {}
+        row = 0
+        for path in paths:
+            ids, fields = read_chunk(path)
+            rows = slice(row, row + ids.shape[0])
+            for name, values in (('id_ms', ids[:, 0]), ('id_seq', ids[:, 1])):
+                if name not in out:
+                    out[name] = np.lib.format.open_memmap(
+                        os.path.join(stream_dir, f'{name}.npy'),
+                        mode='w+',
+                        dtype=np.uint64,
+                        shape=(n, ))
+                out[name][rows] = values
+            for name, (data, lengths) in fields.items():
+                if name not in spec:
+                    continue
+                if name not in out:
+                    first = decode_column(data[:widths[name]],
+                                          np.array([widths[name]]),
+                                          spec[name])
+                    first = _storable(first)
+                    dtype = first.dtype
+                    if spec[name] == 'str':
+                        dtype = np.dtype(f'S{max(max_len[name], 1)}')
+                    elif name in missing and dtype.kind in 'iub':
+                        dtype = np.dtype(np.float64)
+                    out[name] = np.lib.format.open_memmap(
+                        os.path.join(stream_dir, f'{name}.npy'),
+                        mode='w+',
+                        dtype=dtype,
+                        shape=(n, ) + first.shape[1:])
+                    if name in missing and dtype.kind == 'f':
+                        out[name][:] = np.nan
+                values = _storable(decode_column(data, lengths, spec[name]))
+                if values.dtype == object:
+                    raise ValueError(
+                        f'Field {name} of {stream} has entries of different '
+                        'sizes and can not be stored as a flat array')
+                out[name][rows] = values
+            row += ids.shape[0]
+        info[stream] = {}
+        for name, values in out.items():
+            values.flush()
+            info[stream][name] = _field_info(values)
+        del out
+    graph = None
+    if 'booter' in list_streams(recording_dir):
+        from .recorder import read_entries
+        graph = _graph({b'booter': read_entries(recording_dir, 'booter')})
+    _write_info(session_dir, info, graph=graph)
+    _save_trials(session_dir)
+
+
+def _save_trials(session_dir):
+    # index the session by trial if it has radialFSM's trial events
+    session = load_session(session_dir)
+    if 'state' in session:
+        save_trial_table(build_trial_table(session), session_dir)
+
+
+class StreamView():
+    # lazily loaded stream of a memory-mapped session
+
+    def __init__(self, stream_dir, fields):
+        self.stream_dir = stream_dir
+        self.fields = list(fields)
+        self._columns = {}
+
+    def __getitem__(self, name):
+        if name not in self._columns:
+            if name not in self.fields:
+                raise KeyError(name)
+            path = os.path.join(self.stream_dir, f'{name}.npy')
+            self._columns[name] = np.load(path, mmap_mode='r')
+        return self._columns[name]
+
+    def __len__(self):
+        return self['id_ms'].shape[0]
+
+    def range(self, column, start=None, stop=None):
+        """
+        Rows where `column` is in [start, stop). `column` must be sorted,
+        e.g. an index column, `sync` or `ts`.
+
+        Returns
+        -------
+        rows : slice
+        """
+        values = self[column]
+        i0 = 0 if start is None else np.searchsorted(values, start, 'left')
+        i1 = (values.shape[0]
+              if stop is None else np.searchsorted(values, stop, 'left'))
+        return slice(int(i0), int(i1))
+
+    def time_range(self, start_ms=None, stop_ms=None):
+        """Rows with Redis entry times in [start_ms, stop_ms)"""
+        return self.range('id_ms', start_ms, stop_ms)
+
+    def read(self, rows=slice(None), fields=None):
+        """Copy the given rows of each field into memory"""
+        fields = fields or [f for f in self.fields if f not in INDEX_COLUMNS]
+        return {name: np.asarray(self[name][rows]) for name in fields}
+
+    def to_dataframe(self, rows=slice(None), fields=None):
+        """
+        Load rows as a DataFrame in the same format as
+        `cursor_control.decode.to_dataframe`
+        """
+        from .decode import to_dataframe
+        decoded = self.read(rows, fields)
+        for name, values in decoded.items():
+            if values.dtype.kind == 'S':
+                decoded[name] = values.astype(str).astype(object)
+        return to_dataframe(decoded)
+
+
+class Session():
+    # memory-mapped session written by `write_session` or
+    # `convert_recording`
+
+    def __init__(self, session_dir):
+        self.session_dir = session_dir
+        with open(os.path.join(session_dir, INFO_FILE), 'r') as f:
+            info = json.load(f)
+        self.info = info['streams']
+        self.graph = info['graph']
+        self.streams = list(self.info)
+        self._views = {}
+        self._trials = None
+
+    def __getitem__(self, stream):
+        if stream not in self._views:
+            if stream not in self.info:
+                raise KeyError(stream)
+            self._views[stream] = StreamView(
+                os.path.join(self.session_dir, stream), self.info[stream])
+        return self._views[stream]
+
+    def __contains__(self, stream):
+        return stream in self.info
+
+    @property
+    def trials(self):
+        """Trial table (see `cursor_control.trials`), or None"""
+        if self._trials is None:
+            self._trials = load_trial_table(self.session_dir)
+        return self._trials
+
+    def trial_rows(self, trial, stream):
+        """Rows of `stream` during a trial"""
+        return trial_rows(self.trials, trial, stream)
+
+
+def load_session(session_dir):
+    """Open a memory-mapped session"""
+    return Session(session_dir)
+
+
+def main():
+    import yaml
+
+    parser = argparse.ArgumentParser(
+        description='Convert recorded sessions to the memory-mapped format')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert')
+    convert.add_argument(
+        'source',
+        help='pickled session saved by a notebook, or a directory written by '
+        'cursor_control.recorder')
+    convert.add_argument('--spec', required=True, help='stream spec YAML file')
+    convert.add_argument('-o', '--output', required=True)
+    convert.add_argument('-s', '--streams', nargs='+', default=None)
+    info = subparsers.add_parser('info')
+    info.add_argument('session_dir')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        with open(args.spec, 'r') as f:
+            stream_spec = yaml.safe_load(f)
+        if os.path.isdir(args.source):
+            convert_recording(args.source,
+                              stream_spec,
+                              args.output,
+                              streams=args.streams)
+        else:
+            with open(args.source, 'rb') as f:
+                graph_data = pickle.load(f)
+            write_session(graph_data,
+                          stream_spec,
+                          args.output,
+                          streams=args.streams)
+    session = load_session(args.output if args.command == 'convert' else
+                           args.session_dir)
+    for stream in session.streams:
+        fields = ', '.join(
+            f'{name} {np.dtype(f["dtype"])}{tuple(f["shape"][1:]) or ""}'
+            for name, f in session.info[stream].items()
+            if name not in INDEX_COLUMNS)
+        print(f'{stream} ({len(session[stream])} entries): {fields}')
+
+
+if __name__ == '__main__':
+    main()
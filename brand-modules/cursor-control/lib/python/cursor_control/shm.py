@@ -0,0 +1,491 @@
+"""
+shm.py
+
+Shared-memory ring buffer transport between nodes on the same machine. A
+producer writes fixed-size records (a numpy structured dtype) into a ring
+of slots in a file under /dev/shm; consumers map the same file and read the
+records in place, without serializing or copying them through Redis.
+
+Layout of a ring file:
+
+    0       magic b'CCRB', version (uint32)
+    8       n_slots, slot_size, record_size, len(dtype JSON) (uint64)
+    64      write_seq: number of records published (uint64)
+    72      futex word: low 32 bits of write_seq (uint32)
+    256     record dtype as JSON
+    4096    n_slots slots of slot_size bytes: the sequence number of the
+            record in the slot (uint64, 0 while it is being written),
+            followed by the record
+
+Record k (counting from 0) is written to slot k % n_slots, and its slot
+holds sequence number k + 1 once it is complete. A consumer keeps the next
+sequence number it wants to read, so it knows how many records it missed if
+it falls more than n_slots behind, and can check that a record it is still
+using has not been overwritten since (`RingReader.valid`). Consumers wait
+for new records on the futex word (FUTEX_WAIT with the last value seen, so
+no wakeup is lost) and the producer wakes them after every record. Where
+futexes are not available, consumers poll instead.
+
+The producer publishes a record with plain stores in order (slot sequence
+number, then write_seq), with no memory barriers. Other processes see them
+in the same order only on x86-64, so rings are refused on other machines:
+RingWriter and RingReader raise, and the node helpers log a warning and
+keep the stream in Redis.
+
+Records are described by a list of (name, dtype, shape) fields. A field of
+dtype 'bytes' holds up to `shape` bytes of variable-length data, such as a
+JSON sync dict or a trace, stored with its length. Readers return each
+record as a dict like a Redis entry: array fields are views into the ring,
+scalar fields are bytes as they would be in Redis, and bytes fields are
+bytes.
+
+Nodes select the transport per stream with a `shm_streams` parameter that
+maps stream names to ring settings, usually shared between the producer
+and the consumers with a YAML anchor in the graph:
+
+    parameters:
+      shm_streams: &shm_streams
+        binned_spikes:
+          n_slots: 1024
+          # also write every 10th record to Redis, 0 for none
+          redis_every: 10
+
+Usage:
+    python -m cursor_control.shm binned_spikes
+"""
+import argparse
+import ctypes
+import json
+import logging
+import mmap
+import os
+import platform
+import time
+
+import numpy as np
+
+MAGIC = b'CCRB'
+VERSION = 1
+HEADER_SIZE = 4096
+DTYPE_OFFSET = 256
+WRITE_SEQ_OFFSET = 64
+FUTEX_OFFSET = 72
+SHM_DIR = '/dev/shm'
+
+FUTEX_WAIT = 0
+FUTEX_WAKE = 1
+# the publication order of records relies on x86-64 store ordering
+RING_SUPPORTED = platform.machine() == 'x86_64'
+SYS_FUTEX = 202 if RING_SUPPORTED else None
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _syscall = _libc.syscall
+except (OSError, AttributeError):
+    _syscall = None
+HAVE_FUTEX = SYS_FUTEX is not None and _syscall is not None
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def futex_wait(address, expected, timeout=None):
+    """Sleep while the uint32 at `address` equals `expected`"""
+    ts = None
+    if timeout is not None:
+        ts = ctypes.byref(
+            _Timespec(int(timeout), int((timeout - int(timeout)) * 1e9)))
+    _syscall(SYS_FUTEX, ctypes.c_void_p(address), FUTEX_WAIT,
+             ctypes.c_uint32(expected), ts, None, 0)
+
+
+def futex_wake(address):
+    """Wake every process waiting on the uint32 at `address`"""
+    _syscall(SYS_FUTEX, ctypes.c_void_p(address), FUTEX_WAKE, 0x7fffffff,
+             None, None, 0)
+
+
+def _check_supported():
+    if not RING_SUPPORTED:
+        raise RuntimeError('Shared-memory rings rely on x86-64 store '
+                           'ordering and are not safe on '
+                           f'{platform.machine()}')
+
+
+def ring_path(stream, name=None):
+    """Path of the ring file of a stream"""
+    return os.path.join(SHM_DIR, name or f'cursor_control.{stream}')
+
+
+def record_dtype(fields):
+    """
+    Structured dtype of a record
+
+    Parameters
+    ----------
+    fields : list of (name, dtype, shape)
+        `shape` is () for scalars. Fields of dtype 'bytes' hold up to
+        `shape` bytes, with their length in `<name>_len`
+
+    Returns
+    -------
+    dtype : numpy.dtype
+    bytes_fields : list of str
+    """
+    spec = []
+    bytes_fields = []
+    for name, dtype, shape in fields:
+        if dtype == 'bytes':
+            spec.append((name, np.uint8, (shape, )))
+            spec.append((f'{name}_len', np.uint16))
+            bytes_fields.append(name)
+        else:
+            spec.append((name, dtype, shape))
+    return np.dtype(spec), bytes_fields
+
+
+def _slot_dtype(rec_dtype):
+    # sequence number and record, padded to whole cache lines
+    slot_size = -(-(8 + rec_dtype.itemsize) // 64) * 64
+    return np.dtype({
+        'names': ['seq', 'record'],
+        'formats': [np.uint64, rec_dtype],
+        'offsets': [0, 8],
+        'itemsize': slot_size
+    })
+
+
+class _Ring():
+    # views of a mapped ring file
+
+    def _map(self, fd, size):
+        self.mm = mmap.mmap(fd, size)
+        self.header = np.frombuffer(self.mm,
+                                    dtype=np.uint64,
+                                    count=8,
+                                    offset=0)
+        self.write_seq = np.frombuffer(self.mm,
+                                       dtype=np.uint64,
+                                       count=1,
+                                       offset=WRITE_SEQ_OFFSET)
+        self.futex = np.frombuffer(self.mm,
+                                   dtype=np.uint32,
+                                   count=1,
+                                   offset=FUTEX_OFFSET)
+        self.futex_address = ctypes.addressof(
+            ctypes.c_uint32.from_buffer(self.mm, FUTEX_OFFSET))
+
+    def _map_slots(self, rec_dtype, n_slots):
+        slot_dtype = _slot_dtype(rec_dtype)
+        slots = np.frombuffer(self.mm,
+                              dtype=slot_dtype,
+                              count=n_slots,
+                              offset=HEADER_SIZE)
+        self.slot_seq = slots['seq']
+        self.records = slots['record']
+        # raw bytes of each record, to copy serialized fields into
+        self.raw = np.frombuffer(self.mm,
+                                 dtype=np.uint8,
+                                 count=n_slots * slot_dtype.itemsize,
+                                 offset=HEADER_SIZE).reshape(
+                                     n_slots, slot_dtype.itemsize)[:, 8:]
+        self.n_slots = n_slots
+
+
+class RingWriter(_Ring):
+    # producer side of a ring. Creates the ring file, replacing any ring
+    # left by a previous run
+
+    def __init__(self, path, fields, n_slots=1024):
+        _check_supported()
+        self.path = path
+        self.dtype, self.bytes_fields = record_dtype(fields)
+        # byte offset and size of each field in a record, by str and bytes
+        # name
+        self.names = {}
+        for name in self.dtype.names:
+            dtype, offset = self.dtype.fields[name][:2]
+            field = (name, offset, dtype.itemsize)
+            self.names[name] = field
+            self.names[name.encode()] = field
+        slot_dtype = _slot_dtype(self.dtype)
+        size = HEADER_SIZE + n_slots * slot_dtype.itemsize
+        descr = json.dumps([[name, np.dtype(dtype).str if dtype != 'bytes'
+                             else 'bytes', shape]
+                            for name, dtype, shape in fields]).encode()
+        if DTYPE_OFFSET + len(descr) > HEADER_SIZE:
+            raise ValueError('Too many record fields for the ring header')
+
+        # build the ring in a temporary file and move it into place, so a
+        # reader never maps a partial header
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.ftruncate(fd, size)
+            self._map(fd, size)
+        finally:
+            os.close(fd)
+        self.mm[DTYPE_OFFSET:DTYPE_OFFSET + len(descr)] = descr
+        self.header[1:5] = (n_slots, slot_dtype.itemsize, self.dtype.itemsize,
+                            len(descr))
+        self.mm[0:8] = MAGIC + np.uint32(VERSION).tobytes()
+        os.replace(tmp_path, path)
+        self._map_slots(self.dtype, n_slots)
+        self.seq = 0
+
+    def write(self, entry):
+        """
+        Publish a record from a dict like a Redis entry. Fields missing from
+        `entry` keep the values of the record previously in the slot
+
+        Returns
+        -------
+        seq : int
+            Sequence number of the record
+        """
+        seq = self.seq
+        slot = seq % self.n_slots
+        self.slot_seq[slot] = 0
+        record = self.records[slot]
+        raw = self.raw[slot]
+        for key, value in entry.items():
+            field = self.names.get(key)
+            if field is None:
+                continue
+            name, offset, size = field
+            if isinstance(value, str):
+                value = value.encode()
+            if name in self.bytes_fields:
+                n = len(value)
+                if n > size:
+                    raise ValueError(f'{n} bytes do not fit in field {name} '
+                                     f'of {size} bytes')
+                raw[offset:offset + n] = np.frombuffer(value, dtype=np.uint8)
+                record[f'{name}_len'] = n
+            elif isinstance(value, bytes):
+                # serialized as for Redis
+                raw[offset:offset + size] = np.frombuffer(value,
+                                                          dtype=np.uint8)
+            else:
+                record[name] = value
+        self.seq = seq + 1
+        self.slot_seq[slot] = seq + 1
+        self.write_seq[0] = seq + 1
+        self.futex[0] = (seq + 1) & 0xffffffff
+        if HAVE_FUTEX:
+            futex_wake(self.futex_address)
+        return seq
+
+    def close(self):
+        """Remove the ring file. Mapped readers keep their copy"""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class RingReader(_Ring):
+    # consumer side of a ring. Maps the ring file once the producer has
+    # created it, and maps it again if the producer restarts
+
+    def __init__(self, path, from_start=False, poll_interval=1e-4, spin_us=0):
+        _check_supported()
+        self.path = path
+        self.from_start = from_start
+        self.poll_interval = poll_interval
+        # time to spin on write_seq before sleeping on the futex
+        self.spin_ns = int(spin_us * 1000)
+        self.inode = None
+        self.next_seq = 0
+        self.dropped = 0
+
+    def attach(self):
+        """Map the ring file, returning False if it does not exist yet"""
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            self.inode = os.fstat(fd).st_ino
+            size = os.fstat(fd).st_size
+            self._map(fd, size)
+        finally:
+            os.close(fd)
+        if bytes(self.mm[0:4]) != MAGIC:
+            raise ValueError(f'{self.path} is not a ring buffer')
+        n_slots, _, _, descr_len = (int(v) for v in self.header[1:5])
+        fields = json.loads(
+            bytes(self.mm[DTYPE_OFFSET:DTYPE_OFFSET + descr_len]).decode())
+        self.dtype, self.bytes_fields = record_dtype(
+            [(name, dtype, tuple(shape) if isinstance(shape, list) else shape)
+             for name, dtype, shape in fields])
+        self._map_slots(self.dtype, n_slots)
+        self.keys = [(name, name.encode(), self.dtype[name].shape == ())
+                     for name, _, _ in fields]
+        self.next_seq = 0 if self.from_start else int(self.write_seq[0])
+        logging.info(f'Reading ring buffer {self.path} ({n_slots} slots)')
+        return True
+
+    def restarted(self):
+        """Whether the producer has replaced the ring file"""
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return False
+
+    def wait(self, timeout=None):
+        """
+        Wait until a record after `next_seq` is published, and return False
+        if none was published within `timeout` seconds
+        """
+        t_end = None if timeout is None else time.monotonic() + timeout
+        t_spin_end = time.monotonic_ns() + self.spin_ns
+        while True:
+            if self.inode is None:
+                if not self.attach():
+                    time.sleep(0.01)
+                    if t_end is not None and time.monotonic() > t_end:
+                        return False
+                    continue
+            expected = int(self.futex[0])
+            if int(self.write_seq[0]) > self.next_seq:
+                return True
+            if self.spin_ns and time.monotonic_ns() < t_spin_end:
+                continue
+            remaining = None if t_end is None else t_end - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            if HAVE_FUTEX:
+                # wake up every second to notice a restarted producer
+                futex_wait(self.futex_address, expected,
+                           1. if remaining is None else min(remaining, 1.))
+            else:
+                time.sleep(self.poll_interval)
+            if int(self.write_seq[0]) <= self.next_seq and self.restarted():
+                logging.warning(f'{self.path} was replaced, reattaching')
+                self.inode = None
+                self.from_start = True
+
+    def read(self, timeout=None):
+        """
+        Read the next record, waiting for it if it has not been published
+
+        Returns
+        -------
+        seq : int
+            Sequence number of the record, or None on timeout
+        entry : dict
+            The record's fields as in a Redis entry. Array fields are views
+            into the ring, valid until the producer laps it (see `valid`)
+        """
+        while True:
+            if not self.wait(timeout):
+                return None, None
+            write_seq = int(self.write_seq[0])
+            if write_seq - self.next_seq > self.n_slots:
+                # fell behind by more than the ring: skip to the oldest
+                # record that is not being overwritten
+                skip = write_seq - self.n_slots + 1 - self.next_seq
+                self.dropped += skip
+                self.next_seq += skip
+            seq = self.next_seq
+            slot = seq % self.n_slots
+            if int(self.slot_seq[slot]) != seq + 1:
+                # overwritten while we looked, try again
+                continue
+            self.next_seq = seq + 1
+            return seq, self.entry(self.records[slot])
+
+    def entry(self, record):
+        entry = {}
+        for name, key, scalar in self.keys:
+            if name in self.bytes_fields:
+                entry[key] = record[name][:record[f'{name}_len']].tobytes()
+            elif scalar:
+                entry[key] = record[name].tobytes()
+            else:
+                entry[key] = record[name]
+        return entry
+
+    def valid(self, seq):
+        """Whether record `seq` is still in the ring, not yet overwritten"""
+        return int(self.slot_seq[seq % self.n_slots]) == seq + 1
+
+
+def _stream_config(node, stream):
+    shm_streams = node.parameters.get('shm_streams') or {}
+    if isinstance(stream, bytes):
+        stream = stream.decode()
+    config = shm_streams.get(stream)
+    if config is not None and not RING_SUPPORTED:
+        # the producer and its consumers run on the same machine, so they
+        # all fall back to Redis
+        logging.warning(f'Shared-memory rings need x86-64, not '
+                        f'{platform.machine()}. Using Redis for {stream}')
+        config = None
+    return stream, config
+
+
+def node_ring_writer(node, stream, fields):
+    """
+    RingWriter for an output stream of a BRAND node, or None if the stream
+    is not listed in its `shm_streams` parameter
+    """
+    stream, config = _stream_config(node, stream)
+    if config is None:
+        return None
+    config = config or {}
+    path = ring_path(stream, config.get('name'))
+    logging.info(f'Writing {stream} to ring buffer {path}')
+    return RingWriter(path, fields, n_slots=config.get('n_slots', 1024))
+
+
+def node_ring_reader(node, stream):
+    """
+    RingReader for an input stream of a BRAND node, or None if the stream
+    is not listed in its `shm_streams` parameter
+    """
+    stream, config = _stream_config(node, stream)
+    if config is None:
+        return None
+    config = config or {}
+    return RingReader(ring_path(stream, config.get('name')))
+
+
+def redis_every(node, stream):
+    """
+    Every how many ring records an output stream is also written to Redis:
+    1 if it does not have a ring, 0 for never
+    """
+    stream, config = _stream_config(node, stream)
+    if config is None:
+        return 1
+    return (config or {}).get('redis_every', 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print the records published to a ring buffer')
+    parser.add_argument('stream')
+    parser.add_argument('--name', default=None, help='ring file name')
+    parser.add_argument('--from-start', action='store_true')
+    args = parser.parse_args()
+
+    reader = RingReader(ring_path(args.stream, args.name),
+                        from_start=args.from_start)
+    t_last = time.monotonic()
+    n = 0
+    while True:
+        seq, entry = reader.read(timeout=1.)
+        if seq is not None:
+            n += 1
+        t = time.monotonic()
+        if t - t_last >= 1.:
+            print(f'{n / (t - t_last):8.1f} records/s, last {seq}, '
+                  f'{reader.dropped} dropped')
+            t_last = t
+            n = 0
+
+
+if __name__ == '__main__':
+    main()
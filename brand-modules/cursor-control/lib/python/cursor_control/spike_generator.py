@@ -0,0 +1,113 @@
+"""
+spike_generator.py
+
+Vectorized synthetic threshold crossings for the `spike_generator` node.
+Each channel crosses threshold in a sample with probability
+rate / sample_rate (a Bernoulli approximation of a Poisson process, which
+is close for the 1-30 kHz sample rates and <100 Hz firing rates used here).
+Rates are either constant ('poisson') or cosine-tuned to a 2D velocity
+('cosine'), as in `cursor_control.synthesize`:
+
+    rate = max(baseline_rate + modulation_rate * (v . d), 0)
+
+where v is the velocity normalized by `max_speed` and d is each channel's
+preferred direction.
+
+Random numbers are drawn once, into a pool of uint16 uniforms of shape
+(pool_size, n_channels). A batch of samples is a random contiguous slice of
+the pool, XORed with a fresh random uint16 key per channel and compared
+against per-channel uint16 thresholds, all in preallocated buffers. So
+generating a batch draws n_channels + 1 random numbers and does two
+vectorized operations.
+
+A slice alone would repeat the exact same spike patterns whenever an
+offset comes up again, and would replay the rows that overlap the previous
+batch. XOR with a uniform key maps uniforms to uniforms, so each batch is
+still Bernoulli with the set rates, and with a threshold of t < 2**16 a
+sample crosses under two keys only if their top ~log2(2**16 / t) bits
+agree. Batches are therefore independent except for a small, rate-dependent
+chance (e.g. ~1/3000 per channel and pair of batches at 10 Hz and 30 kHz)
+that a channel reuses correlated crossings. Within a batch, samples and
+channels are independent.
+"""
+import numpy as np
+
+MODELS = ('poisson', 'cosine')
+
+
+class SpikeGenerator():
+    # batches of threshold crossings, from a precomputed random pool
+
+    def __init__(self,
+                 n_channels,
+                 sample_rate,
+                 model='poisson',
+                 baseline_rate=10.,
+                 modulation_rate=20.,
+                 max_speed=1.,
+                 pool_size=2048,
+                 max_batch=1024,
+                 seed=None):
+        if model not in MODELS:
+            raise ValueError(f'model must be one of {MODELS}, not {model!r}')
+        if pool_size < max_batch:
+            raise ValueError('pool_size must be at least max_batch')
+        self.n_channels = n_channels
+        self.sample_rate = sample_rate
+        self.model = model
+        self.baseline_rate = baseline_rate
+        self.modulation_rate = modulation_rate
+        self.max_speed = max_speed
+        self.max_batch = max_batch
+        self.rng = np.random.default_rng(seed)
+        self.pool = self.rng.integers(0,
+                                      1 << 16,
+                                      size=(pool_size, n_channels),
+                                      dtype=np.uint16)
+        self.pref_dir = self.rng.uniform(0, 2 * np.pi, n_channels)
+        self.cos_dir = np.cos(self.pref_dir)
+        self.sin_dir = np.sin(self.pref_dir)
+        self.thresholds = np.zeros(n_channels, dtype=np.uint16)
+        self.rates = np.zeros(n_channels)
+        self.keys = np.zeros(n_channels, dtype=np.uint16)
+        self.mixed = np.zeros((max_batch, n_channels), dtype=np.uint16)
+        self.out = np.zeros((max_batch, n_channels), dtype=np.bool_)
+        self.set_velocity(0., 0.)
+
+    def set_rates(self, rates):
+        """Set the firing rate (Hz) of each channel"""
+        self.rates[:] = rates
+        p = np.clip(self.rates / self.sample_rate, 0, 1)
+        self.thresholds[:] = np.minimum(np.round(p * (1 << 16)),
+                                        (1 << 16) - 1)
+
+    def set_velocity(self, vx, vy):
+        """Set the velocity that drives cosine-tuned rates"""
+        if self.model == 'poisson':
+            self.set_rates(self.baseline_rate)
+            return
+        drive = (vx * self.cos_dir + vy * self.sin_dir) / self.max_speed
+        self.set_rates(
+            np.maximum(self.baseline_rate + self.modulation_rate * drive, 0))
+
+    def generate(self, n):
+        """
+        Threshold crossings of the next `n` samples
+
+        Returns
+        -------
+        spikes : int8 array of shape (n, n_channels)
+            View of the output buffer, overwritten by the next call
+        """
+        if n > self.max_batch:
+            raise ValueError(f'n must be at most max_batch={self.max_batch}')
+        start = self.rng.integers(0, self.pool.shape[0] - n + 1)
+        self.keys[:] = self.rng.integers(0,
+                                         1 << 16,
+                                         size=self.keys.shape[0],
+                                         dtype=np.uint16)
+        np.bitwise_xor(self.pool[start:start + n],
+                       self.keys,
+                       out=self.mixed[:n])
+        np.less(self.mixed[:n], self.thresholds, out=self.out[:n])
+        return self.out[:n].view(np.int8)
@@ -0,0 +1,452 @@
+"""
+synthesize.py
+
+Generate an open-loop calibration session offline. The radialFSM and
+auto_cue parameters of a graph YAML define the target sequence, the trial
+timing and the velocity profile, and the whole session is computed in one
+pass at the auto_cue input rate (one iteration per bin) instead of running
+the graph in real time.
+
+The output is written in the same format the calibration notebook reads:
+a pickled dict mapping each stream name to its list of `(entry_id,
+entry_dict)` tuples, as returned by `xrange`.
+
+Usage:
+    python -m cursor_control.synthesize graphs/sim_graph_ol.yaml \
+        --duration 600 --output data/synth_sim_graph_ol.pkl
+"""
+import argparse
+import json
+import logging
+import os
+import pickle
+import time
+from datetime import datetime
+from struct import pack
+
+import numpy as np
+import yaml
+
+from .velocity_profiles import make_profile
+
+# target visual states (see radialFSM.Target)
+TARGET_OFF = 0
+TARGET_SHOW = 1
+TARGET_ON = 2
+TARGET_OVER = 3
+
+
+def node_parameters(graph, name):
+    """Get the parameters of the first node in `graph` named `name`"""
+    for node in graph['nodes']:
+        if node['name'] == name:
+            return node['parameters']
+    raise ValueError(f'Node {name} not found in graph')
+
+
+def target_positions(fsm_params):
+    """
+    Compute the target layout the same way radialFSM does
+
+    Returns
+    -------
+    positions : dict
+        Maps target IDs ('0' is the center) to (x, y) positions
+    """
+    dist = fsm_params['distance_from_center']
+    positions = {'0': (0., 0.)}
+    for i, angle in enumerate(fsm_params['target_angles']):
+        positions[f'{i + 1}'] = (
+            np.round(dist * np.cos(np.radians(angle)), 4),
+            np.round(dist * np.sin(np.radians(angle)), 4),
+        )
+    return positions
+
+
+def random_target_sequence(n_outer, n_targets, rng):
+    """
+    Draw outer targets without replacement in blocks, matching
+    `radialFSM.Target.pick_target`
+    """
+    n_blocks = int(np.ceil(n_targets / n_outer))
+    seq = np.concatenate(
+        [rng.permutation(n_outer) + 1 for _ in range(n_blocks)])
+    return [str(t) for t in seq[:n_targets]]
+
+
+def _n_ticks(seconds, rate):
+    # radialFSM waits until strictly more than `seconds` have passed
+    return int(np.floor(seconds * rate)) + 1
+
+
+def _draw_delay(delay, rng):
+    return rng.uniform(delay['min'], delay['max'])
+
+
+def synthesize_session(graph,
+                       duration=600,
+                       targets=None,
+                       seed=0,
+                       n_neurons=None,
+                       baseline_rate=10.,
+                       modulation_rate=20.):
+    """
+    Generate the cursor, target and control trajectories of an open-loop
+    session
+
+    Parameters
+    ----------
+    graph : dict
+        Graph configuration containing radialFSM and auto_cue nodes
+    duration : float, optional
+        Session duration in seconds, by default 600
+    targets : list of str, optional
+        Sequence of outer target IDs to visit. By default, targets are drawn
+        at random the same way radialFSM draws them.
+    seed : int, optional
+        Random seed, by default 0
+    n_neurons : int, optional
+        Number of channels of simulated binned spikes. Defaults to the graph's
+        `total_channels` parameter. Set to 0 to skip neural data.
+    baseline_rate : float, optional
+        Baseline firing rate in Hz, by default 10
+    modulation_rate : float, optional
+        Firing rate modulation at peak speed in Hz, by default 20
+
+    Returns
+    -------
+    session : dict
+        Per-bin arrays (`cursor`, `target`, `target_state`, `control`,
+        `binned_spikes`) and a `trials` list of per-trial events
+    """
+    rng = np.random.default_rng(seed)
+    fsm = node_parameters(graph, 'radialFSM')
+    ac = node_parameters(graph, 'auto_cue')
+
+    rate = ac['input_rate']
+    speed = ac['speed'] / rate  # units/iteration
+    profile_kwargs = {}
+    if 'min_speed' in ac and ac['vel_profile'] != 'constant':
+        profile_kwargs['min_speed'] = ac['min_speed']
+    if ac['vel_profile'] == 'PD':
+        profile_kwargs.update(kp=ac['pd_kp'],
+                              kd=ac['pd_kd'],
+                              tol=ac['error_thres'])
+    profile = make_profile(ac['vel_profile'], speed, **profile_kwargs)
+
+    positions = target_positions(fsm)
+    n_outer = len(positions) - 1
+    n_total = int(duration * rate)
+    if targets is None:
+        # more than enough trials to fill the session
+        targets = random_target_sequence(n_outer, n_total, rng)
+    targets = iter(targets)
+
+    target_radius = fsm['target_diameter'] / 2
+    acquire_dist = target_radius + fsm['cursor_radius']
+    timeout = fsm.get('trial_timeout', 10)
+
+    # per-bin outputs are filled segment by segment
+    cursor = np.zeros((n_total, 2), dtype=np.float32)
+    target = np.zeros((n_total, 2), dtype=np.float32)
+    target_state = np.zeros(n_total, dtype=np.int32)
+    trials = []
+
+    k = 0  # current bin
+    pos = np.zeros(2)
+    tgt_id = '0'
+    wait = fsm['initial_wait_time']
+    while k < n_total:
+        # between trials: target off, cursor holds still
+        n = _n_ticks(wait, rate)
+        cursor[k:k + n] = pos
+        target[k:k + n] = positions[tgt_id]
+        k += n
+        if k >= n_total:
+            break
+
+        # start of trial: pick the next target and roll the trial timing
+        from_start = tgt_id == '0'
+        suffix = 'in' if from_start else 'out'
+        delay = _draw_delay(fsm[f'delay_time_{suffix}'], rng)
+        hold = _draw_delay(fsm[f'target_hold_time_{suffix}'], rng)
+        start_id = tgt_id
+        if from_start:
+            try:
+                tgt_id = next(targets)
+            except StopIteration:
+                break
+        else:
+            tgt_id = '0'
+        trial = {
+            'start': k,
+            'start_id': start_id,
+            'target_id': tgt_id,
+            'dwell_time': hold,
+        }
+        wait = _draw_delay(
+            fsm['inter_trial_time_in' if tgt_id ==
+                '0' else 'inter_trial_time_out'], rng)
+
+        # delay period: target shown, cursor holds still
+        n = _n_ticks(delay, rate)
+        cursor[k:k + n] = pos
+        target[k:k + n] = positions[tgt_id]
+        target_state[k:k + n] = TARGET_SHOW
+        k += n
+        trial['go'] = k
+        if k >= n_total:
+            # the session ends before the go cue
+            trials.append(trial)
+            break
+
+        # movement: the cursor follows the velocity profile, capped at the
+        # remaining distance to the target
+        goal = np.array(positions[tgt_id])
+        move = goal - pos
+        dist = np.linalg.norm(move)
+        n_timeout = _n_ticks(timeout, rate)
+        lut = profile.build(dist)
+        speeds = np.full(n_timeout, profile.tail_speed)
+        speeds[:min(lut.shape[0], n_timeout)] = lut[:n_timeout]
+        travelled = np.minimum(np.cumsum(speeds), dist)
+        remaining = dist - travelled
+        path = pos + (travelled[:, None] / dist *
+                      move[None, :] if dist > 0 else np.zeros((n_timeout, 2)))
+        over = np.flatnonzero(remaining < acquire_dist)
+        if over.size and over[0] + _n_ticks(hold, rate) < n_timeout:
+            n = over[0] + _n_ticks(hold, rate)
+            trial['success'] = True
+        else:
+            n = n_timeout
+            trial['success'] = False
+        n = min(n, n_total - k)
+        cursor[k:k + n] = path[:n]
+        target[k:k + n] = goal
+        target_state[k:k + n] = np.where(remaining[:n] < acquire_dist,
+                                         TARGET_OVER, TARGET_ON)
+        pos = path[n - 1].copy()
+        k += n
+        trial['end'] = k
+
+        if not trial['success']:
+            wait = _draw_delay(fsm['inter_trial_time_failure'], rng)
+            if fsm['recenter_on_fail']:
+                tgt_id = '0'
+                pos = np.zeros(2)
+            else:
+                tgt_id = start_id
+        elif fsm['recenter']:
+            tgt_id = '0'
+            pos = np.zeros(2)
+            wait = _draw_delay(fsm['inter_trial_time_in'], rng)
+        trials.append(trial)
+
+    # auto_cue outputs the velocity that takes the cursor to its next position
+    control = np.zeros((n_total, 2), dtype=np.float32)
+    control[:-1] = np.diff(cursor, axis=0)
+    # zero out jumps from recentering between trials
+    moving = (target_state[:-1] >= TARGET_ON) & (target_state[1:] >= TARGET_ON)
+    control[:-1][~moving] = 0
+
+    session = {
+        'rate': rate,
+        'cursor': cursor,
+        'target': target,
+        'target_state': target_state,
+        'control': control,
+        'trials': trials,
+        'positions': positions,
+        'target_radius': target_radius,
+        'cursor_radius': fsm['cursor_radius'],
+    }
+
+    # cosine-tuned Poisson spike counts driven by cursor velocity
+    if n_neurons is None:
+        n_neurons = graph['parameters'].get('total_channels', 0)
+    if n_neurons:
+        pref_dir = rng.uniform(0, 2 * np.pi, n_neurons)
+        vel = control / max(speed, 1e-12)
+        drive = (vel[:, :1] * np.cos(pref_dir)[None, :] +
+                 vel[:, 1:] * np.sin(pref_dir)[None, :])
+        fr = np.maximum(baseline_rate + modulation_rate * drive, 0)
+        counts = rng.poisson(fr / rate)
+        session['binned_spikes'] = np.clip(counts, 0,
+                                           np.iinfo(np.int8).max).astype(
+                                               np.int8)
+
+    return session
+
+
+def _entry_ids(n, t0_ms, rate, offset=0):
+    ms = t0_ms + (np.arange(n) * 1000 // rate).astype(np.int64)
+    return [f'{m}-{offset}'.encode() for m in ms]
+
+
+def to_stream_entries(session, graph, sync_key=b'sync', time_key=b'ts'):
+    """
+    Convert a synthesized session into the `xrange` format that the
+    notebooks save
+
+    Returns
+    -------
+    streams : dict
+        Maps stream names (bytes) to lists of (entry_id, entry_dict) tuples
+    """
+    n = session['cursor'].shape[0]
+    rate = session['rate']
+    t0_ms = int(time.time() * 1000)
+    t0_ns = time.monotonic_ns()
+    ids = _entry_ids(n, t0_ms, rate)
+    ts = (t0_ns + np.arange(n, dtype=np.uint64) *
+          np.uint64(1e9 // rate)).astype(np.uint64)
+    sync = [json.dumps({'count': int(i)}).encode() for i in range(n)]
+    i_u32 = np.arange(n, dtype=np.uint32)
+
+    cursor = session['cursor'].astype(np.float32)
+    target = session['target'].astype(np.float32)
+    state = session['target_state'].astype(np.int32)
+    control = session['control'].astype(np.float32)
+    cursor_radius = pack('f', session['cursor_radius'])
+    target_radius = pack('f', session['target_radius'])
+    cursor_state = pack('i', 1)
+
+    streams = {}
+    streams[b'cursorData'] = [(ids[k], {
+        b'X': cursor[k, 0].tobytes(),
+        b'Y': cursor[k, 1].tobytes(),
+        b'radius': cursor_radius,
+        b'state': cursor_state,
+        b'i': i_u32[k].tobytes(),
+        sync_key: sync[k],
+        time_key: ts[k].tobytes()
+    }) for k in range(n)]
+    streams[b'targetData'] = [(ids[k], {
+        b'X': target[k, 0].tobytes(),
+        b'Y': target[k, 1].tobytes(),
+        b'radius': target_radius,
+        b'state': state[k].tobytes(),
+        b'i': i_u32[k].tobytes(),
+        sync_key: sync[k],
+        time_key: ts[k].tobytes()
+    }) for k in range(n)]
+    streams[b'control'] = [(ids[k], {
+        b'samples': control[k].tobytes(),
+        sync_key: sync[k],
+        time_key: ts[k].tobytes(),
+        b'i': np.uint64(k).tobytes()
+    }) for k in range(n)]
+    # the mouse is not part of a synthesized session, but the notebook
+    # expects the stream, so store the commanded velocity (units/s) in its
+    # place
+    mouse = np.zeros((n, 3), dtype=np.int16)
+    mouse[:, :2] = np.round(control * rate)
+    streams[b'mouse_vel'] = [(ids[k], {
+        b'samples': mouse[k].tobytes(),
+        b'index': np.int32(k).tobytes()
+    }) for k in range(n)]
+    if 'binned_spikes' in session:
+        spikes = session['binned_spikes']
+        streams[b'binned_spikes'] = [(ids[k], {
+            time_key: ts[k].tobytes(),
+            sync_key: sync[k],
+            b'samples': spikes[k].tobytes(),
+            b'i': np.uint64(k).tobytes()
+        }) for k in range(n)]
+
+    # trial events
+    positions = session['positions']
+    streams[b'state'] = []
+    streams[b'trial_info'] = []
+    streams[b'trial_success'] = []
+    for trial in session['trials']:
+        for key, name in [('start', 'start_time'), ('go', 'go_cue_time'),
+                          ('end', 'end_time')]:
+            if key not in trial or trial[key] >= n:
+                continue
+            k = trial[key]
+            entry = {
+                time_key: ts[k].tobytes(),
+                sync_key: sync[k],
+                b'state': name.encode(),
+                b'i': i_u32[k].tobytes()
+            }
+            streams[b'state'].append((ids[k], entry))
+        k = trial['start']
+        tx, ty = positions[trial['target_id']]
+        sx, sy = positions[trial['start_id']]
+        streams[b'trial_info'].append((ids[k], {
+            time_key: ts[k].tobytes(),
+            sync_key: sync[k],
+            b'target_X': pack('f', tx),
+            b'target_Y': pack('f', ty),
+            b'reach_angle': np.float32(0).tobytes(),
+            b'start_X': pack('f', sx),
+            b'start_Y': pack('f', sy),
+            b'cond_id': f"{trial['start_id']}-{trial['target_id']}".encode(),
+            b'target_radius': target_radius,
+            b'cursor_radius': cursor_radius,
+            b'dwell_time': pack('f', trial['dwell_time']),
+            b'i': i_u32[k].tobytes()
+        }))
+        if 'end' in trial and trial['end'] < n:
+            k = trial['end']
+            streams[b'trial_success'].append((ids[k], {
+                time_key: ts[k].tobytes(),
+                sync_key: sync[k],
+                b'success': np.uint8(trial['success']).tobytes(),
+                b'i': i_u32[k].tobytes()
+            }))
+
+    # the notebook loads the graph parameters from the booter stream
+    streams[b'booter'] = [(ids[0], {b'graph': json.dumps(graph).encode()})]
+    return streams
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Synthesize an open-loop calibration session')
+    parser.add_argument('graph', help='path to the graph YAML')
+    parser.add_argument('-d',
+                        '--duration',
+                        type=float,
+                        default=600,
+                        help='session duration in seconds')
+    parser.add_argument('-t',
+                        '--targets',
+                        nargs='+',
+                        default=None,
+                        help='sequence of outer target IDs to reach')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-n',
+                        '--n-neurons',
+                        type=int,
+                        default=None,
+                        help='number of simulated channels (0 to skip)')
+    parser.add_argument('-o', '--output', default=None, help='output path')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.graph, 'r') as f:
+        graph = yaml.safe_load(f)
+
+    session = synthesize_session(graph,
+                                 duration=args.duration,
+                                 targets=args.targets,
+                                 seed=args.seed,
+                                 n_neurons=args.n_neurons)
+    streams = to_stream_entries(session, graph)
+
+    if args.output is None:
+        date_str = datetime.now().strftime(r'%y%m%dT%H%M')
+        graph_name = os.path.splitext(os.path.basename(args.graph))[0]
+        args.output = os.path.join('data', f'{date_str}_{graph_name}.pkl')
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'wb') as f:
+        pickle.dump(streams, f)
+    logging.info(f"Synthesized {len(session['trials'])} trials "
+                 f"({session['cursor'].shape[0]} bins) to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+trace.py
+
+Per-hop latency tracing. When a node runs with `trace: True`, it copies the
+`trace` field of the entry it read into the entry it writes and appends one
+fixed-size binary record with its node ID, the time the input was read
+(`t_in`) and the time the output was written (`t_out`), both from
+time.monotonic_ns(). An entry that reaches the display has one record per
+hop:
+
+    threshold_values -> bin_multiple -> wiener_filter -> radialFSM
+        -> display_centerOut
+
+The first record stands for the source stream (its `ts`, with
+t_in == t_out), since the nodes that write `threshold_values` do not trace.
+display_centerOut adds its record (t_in when the cursor entry was received,
+t_out at the end of the flip that first showed it) to `display_sync_pulse`.
+
+For each hop, the analyzer reports the time from the previous hop's output
+to this hop's output, split into `wait` (previous t_out to t_in: Redis
+transport and time spent blocked behind other work) and `compute` (t_in to
+t_out), plus the end-to-end latency from the source to the last hop.
+Latencies are only meaningful for nodes that run on the same machine.
+
+Usage:
+    python -m cursor_control.trace -i 127.0.0.1 -p 6379 --count 10000
+    python -m cursor_control.trace data/230101T1200_sim_graph_cl.pkl
+"""
+import argparse
+import json
+import pickle
+import struct
+
+import numpy as np
+
+TRACE_KEY = b'trace'
+# one record per hop, little-endian and unpadded
+HOP = struct.Struct('<HQQ')
+HOP_DTYPE = np.dtype([('node', '<u2'), ('t_in', '<u8'), ('t_out', '<u8')])
+# node IDs written in the trace records
+NODES = ('source', 'bin_multiple', 'wiener_filter', 'auto_cue', 'radialFSM',
+         'display_centerOut')
+NODE_IDS = {name: i for i, name in enumerate(NODES)}
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def stamp(trace, node_id, t_in, t_out):
+    """Append a hop record to a trace (bytes)"""
+    return trace + HOP.pack(node_id, t_in, t_out)
+
+
+def source_trace(entry, time_key=b'ts'):
+    """
+    Trace to continue from an input entry: its own trace if it has one,
+    otherwise a source record from its timestamp, or an empty trace
+    """
+    if TRACE_KEY in entry:
+        return entry[TRACE_KEY]
+    if time_key in entry:
+        t = int(np.frombuffer(entry[time_key], dtype=np.uint64)[0])
+        return HOP.pack(NODE_IDS['source'], t, t)
+    return b''
+
+
+def node_name(node_id):
+    return NODES[node_id] if node_id < len(NODES) else f'node{node_id}'
+
+
+def decode_traces(entries, key=TRACE_KEY):
+    """
+    Decode the traces of a list of (entry_id, entry_dict) tuples
+
+    Entries are grouped by the sequence of nodes in their trace, since
+    streams can mix traces with different paths (e.g. when a node was
+    restarted with tracing disabled).
+
+    Returns
+    -------
+    paths : dict
+        Maps tuples of node names to structured arrays of shape
+        (n_entries, n_hops) with HOP_DTYPE, in entry order
+    """
+    traces = [e[key] for _, e in entries if key in e]
+    by_len = {}
+    for trace in traces:
+        by_len.setdefault(len(trace), []).append(trace)
+    paths = {}
+    for length, group in by_len.items():
+        if length == 0 or length % HOP.size:
+            continue
+        records = np.frombuffer(b''.join(group), dtype=HOP_DTYPE).reshape(
+            len(group), length // HOP.size)
+        # split by node sequence
+        nodes, inverse = np.unique(records['node'],
+                                   axis=0,
+                                   return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for i, path in enumerate(nodes):
+            paths[tuple(node_name(n) for n in path)] = records[inverse == i]
+    return paths
+
+
+def latency_stats(x):
+    """
+    Summary of latencies in ms: count, mean, std, percentiles, max and
+    jitter (mean absolute difference between consecutive latencies)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if x.size == 0:
+        return {'n': 0}
+    stats = {'n': int(x.size), 'mean': float(x.mean()), 'std': float(x.std())}
+    for p, v in zip(PERCENTILES, np.percentile(x, PERCENTILES)):
+        stats[f'p{p:g}'] = float(v)
+    stats['max'] = float(x.max())
+    stats['jitter'] = float(np.abs(np.diff(x)).mean()) if x.size > 1 else 0.
+    return stats
+
+
+def hop_latencies(records, path):
+    """
+    Per-hop and end-to-end latencies of the traces that follow one path
+
+    Parameters
+    ----------
+    records : structured array of shape (n_entries, n_hops)
+        From `decode_traces`
+    path : tuple of str
+        Node names of each hop
+
+    Returns
+    -------
+    latencies : dict
+        Maps '<node> wait', '<node> compute', '<node> total' and
+        'end-to-end' to arrays of latencies in ms
+    """
+    t_in = records['t_in'].astype(np.int64)
+    t_out = records['t_out'].astype(np.int64)
+    latencies = {}
+    for k in range(1, len(path)):
+        latencies[f'{path[k]} wait'] = (t_in[:, k] - t_out[:, k - 1]) / 1e6
+        latencies[f'{path[k]} compute'] = (t_out[:, k] - t_in[:, k]) / 1e6
+        latencies[f'{path[k]} total'] = (t_out[:, k] - t_out[:, k - 1]) / 1e6
+    latencies['end-to-end'] = (t_out[:, -1] - t_out[:, 0]) / 1e6
+    return latencies
+
+
+def analyze(entries, key=TRACE_KEY):
+    """
+    Latency statistics for each trace path in a list of entries
+
+    Returns
+    -------
+    report : dict
+        Maps ' -> '.join(path) to {'n': count, 'latency_ms': {name: stats}}
+    """
+    report = {}
+    for path, records in decode_traces(entries, key).items():
+        report[' -> '.join(path)] = {
+            'n': int(records.shape[0]),
+            'latency_ms': {
+                name: latency_stats(x)
+                for name, x in hop_latencies(records, path).items()
+            },
+        }
+    return report
+
+
+def print_report(report):
+    columns = ['mean', 'std', 'jitter'] + [f'p{p:g}' for p in PERCENTILES
+                                           ] + ['max']
+    for path, result in report.items():
+        print(f"\n{path} ({result['n']} entries), ms")
+        print(f"{'':28}" + ''.join(f'{c:>9}' for c in columns))
+        for name, stats in result['latency_ms'].items():
+            print(f'{name:28}' +
+                  ''.join(f'{stats.get(c, np.nan):9.3f}' for c in columns))
+
+
+def _load_entries(args, stream):
+    if args.session is None:
+        import redis
+        r = redis.Redis(host=args.host, port=args.port)
+        return r.xrevrange(stream, '+', '-', count=args.count)[::-1]
+    if args.session.endswith('.pkl'):
+        with open(args.session, 'rb') as f:
+            return pickle.load(f).get(stream.encode(), [])
+    from .recorder import read_entries
+    return read_entries(args.session, stream)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Per-hop latency of traced entries')
+    parser.add_argument(
+        'session',
+        nargs='?',
+        default=None,
+        help='pickled session or directory written by cursor_control.recorder'
+        ', or read the latest entries from Redis if not given')
+    parser.add_argument('-i', '--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=6379)
+    parser.add_argument('-s',
+                        '--streams',
+                        nargs='+',
+                        default=['display_sync_pulse', 'cursorData'],
+                        help='streams to analyze')
+    parser.add_argument('--count',
+                        type=int,
+                        default=10000,
+                        help='number of entries to read from Redis')
+    parser.add_argument('--json', action='store_true', help='print JSON')
+    args = parser.parse_args()
+
+    report = {
+        stream: analyze(_load_entries(args, stream))
+        for stream in args.streams
+    }
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return
+    for stream, stream_report in report.items():
+        print(f'=== {stream} ===')
+        if not stream_report:
+            print('no traced entries')
+        print_report(stream_report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+"""
+train.py
+
+Out-of-core training of the lagged linear decoder used by wiener_filter.
+
+The decoder input at bin t is [x_t, x_t-1, ..., x_t-seq_len+1] (the same
+ordering as `get_lagged_features` in the calibration notebook), which makes
+the lagged feature matrix seq_len times larger than the binned data. Here
+it is never built: lagged rows are produced a chunk at a time from sliding
+window views, and only XᵀX, Xᵀy and the other sufficient statistics of each
+cross-validation fold are kept. Every alpha is then solved from a single
+eigendecomposition of XᵀX per fold, and validation R² is computed from the
+held-out fold's statistics, without a second pass over the data.
+
+Cross-validation uses contiguous folds like `RidgeCV(cv=k)`, and scores are
+the R² averaged over targets and folds.
+
+Usage:
+    python -m cursor_control.train data/230101T1200_sim_graph_ol \\
+        --seq-len 15 -o models/230101T1200_wf_seq_len_15.pkl
+"""
+import argparse
+import logging
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .align import align_streams
+from .session import load_session
+
+
+def lagged_chunks(X, seq_len, start=0, stop=None, chunk_size=10000):
+    """
+    Yield lagged feature rows of X a chunk at a time
+
+    Rows before the first row of X are treated as zeros. Lags of the first
+    rows of [start, stop) reach back into the rows before `start`.
+
+    Parameters
+    ----------
+    X : array-like of shape (n_samples, n_features)
+        Binned data. Memory-mapped arrays are read one chunk at a time.
+    seq_len : int
+        Number of bins in each lagged row
+    start, stop : int, optional
+        Rows to produce, by default all rows
+    chunk_size : int, optional
+        Rows per chunk
+
+    Yields
+    ------
+    start, stop : int
+        Rows covered by the chunk
+    lagged : array of shape (stop - start, seq_len * n_features)
+        Lagged rows, block i holding lag i
+    """
+    n, n_features = X.shape
+    stop = n if stop is None else stop
+    for c_start in range(start, stop, chunk_size):
+        c_stop = min(c_start + chunk_size, stop)
+        lo = c_start - (seq_len - 1)
+        block = np.asarray(X[max(lo, 0):c_stop], dtype=np.float64)
+        if lo < 0:
+            block = np.vstack([np.zeros((-lo, n_features)), block])
+        # windows[t, f, k] is feature f of bin t - seq_len + 1 + k
+        windows = sliding_window_view(block, seq_len, axis=0)
+        lagged = windows[:, :, ::-1].transpose(0, 2, 1).reshape(
+            c_stop - c_start, seq_len * n_features)
+        yield c_start, c_stop, lagged
+
+
+def _empty_moments(n_features, n_targets):
+    return {
+        'n': 0,
+        'sx': np.zeros(n_features),
+        'sy': np.zeros(n_targets),
+        'sxx': np.zeros((n_features, n_features)),
+        'sxy': np.zeros((n_features, n_targets)),
+        'syy': np.zeros(n_targets),
+    }
+
+
+def _add_moments(m, X, y):
+    m['n'] += X.shape[0]
+    m['sx'] += X.sum(axis=0)
+    m['sy'] += y.sum(axis=0)
+    m['sxx'] += X.T @ X
+    m['sxy'] += X.T @ y
+    m['syy'] += (y * y).sum(axis=0)
+
+
+def _sum_moments(moments):
+    total = {key: 0 for key in moments[0]}
+    for m in moments:
+        for key in m:
+            total[key] = total[key] + m[key]
+    return total
+
+
+def accumulate_moments(X, y, seq_len, bounds, chunk_size=10000):
+    """
+    Sufficient statistics of the lagged features of X and targets y over
+    consecutive row ranges
+
+    Parameters
+    ----------
+    bounds : list of int
+        Row boundaries: statistics are computed separately for
+        [bounds[0], bounds[1]), [bounds[1], bounds[2]), ...
+
+    Returns
+    -------
+    moments : list of dict
+        Number of rows, sums, cross products and target sums of squares of
+        each range
+    """
+    n_lagged = seq_len * X.shape[1]
+    moments = [
+        _empty_moments(n_lagged, y.shape[1]) for _ in range(len(bounds) - 1)
+    ]
+    for start, stop, lagged in lagged_chunks(X,
+                                             seq_len,
+                                             start=bounds[0],
+                                             stop=bounds[-1],
+                                             chunk_size=chunk_size):
+        y_chunk = np.asarray(y[start:stop], dtype=np.float64)
+        # split the chunk where it crosses range boundaries
+        for i in range(len(bounds) - 1):
+            lo, hi = max(start, bounds[i]), min(stop, bounds[i + 1])
+            if lo < hi:
+                _add_moments(moments[i], lagged[lo - start:hi - start],
+                             y_chunk[lo - start:hi - start])
+    return moments
+
+
+def solve_ridge(m, alphas):
+    """
+    Ridge solutions with an intercept for every alpha, from one
+    eigendecomposition of the centered XᵀX
+
+    Returns
+    -------
+    coefs : array of shape (n_alphas, n_targets, n_features)
+    intercepts : array of shape (n_alphas, n_targets)
+    """
+    n = m['n']
+    mean_x, mean_y = m['sx'] / n, m['sy'] / n
+    cxx = m['sxx'] - n * np.outer(mean_x, mean_x)
+    cxy = m['sxy'] - n * np.outer(mean_x, mean_y)
+    eigvals, eigvecs = np.linalg.eigh(cxx)
+    proj = eigvecs.T @ cxy
+    coefs = np.empty((len(alphas), cxy.shape[1], cxy.shape[0]))
+    intercepts = np.empty((len(alphas), cxy.shape[1]))
+    for i, alpha in enumerate(alphas):
+        w = eigvecs @ (proj / (eigvals + alpha)[:, None])
+        coefs[i] = w.T
+        intercepts[i] = mean_y - mean_x @ w
+    return coefs, intercepts
+
+
+def r2_from_moments(m, coefs, intercepts):
+    """
+    R² (averaged over targets) of each solution on the rows summarized by
+    `m`
+
+    Returns
+    -------
+    scores : array of shape (n_alphas, )
+    """
+    n = m['n']
+    scores = np.empty(coefs.shape[0])
+    for i, (w, b) in enumerate(zip(coefs, intercepts)):
+        # sum of (y - Xw - b)² expanded in terms of the moments
+        sse = (m['syy'] - 2 * np.einsum('tf,ft->t', w, m['sxy']) -
+               2 * b * m['sy'] + np.einsum('tf,fg,tg->t', w, m['sxx'], w) +
+               2 * b * (w @ m['sx']) + n * b**2)
+        sst = m['syy'] - m['sy']**2 / n
+        scores[i] = np.mean(1 - sse / sst)
+    return scores
+
+
+def fit_lagged_ridge(X,
+                     y,
+                     seq_len,
+                     alphas=np.logspace(2, 5, 4),
+                     cv=3,
+                     chunk_size=10000,
+                     n_jobs=None):
+    """
+    Fit a ridge regression from lagged X to y, choosing alpha by
+    cross-validation
+
+    Parameters
+    ----------
+    X : array-like of shape (n_samples, n_features)
+        Binned neural data (not lagged)
+    y : array-like of shape (n_samples, n_targets)
+        Targets, e.g. cursor velocity
+    seq_len : int
+        Number of bins of neural data per prediction
+    alphas : array-like, optional
+        L2 penalties to try
+    cv : int, optional
+        Number of contiguous cross-validation folds
+    chunk_size : int, optional
+        Rows of lagged features built at a time
+    n_jobs : int, optional
+        Number of folds solved in parallel, by default all of them
+
+    Returns
+    -------
+    fit : dict
+        `alpha`, `coef` (n_targets, seq_len * n_features), `intercept`
+        (n_targets, ) and the cross-validation `scores` of every alpha
+    """
+    alphas = np.asarray(alphas, dtype=np.float64)
+    n = X.shape[0]
+    # fold sizes follow sklearn's KFold
+    sizes = np.full(cv, n // cv)
+    sizes[:n % cv] += 1
+    bounds = np.concatenate([[0], np.cumsum(sizes)]).tolist()
+    folds = accumulate_moments(X, y, seq_len, bounds, chunk_size=chunk_size)
+    total = _sum_moments(folds)
+
+    def score_fold(i):
+        train = {key: total[key] - folds[i][key] for key in total}
+        coefs, intercepts = solve_ridge(train, alphas)
+        return r2_from_moments(folds[i], coefs, intercepts)
+
+    with ThreadPoolExecutor(max_workers=n_jobs or cv) as pool:
+        scores = np.array(list(pool.map(score_fold, range(cv))))
+    mean_scores = scores.mean(axis=0)
+    best = int(np.argmax(mean_scores))
+    logging.info('CV R2 by alpha: ' + ', '.join(
+        f'{a:g}: {s:.4f}' for a, s in zip(alphas, mean_scores)))
+
+    coefs, intercepts = solve_ridge(total, alphas[best:best + 1])
+    return {
+        'alpha': alphas[best],
+        'coef': coefs[0],
+        'intercept': intercepts[0],
+        'alphas': alphas,
+        'scores': mean_scores,
+    }
+
+
+def to_sklearn(fit):
+    """
+    Wrap a fit in a `sklearn.linear_model.Ridge`, the model type the
+    wiener_filter node loads
+    """
+    from sklearn.linear_model import Ridge
+    mdl = Ridge(alpha=fit['alpha'])
+    mdl.coef_ = fit['coef']
+    mdl.intercept_ = fit['intercept']
+    mdl.n_features_in_ = fit['coef'].shape[1]
+    return mdl
+
+
+def predict_lagged(mdl, X, seq_len, start=0, stop=None, chunk_size=10000):
+    """Predict from binned X with a model fit on its lagged features"""
+    stop = X.shape[0] if stop is None else stop
+    y = np.empty((stop - start, np.atleast_2d(mdl.coef_).shape[0]))
+    for c_start, c_stop, lagged in lagged_chunks(X,
+                                                 seq_len,
+                                                 start=start,
+                                                 stop=stop,
+                                                 chunk_size=chunk_size):
+        y[c_start - start:c_stop - start] = (lagged @ mdl.coef_.T +
+                                             mdl.intercept_)
+    return y
+
+
+class _IndexedRows():
+    # rows of an array selected by an index array, read lazily by slice
+
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+        self.shape = (index.shape[0], ) + array.shape[1:]
+
+    def __getitem__(self, rows):
+        return self.array[self.index[rows]]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Train a wiener_filter model from a memory-mapped session')
+    parser.add_argument('session_dir')
+    parser.add_argument('-o', '--output', required=True, help='model .pkl')
+    parser.add_argument('--neural-stream', default='binned_spikes')
+    parser.add_argument('--neural-field', default='samples')
+    parser.add_argument('--kin-stream', default='control')
+    parser.add_argument('--kin-field', default='samples')
+    parser.add_argument('--n-targets', type=int, default=2)
+    parser.add_argument('--gain', type=float, default=3.)
+    parser.add_argument('--seq-len', type=int, default=15)
+    parser.add_argument('--alphas',
+                        type=float,
+                        nargs='+',
+                        default=np.logspace(2, 5, 4).tolist())
+    parser.add_argument('--cv', type=int, default=3)
+    parser.add_argument('--test-size', type=float, default=0.25)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--n-jobs', type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    session = load_session(args.session_dir)
+    neural = session[args.neural_stream]
+    kin = session[args.kin_stream]
+    # pair each kinematics entry with the neural entry that has its sync
+    kin_rows, rows = align_streams(np.asarray(kin['sync']),
+                                   {'neural': np.asarray(neural['sync'])})
+    neural_rows = rows['neural']
+    X = _IndexedRows(neural[args.neural_field], neural_rows)
+    y = kin[args.kin_field][kin_rows]
+    y = np.asarray(y, dtype=np.float64)[:, :args.n_targets] * args.gain
+
+    # hold out the end of the session for testing
+    n_test = int(np.ceil(X.shape[0] * args.test_size))
+    n_train = X.shape[0] - n_test
+    fit = fit_lagged_ridge(_IndexedRows(neural[args.neural_field],
+                                        neural_rows[:n_train]),
+                           y[:n_train],
+                           args.seq_len,
+                           alphas=args.alphas,
+                           cv=args.cv,
+                           chunk_size=args.chunk_size,
+                           n_jobs=args.n_jobs)
+    mdl = to_sklearn(fit)
+    if n_test:
+        y_pred = predict_lagged(mdl, X, args.seq_len, start=n_train)
+        y_test = y[n_train:]
+        r2 = np.mean(1 - ((y_test - y_pred)**2).sum(axis=0) /
+                     ((y_test - y_test.mean(axis=0))**2).sum(axis=0))
+        logging.info(f'alpha={fit["alpha"]:g}, test R2={r2:.4f}')
+    with open(args.output, 'wb') as f:
+        pickle.dump(mdl, f)
+    logging.info(f'Saved model to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+trials.py
+
+Per-trial index of a recorded session. radialFSM marks trials in the `state`
+stream with 'start_time', 'go_cue_time' and 'end_time' entries, and writes a
+`trial_info` entry when a trial starts and a `trial_success` entry when it
+ends, all with the sync dict of the cursor update that triggered them. The
+trial table collects these into one row per trial, together with the range
+of rows each recorded stream has between the trial's start and end, so
+trial-aligned data can be taken with a slice instead of a search.
+
+Trial table columns:
+
+    trial                   trial number
+    start_sync, go_sync,    sync counts of the trial events (-1 if the
+    end_sync                trial has no go cue or did not end)
+    start_ts, go_ts,        monotonic timestamps of the trial events (ns)
+    end_ts
+    cond_id                 condition ID from trial_info ('' if missing)
+    target_X, target_Y,     target and start positions from trial_info
+    start_X, start_Y
+    success                 1 if the target was acquired, 0 if not, -1 if
+                            the trial did not end
+    rows:<stream>           (start, stop) rows of <stream> from the start
+                            to the end of the trial, inclusive
+
+Usage:
+    python -m cursor_control.trials data/230101T1200_sim_graph_ol
+"""
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from .align import UNMATCHED, match
+
+TRIALS_FILE = 'trials.npz'
+TRIAL_STREAMS = ('state', 'trial_info', 'trial_success')
+INFO_FIELDS = ('target_X', 'target_Y', 'start_X', 'start_Y')
+
+
+def _next_event(starts, events, limit):
+    # first event at or after each start and before `limit`, or -1
+    events = np.append(events, np.iinfo(np.int64).max)
+    nxt = events[np.searchsorted(events, starts)]
+    return np.where(nxt < limit, nxt, -1)
+
+
+def _take(values, rows, fill):
+    values = np.asarray(values)
+    out = np.full(rows.shape[0], fill,
+                  dtype=np.result_type(values, np.asarray(fill)))
+    found = rows >= 0
+    out[found] = values[rows[found]]
+    return out
+
+
+def _fields(view):
+    return view.fields if hasattr(view, 'fields') else list(view)
+
+
+def build_trial_table(session, streams=None):
+    """
+    Build the trial table of a session
+
+    Parameters
+    ----------
+    session : mapping
+        Maps stream names to mappings of decoded fields, e.g. a
+        `cursor_control.session.Session` or a dict of `decode_stream`
+        outputs. Must contain the `state` stream.
+    streams : list of str, optional
+        Streams to index by trial, by default every stream with a `sync`
+        field other than the trial streams
+
+    Returns
+    -------
+    table : dict of arrays
+        One row per trial
+    """
+    state = session['state']
+    labels = np.asarray(state['state'])
+    if labels.dtype.kind == 'S':
+        labels = labels.astype(str)
+    sync = np.asarray(state['sync']).astype(np.int64)
+    ts = np.asarray(state['ts']).astype(np.int64)
+
+    idx = np.arange(labels.shape[0])
+    starts = idx[labels == 'start_time']
+    next_start = np.append(starts[1:], labels.shape[0])
+    go = _next_event(starts, idx[labels == 'go_cue_time'], next_start)
+    end = _next_event(starts, idx[labels == 'end_time'], next_start)
+
+    table = {'trial': np.arange(starts.shape[0])}
+    for name, rows in (('start', starts), ('go', go), ('end', end)):
+        table[f'{name}_sync'] = _take(sync, rows, -1)
+        table[f'{name}_ts'] = _take(ts, rows, -1)
+
+    # trial_info is written with the start of each trial
+    if 'trial_info' in session:
+        info = session['trial_info']
+        rows = match(table['start_sync'],
+                     np.asarray(info['sync']),
+                     duplicates='first')
+        if 'cond_id' in _fields(info):
+            cond_id = np.asarray(info['cond_id'])
+            table['cond_id'] = _take(cond_id.astype(str), rows, '')
+        for name in INFO_FIELDS:
+            if name in _fields(info):
+                table[name] = _take(np.asarray(info[name], np.float32), rows,
+                                    np.float32(np.nan))
+
+    # trial_success is written with the end of each trial
+    if 'trial_success' in session:
+        outcome = session['trial_success']
+        rows = match(table['end_sync'],
+                     np.asarray(outcome['sync']),
+                     duplicates='first')
+        rows[table['end_sync'] < 0] = UNMATCHED
+        table['success'] = _take(
+            np.asarray(outcome['success']).astype(np.int8), rows,
+            np.int8(-1))
+
+    # row ranges of the other streams
+    if streams is None:
+        streams = [
+            name for name in (getattr(session, 'streams', None)
+                              or list(session))
+            if name not in TRIAL_STREAMS and 'sync' in _fields(session[name])
+        ]
+    for name in streams:
+        stream_sync = np.asarray(session[name]['sync'])
+        if np.any(np.diff(stream_sync) < 0):
+            logging.warning(f'Sync counts of {name} are not sorted, skipping')
+            continue
+        start_row = np.searchsorted(stream_sync, table['start_sync'], 'left')
+        stop_row = np.searchsorted(stream_sync, table['end_sync'], 'right')
+        # trials that did not end run to the end of the stream
+        stop_row[table['end_sync'] < 0] = stream_sync.shape[0]
+        table[f'rows:{name}'] = np.stack([start_row, stop_row], axis=1)
+    return table
+
+
+def save_trial_table(table, session_dir):
+    """Save a trial table in a session directory"""
+    np.savez(os.path.join(session_dir, TRIALS_FILE), **table)
+
+
+def load_trial_table(session_dir):
+    """Load the trial table of a session, or None if it has none"""
+    path = os.path.join(session_dir, TRIALS_FILE)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def trial_rows(table, trial, stream):
+    """Rows of `stream` during a trial"""
+    start, stop = table[f'rows:{stream}'][trial]
+    return slice(int(start), int(stop))
+
+
+def main():
+    from .session import load_session
+
+    parser = argparse.ArgumentParser(
+        description='Build the trial table of a memory-mapped session')
+    parser.add_argument('session_dir')
+    args = parser.parse_args()
+
+    session = load_session(args.session_dir)
+    table = build_trial_table(session)
+    save_trial_table(table, args.session_dir)
+    n_trials = table['trial'].shape[0]
+    msg = f'{n_trials} trials'
+    if 'success' in table:
+        msg += f", {np.count_nonzero(table['success'] == 1)} successful"
+    print(msg)
+    print('indexed streams: ' + ', '.join(
+        key[len('rows:'):] for key in table if key.startswith('rows:')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+trim.py
+
+Approximate trimming of node output streams, so that long sessions do not
+grow Redis memory without bound. Nodes read two optional parameters, each
+either one value for all of the node's output streams or a map from stream
+names to values, with `default` for the streams that are not listed:
+
+    # keep about this many entries
+    max_samples: 100000
+    # keep about this many seconds of entries
+    max_age: {cursorData: 600, display_sync_pulse: 600, default: null}
+
+`max_samples` is applied with XADD ... MAXLEN ~ and `max_age` with
+XADD ... MINID ~ <now - max_age>, so Redis only drops whole macro nodes and
+trimming costs nothing measurable per XADD. A stream can be given one of
+the two, not both. `max_age` is measured on this machine's clock against
+entry IDs from the Redis server's clock.
+
+To keep complete recordings of trimmed streams, run the `session_recorder`
+node (or `cursor_control.recorder`) with `keep_s` set: it writes entries to
+disk and then trims what it has written, so memory stays flat without
+depending on `max_samples`, which should then only be a safety limit well
+above what accumulates between the recorder's writes.
+"""
+import time
+
+DEFAULT = 'default'
+
+
+def _stream_value(value, stream):
+    if isinstance(value, dict):
+        return value.get(stream, value.get(DEFAULT))
+    return value
+
+
+class StreamTrim():
+    # XADD trimming arguments of each output stream of a node. Call with a
+    # stream name to get the keyword arguments for `xadd`
+
+    def __init__(self, max_samples=None, max_age=None):
+        self.max_samples = max_samples
+        self.max_age = max_age
+        self.kwargs = {}
+        # streams trimmed by age, whose MINID is updated on every call
+        self.by_age = {}
+
+    def _resolve(self, stream):
+        name = stream.decode() if isinstance(stream, bytes) else stream
+        max_samples = _stream_value(self.max_samples, name)
+        max_age = _stream_value(self.max_age, name)
+        if max_samples and max_age:
+            raise ValueError(f'Stream {name} has both max_samples and max_age')
+        if max_samples:
+            kwargs = {'maxlen': int(max_samples), 'approximate': True}
+        elif max_age:
+            kwargs = {'minid': 0, 'approximate': True}
+            self.by_age[stream] = int(max_age * 1000)
+        else:
+            kwargs = {}
+        self.kwargs[stream] = kwargs
+        return kwargs
+
+    def __call__(self, stream):
+        kwargs = self.kwargs.get(stream)
+        if kwargs is None:
+            kwargs = self._resolve(stream)
+        if stream in self.by_age:
+            kwargs['minid'] = int(time.time() * 1000) - self.by_age[stream]
+        return kwargs
+
+
+def node_trim(node):
+    """
+    StreamTrim for a BRAND node from its `max_samples` and `max_age`
+    parameters
+    """
+    return StreamTrim(max_samples=node.parameters.get('max_samples'),
+                      max_age=node.parameters.get('max_age'))
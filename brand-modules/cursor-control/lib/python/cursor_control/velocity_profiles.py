@@ -0,0 +1,172 @@
+"""
+velocity_profiles.py
+
+Speed profiles for automatic cursor movements. A profile is built once per
+movement, when the movement's start position is set, and turns the total
+distance to travel into a lookup table of per-iteration speeds. Reading a
+speed during the movement is then an O(1) table lookup.
+
+All speeds are in units/iteration.
+"""
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+class VelocityProfile(ABC):
+    # base class for all profiles. Subclasses implement `_build`, which
+    # returns the per-iteration speeds for a movement of a given distance
+
+    name = None
+
+    def __init__(self, speed, min_speed=0.):
+        self.speed = speed  # peak speed (units/iteration)
+        self.min_speed = min_speed  # speed floor (units/iteration)
+        self.lut = np.zeros(0)
+        self.tail_speed = min_speed
+
+    def build(self, distance):
+        """
+        Compute the speed lookup table for a new movement
+
+        Parameters
+        ----------
+        distance : float
+            Total distance from the movement start to the target
+
+        Returns
+        -------
+        lut : array of shape (n_iterations,)
+            Speed at each iteration of the movement
+        """
+        lut = self._build(distance) if distance > 0 else np.zeros(0)
+        self.lut = np.maximum(lut, self.min_speed)
+        return self.lut
+
+    def speed_at(self, i):
+        """Speed at iteration `i` of the current movement"""
+        if i < self.lut.shape[0]:
+            return self.lut[i]
+        return self.tail_speed
+
+    @abstractmethod
+    def _build(self, distance):
+        pass
+
+    def n_iterations(self, distance):
+        # maximum number of iterations to complete a movement at peak speed
+        return int(np.ceil(distance / self.speed))
+
+
+class ConstantProfile(VelocityProfile):
+    name = 'constant'
+
+    def __init__(self, speed, min_speed=0.):
+        super().__init__(speed, min_speed=min_speed)
+        self.tail_speed = speed
+
+    def _build(self, distance):
+        # the same speed throughout, which is also the tail speed
+        return np.full(1, self.speed)
+
+
+class TriangularProfile(VelocityProfile):
+    name = 'triangular'
+
+    def _build(self, distance):
+        T = self.n_iterations(distance)
+        it = np.arange(T + 1)
+        # ramp up to the halfway point, then back down
+        vel_gain = np.where(it < 0.5 * T, it / (0.25 * T),
+                            (T - it) / (0.25 * T))
+        return self.min_speed + (self.speed - self.min_speed) * vel_gain
+
+
+class GaussianProfile(VelocityProfile):
+    name = 'gaussian'
+
+    def _build(self, distance):
+        T = self.n_iterations(distance)
+        it = np.arange(T + 1)
+        # truncated gaussian parameters
+        sigma = T / 6
+        mu = sigma * 3
+        pdf = np.exp(-((it - mu)**2 / (2 * sigma**2))) / (sigma *
+                                                          np.sqrt(2 * np.pi))
+        scale = pdf[:T].sum()
+        vel_gain = pdf / scale
+        return self.min_speed + (self.speed - self.min_speed) * vel_gain * T
+
+
+class MinimumJerkProfile(VelocityProfile):
+    name = 'minimum_jerk'
+
+    def _build(self, distance):
+        # the peak speed of a minimum-jerk movement is 1.875 times its mean
+        # speed, so stretch the movement to keep the peak at `speed`
+        T = int(np.ceil(1.875 * distance / self.speed))
+        tau = np.arange(T + 1) / T
+        pos = distance * (10 * tau**3 - 15 * tau**4 + 6 * tau**5)
+        # per-iteration displacement, which sums to `distance`
+        return np.diff(pos)
+
+
+class PDProfile(VelocityProfile):
+    name = 'PD'
+
+    def __init__(self, speed, kp, kd, min_speed=0., tol=0.5, max_iter=10000):
+        super().__init__(speed, min_speed=min_speed)
+        self.Kp = kp
+        self.Kd = kd
+        self.tol = tol  # stop simulating once the error is below this
+        self.max_iter = max_iter
+
+    def _build(self, distance):
+        # simulate a PD controller acting on the distance to the target,
+        # assuming the cursor follows the commanded velocity
+        lut = np.zeros(self.max_iter)
+        error = error_last = distance
+        n = 0
+        while n < self.max_iter and error > self.tol:
+            v = self.Kp * error + self.Kd * (error - error_last)
+            if v <= 0:
+                break
+            lut[n] = v
+            error_last = error
+            error -= v
+            n += 1
+        lut = lut[:n]
+        self.tail_speed = max(lut[-1] if n else 0., self.min_speed)
+        return lut
+
+
+PROFILES = {
+    p.name: p
+    for p in [
+        ConstantProfile, TriangularProfile, GaussianProfile,
+        MinimumJerkProfile, PDProfile
+    ]
+}
+
+
+def make_profile(name, speed, **kwargs):
+    """
+    Create a velocity profile by name
+
+    Parameters
+    ----------
+    name : str
+        One of the keys of `PROFILES`
+    speed : float
+        Peak speed in units/iteration
+    **kwargs
+        Profile-specific parameters (e.g. `min_speed`, `kp`, `kd`)
+
+    Returns
+    -------
+    profile : VelocityProfile
+    """
+    if name not in PROFILES:
+        raise ValueError(f'Unknown velocity profile: {name}. '
+                         f'Options are {list(PROFILES.keys())}')
+    return PROFILES[name](speed, **kwargs)
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import numpy as np
+
+# make the cursor-control library importable
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cursor_control.align import UNMATCHED, align_streams, match
+
+
+def test_match_exact():
+    rows = match([3, 1, 5], [1, 3, 3])
+    np.testing.assert_array_equal(rows, [2, 0, UNMATCHED])
+    rows = match([3, 1, 5], [1, 3, 3], duplicates='first')
+    np.testing.assert_array_equal(rows, [1, 0, UNMATCHED])
+
+
+def test_match_empty():
+    for how in ('exact', 'backward'):
+        rows = match([1, 2], [], how=how)
+        np.testing.assert_array_equal(rows, [UNMATCHED, UNMATCHED])
+    assert match([], [1, 2]).shape == (0, )
+
+
+def test_align_streams_left():
+    others = {'a': [2, 3], 'b': []}
+    base_rows, rows = align_streams([1, 2, 3], others, inner=False)
+    np.testing.assert_array_equal(base_rows, [0, 1, 2])
+    np.testing.assert_array_equal(rows['a'], [UNMATCHED, 0, 1])
+    np.testing.assert_array_equal(rows['b'], [UNMATCHED] * 3)
@@ -0,0 +1,73 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+# make the cursor-control library importable
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cursor_control.decode import decode_column, decode_stream
+from cursor_control.session import load_session, write_session
+
+SPEC = {
+    'X': 'float32',
+    'pos': 'float32',
+    'ts': 'uint64',
+    'sync': 'sync',
+    'name': 'str',
+    'tv': 'timeval',
+}
+
+
+def _entry(i):
+    return {
+        b'X': np.float32(i).tobytes(),
+        b'pos': np.array([i, -i], dtype=np.float32).tobytes(),
+        b'ts': np.uint64(i).tobytes(),
+        b'sync': json.dumps({'count': i}).encode(),
+        b'name': f'entry{i}'.encode(),
+        b'tv': np.array([i, 500000], dtype=np.int64).tobytes(),
+    }
+
+
+def test_decode_stream():
+    entries = [(f'{i}-0'.encode(), _entry(i)) for i in range(3)]
+    decoded = decode_stream(entries, SPEC)
+    np.testing.assert_array_equal(decoded['X'], [0, 1, 2])
+    assert decoded['X'].dtype == np.float32
+    np.testing.assert_array_equal(decoded['pos'], [[0, 0], [1, -1], [2, -2]])
+    np.testing.assert_array_equal(decoded['ts'], [0, 1, 2])
+    np.testing.assert_array_equal(decoded['sync'], [0, 1, 2])
+    assert list(decoded['name']) == ['entry0', 'entry1', 'entry2']
+    np.testing.assert_array_equal(decoded['tv'], [0.5, 1.5, 2.5])
+
+
+def test_decode_stream_empty():
+    decoded = decode_stream([], SPEC)
+    assert set(decoded) == set(SPEC)
+    for values in decoded.values():
+        assert values.shape == (0, )
+    assert decoded['X'].dtype == np.float32
+    assert decoded['ts'].dtype == np.uint64
+    assert decoded['sync'].dtype == np.int64
+    assert decoded['tv'].dtype == np.float64
+
+
+def test_decode_column_missing_everywhere():
+    values = decode_column(b'', np.array([-1, -1]), 'uint16')
+    assert values.dtype == np.float32
+    assert np.isnan(values).all()
+
+
+def test_write_session_empty_stream(tmp_path):
+    graph_data = {
+        b'cursorData': [],
+        b'targetData': [(b'1-0', _entry(1))],
+    }
+    spec = {'cursorData': SPEC, 'targetData': SPEC}
+    write_session(graph_data, spec, str(tmp_path))
+    session = load_session(str(tmp_path))
+    assert len(session['cursorData']) == 0
+    assert session['cursorData']['ts'].dtype == np.uint64
+    assert len(session['targetData']) == 1
@@ -0,0 +1,63 @@
+import logging
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+
+# make the cursor-control library importable
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cursor_control.frame_latency import (cursor_latency, frame_table,
+                                          scene_latency, shown_stream)
+from cursor_control.scene import SCENE_FIELD, SCENE_STREAM, ScenePacker
+
+
+def _frame(i, entry_id, t_flip):
+    return (f'{i}-0'.encode(), {
+        b'frame': np.uint64(i).tobytes(),
+        b't_draw': np.uint64(t_flip - 1000).tobytes(),
+        b't_flip': np.uint64(t_flip).tobytes(),
+        b'cursor_sync': np.int64(i).tobytes(),
+        b'target_sync': np.int64(i).tobytes(),
+        b'cursor_id': entry_id,
+    })
+
+
+def _scene_entries(n):
+    packer = ScenePacker()
+    shape = SimpleNamespace(x=0., y=0., radius=1., state=0)
+    entries = []
+    for i in range(n):
+        record = packer.pack(i, 0, {'count': i}, shape, [shape])
+        entries.append((f'{i + 1}-0'.encode(), {SCENE_FIELD: record}))
+    return entries
+
+
+def test_scene_latency():
+    scene = _scene_entries(2)
+    ts = [
+        np.frombuffer(e[SCENE_FIELD], np.uint64, count=1)[0]
+        for _, e in scene
+    ]
+    # the display shows the b'0-0' seed until the first scene entry arrives
+    frames = [
+        _frame(0, b'0-0', int(ts[0])),
+        _frame(1, b'1-0', int(ts[0]) + 2000000),
+        _frame(2, b'1-0', int(ts[0]) + 4000000),
+        _frame(3, b'2-0', int(ts[1]) + 3000000),
+    ]
+    table = frame_table(frames)
+    graph_data = {SCENE_STREAM: scene, b'cursorData': []}
+    assert shown_stream(table, graph_data) == SCENE_STREAM
+    np.testing.assert_allclose(scene_latency(table, scene), [2., 3.])
+
+
+def test_cursor_latency_no_match_warns(caplog):
+    frames = [_frame(0, b'0-0', 1000), _frame(1, b'1-0', 2000)]
+    table = frame_table(frames)
+    cursor = [(b'5-0', {b'ts': np.uint64(0).tobytes()})]
+    assert shown_stream(table, {b'cursorData': cursor}) == b'cursorData'
+    with caplog.at_level(logging.WARNING):
+        assert cursor_latency(table, cursor).shape == (0, )
+    assert 'cursorData' in caplog.text
@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+# make the cursor-control library importable
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cursor_control.hooks import node_hooks
+from cursor_control.lag import LAG_STREAM, SKIP_KEY
+from cursor_control.metrics import COMPUTE, WAIT, decode_metrics
+from cursor_control.recorder import parse_id
+
+
+class _Pipeline():
+
+    def __init__(self, r):
+        self.r = r
+        self.queued = []
+
+    def __getattr__(self, name):
+        # queue any command, to run on the Redis stand-in at execute()
+        def command(*args, **kwargs):
+            self.queued.append((getattr(self.r, name), args, kwargs))
+        return command
+
+    def execute(self):
+        replies = [f(*args, **kwargs) for f, args, kwargs in self.queued]
+        self.queued = []
+        return replies
+
+
+class _Redis():
+    # streams, hashes and XREAD calls, like a Redis client
+
+    def __init__(self, streams=None):
+        self.streams = streams or {}
+        self.hashes = {}
+        self.reads = []
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+    def xadd(self, stream, entry, **kwargs):
+        entries = self.streams.setdefault(stream, [])
+        entries.append((f'{len(entries)}-0'.encode(), entry))
+
+    def xrevrange(self, stream, max, min, count=None):
+        return self.streams.get(stream, [])[::-1][:count]
+
+    def xrange(self, stream, min, max, count=None):
+        return [(entry_id, entry)
+                for entry_id, entry in self.streams.get(stream, [])
+                if parse_id(entry_id) >= parse_id(min)][:count]
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def xread(self, streams, count=None, block=None):
+        self.reads.append((dict(streams), count, block))
+        return [[stream, []] for stream in streams]
+
+
+def _node(parameters, r=None):
+    return SimpleNamespace(parameters=parameters,
+                           r=r or _Redis(),
+                           NAME='node')
+
+
+def test_default_hooks_change_nothing():
+    node = _node({})
+    hooks = node_hooks(node)
+    assert hooks.metrics is None
+    assert hooks.audit is None
+    assert hooks.profiler is None
+    assert hooks.lag is None
+    assert hooks.trim(b'out') == {}
+    hooks.xread(node.r, {b'in': '$'}, count=4)
+    assert node.r.reads == [({b'in': '$'}, 4, 0)]
+
+    stream_ids = {b'in': b'1-0'}
+    hooks.start()
+    hooks.lap(WAIT)
+    hooks.lap(COMPUTE)
+    hooks.after_tick(stream_ids, safe_point=True)
+    assert stream_ids == {b'in': b'1-0'}
+    assert node.r.streams == {}
+
+
+def test_trim_and_metrics_from_parameters():
+    node = _node({'max_samples': 10, 'metrics_interval': 3600})
+    hooks = node_hooks(node)
+    assert hooks.trim(b'out') == {'maxlen': 10, 'approximate': True}
+    hooks.start()
+    for _ in range(3):
+        hooks.lap(WAIT)
+        hooks.lap(COMPUTE)
+        hooks.after_tick()
+    hooks.metrics.flush()
+    decoded = decode_metrics(node.r.streams['node_metrics'])
+    assert [decoded[phase]['n'][0] for phase in hooks.metrics.phases] == [
+        3, 3, 3
+    ]
+
+
+def test_after_tick_collects_at_safe_points():
+    hooks = node_hooks(_node({'gc_threshold': 1}))
+    garbage = []
+    for _ in range(10):
+        cycle = []
+        cycle.append(cycle)
+        garbage.append(cycle)
+    hooks.after_tick()
+    assert hooks.audit.collections == 0
+    hooks.after_tick(safe_point=True)
+    assert hooks.audit.collections == 1
+
+
+def test_after_tick_checks_lag_and_skips_in_place():
+    r = _Redis({b'in': [(b'1-0', {}), (b'2-0', {}), (b'100-0', {})]})
+    r.hashes[SKIP_KEY] = {'node': b'10'}
+    hooks = node_hooks(_node({'lag_interval': 1e-6}, r))
+    stream_ids = {b'in': b'1-0'}
+    time.sleep(1e-3)
+    # not checked without the IDs, e.g. for a node reading from a ring
+    hooks.after_tick()
+    assert LAG_STREAM not in r.streams
+    hooks.after_tick(stream_ids)
+    assert stream_ids == {b'in': b'100-0'}
+    (_, report), = r.streams[LAG_STREAM]
+    assert report[b'node'] == b'node'
+    assert report[b'stream'] == b'in'
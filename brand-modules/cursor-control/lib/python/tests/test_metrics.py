@@ -0,0 +1,85 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# make the cursor-control library importable
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cursor_control.metrics import (COMPUTE, N_BUCKETS, PERCENTILES, WAIT,
+                                    WRITE, LoopMetrics, bucket_bounds,
+                                    bucket_index, decode_metrics,
+                                    histogram_percentiles, summarize_metrics)
+
+
+class _Stream():
+    # records XADDs like a Redis client
+
+    def __init__(self):
+        self.entries = []
+
+    def xadd(self, stream, entry, **kwargs):
+        self.entries.append((f'{len(self.entries)}-0'.encode(), entry))
+
+
+def _histogram(values):
+    counts = np.zeros(N_BUCKETS, dtype=np.int64)
+    for v in values:
+        counts[bucket_index(int(v))] += 1
+    return counts
+
+
+def test_bucket_index_bounds():
+    lower, upper = bucket_bounds()
+    values = np.unique(
+        np.concatenate([
+            np.arange(200),
+            np.logspace(2, 10.5, 5000).astype(np.int64),
+            upper[:-1] - 1,
+            lower,
+        ]))
+    for v in values.tolist():
+        i = bucket_index(v)
+        assert lower[i] <= v < upper[i]
+        # buckets hold values within 1/32 of each other
+        assert upper[i] - lower[i] <= max(lower[i] / 32, 1)
+    assert bucket_index(2**62) == N_BUCKETS - 1
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_histogram_percentiles(seed):
+    rng = np.random.default_rng(seed)
+    # loop times in ns, with a tail
+    values = np.concatenate([
+        rng.lognormal(np.log(50000), 0.3, 20000),
+        rng.lognormal(np.log(2e6), 0.5, 200),
+    ]).astype(np.int64)
+    estimate = histogram_percentiles(_histogram(values))
+    exact = np.percentile(values, PERCENTILES, method='inverted_cdf')
+    np.testing.assert_allclose(estimate, exact, rtol=1 / 32)
+
+
+def test_histogram_percentiles_small():
+    counts = _histogram([5, 7, 9, 11])
+    np.testing.assert_array_equal(histogram_percentiles(counts, (50, 100)),
+                                  [7.5, 11.5])
+    assert np.isnan(histogram_percentiles(np.zeros(N_BUCKETS))).all()
+
+
+def test_loop_metrics_flush():
+    r = _Stream()
+    metrics = LoopMetrics(r, 'node_metrics', interval=3600)
+    metrics.start()
+    for _ in range(100):
+        metrics.lap(WAIT)
+        metrics.lap(COMPUTE)
+        metrics.lap(WRITE)
+    metrics.flush()
+    decoded = decode_metrics(r.entries)
+    for name in ('wait', 'compute', 'write'):
+        assert decoded[name]['n'][0] == 100
+        assert decoded[name]['counts'].sum() == 100
+    summary = summarize_metrics(decoded)
+    assert summary['wait']['n'] == 100
+    assert summary['write']['n'] == 100
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+# make the cursor-control library importable
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cursor_control.nwb_export import (check_trial_indicators,
+                                       node_output_specs)
+
+
+def test_radialfsm_trial_indicators():
+    graph = {'nodes': [{'name': 'radialFSM', 'parameters': {}}]}
+    sources = {}
+    specs = node_output_specs(graph, sources=sources)
+    state = specs['state']['state']
+    check_trial_indicators(state['nwb'], sources['state'])
+    assert sources['state'].endswith('radialFSM.yaml')
+
+
+@pytest.mark.parametrize('args, missing', [
+    ({
+        'end_trial_indicators': ['end_time']
+    }, "'start_time'"),
+    ({
+        'start_trial_indicators': ['start_time'],
+        'end_trial_indicators': ['trial_end']
+    }, "'end_time'"),
+])
+def test_missing_trial_indicator(args, missing):
+    with pytest.raises(ValueError, match='radialFSM.yaml') as exc:
+        check_trial_indicators(args, 'nodes/radialFSM/radialFSM.yaml')
+    assert missing in str(exc.value)
@@ -0,0 +1,124 @@
+import os
+import pickle
+import sys
+import time
+
+# make the cursor-control library importable
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cursor_control.metrics import LoopMetrics, decode_metrics
+from cursor_control.replay import Pacer, Replayer, iter_session, split_pickle
+
+
+class _Pipeline():
+
+    def __init__(self, r):
+        self.r = r
+        self.queued = []
+
+    def xadd(self, stream, entry, **kwargs):
+        self.queued.append((stream, entry))
+
+    def execute(self):
+        self.r.batches.append([stream for stream, _ in self.queued])
+        self.queued = []
+
+
+class _Redis():
+    # records pipelined batches and direct XADDs
+
+    def __init__(self):
+        self.batches = []
+        self.entries = []
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+    def xadd(self, stream, entry, **kwargs):
+        self.entries.append((f'{len(self.entries)}-0'.encode(), entry))
+
+
+def _session(tmp_path):
+    graph_data = {
+        b'a': [(f'{ms}-0'.encode(), {
+            b'v': b'a%d' % ms
+        }) for ms in (1000, 1002, 1010)],
+        b'b': [(f'{ms}-{seq}'.encode(), {
+            b'v': b'b%d' % ms
+        }) for ms, seq in ((1001, 0), (1002, 1), (1030, 0))],
+    }
+    path = str(tmp_path / 'session.pkl')
+    with open(path, 'wb') as f:
+        pickle.dump(graph_data, f)
+    return path
+
+
+def test_iter_session_merges_in_id_order(tmp_path):
+    path = _session(tmp_path)
+    session_dir = str(tmp_path / 'session')
+    split_pickle(path, session_dir, chunk_size=2)
+    for source in (path, session_dir):
+        merged = [(ms, seq, index, entry[b'v'])
+                  for ms, seq, index, entry in iter_session(source, ['a', 'b'])
+                  ]
+        assert merged == [
+            (1000, 0, 0, b'a1000'),
+            (1001, 0, 1, b'b1001'),
+            (1002, 0, 0, b'a1002'),
+            (1002, 1, 1, b'b1002'),
+            (1010, 0, 0, b'a1010'),
+            (1030, 0, 1, b'b1030'),
+        ]
+
+
+def test_pacer():
+    pacer = Pacer(speed=2., spin_us=500)
+    pacer.start(10**9)
+    assert pacer.deadline(10**9 + 4 * 10**6) == pacer.t0 + 2 * 10**6
+    deadline = time.monotonic_ns() + 3 * 10**6
+    late = pacer.wait(deadline)
+    assert late >= 0
+    assert time.monotonic_ns() >= deadline
+    # a deadline in the past returns at once with how late it is
+    assert pacer.wait(time.monotonic_ns() - 10**6) >= 10**6
+
+
+def test_replayer_batches(tmp_path):
+    r = _Redis()
+    metrics = LoopMetrics(r, 'replay_metrics', interval=3600)
+    replayer = Replayer(r,
+                        _session(tmp_path),
+                        streams=['a', 'b'],
+                        speed=0,
+                        max_batch=2,
+                        prefix='re_',
+                        metrics=metrics)
+    assert replayer.run() == 6
+    # merged in entry ID order, at most max_batch entries per pipeline
+    assert r.batches == [[b're_a', b're_b'], [b're_a', b're_b'],
+                         [b're_a', b're_b']]
+    metrics.flush()
+    decoded = decode_metrics(r.entries[-1:])
+    for name in ('wait', 'compute', 'write'):
+        assert decoded[name]['n'][0] == 3
+
+
+def test_replayer_paced(tmp_path):
+    r = _Redis()
+    metrics = LoopMetrics(r, 'replay_metrics', interval=3600)
+    replayer = Replayer(r,
+                        _session(tmp_path),
+                        streams=['a', 'b'],
+                        speed=1,
+                        batch_us=500,
+                        metrics=metrics)
+    t = time.monotonic_ns()
+    assert replayer.run() == 6
+    # the session spans 30 ms of entry IDs
+    assert time.monotonic_ns() - t >= 30 * 10**6
+    assert r.batches == [[b'a'], [b'b'], [b'a', b'b'], [b'a'], [b'b']]
+    metrics.flush()
+    decoded = decode_metrics(r.entries[-1:])
+    # the 20 ms before the last batch are spent pacing, in the wait phase
+    assert decoded['wait']['max'][0] >= 19 * 10**6
+    assert decoded['compute']['max'][0] < 10**7
@@ -0,0 +1,125 @@
+import logging
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+# make the cursor-control library importable
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cursor_control import shm
+from cursor_control.shm import RingReader, RingWriter
+
+FIELDS = [('samples', np.int16, (4, )), ('i', np.uint64, ()),
+          ('sync', 'bytes', 64)]
+
+ring = pytest.mark.skipif(not shm.RING_SUPPORTED,
+                          reason='shared-memory rings need x86-64')
+
+
+def _entry(i):
+    return {
+        b'samples': np.arange(4, dtype=np.int16) * i,
+        b'i': np.uint64(i).tobytes(),
+        b'sync': b'{"count": %d}' % i,
+    }
+
+
+def _ring(tmp_path, n_slots=4):
+    path = str(tmp_path / 'ring')
+    writer = RingWriter(path, FIELDS, n_slots=n_slots)
+    reader = RingReader(path, from_start=True)
+    assert reader.attach()
+    return writer, reader
+
+
+def _check(seq, entry):
+    np.testing.assert_array_equal(entry[b'samples'],
+                                  np.arange(4, dtype=np.int16) * seq)
+    assert entry[b'i'] == np.uint64(seq).tobytes()
+    assert entry[b'sync'] == b'{"count": %d}' % seq
+
+
+@ring
+def test_round_trip(tmp_path):
+    writer, reader = _ring(tmp_path)
+    assert writer.write(_entry(0)) == 0
+    seq, entry = reader.read(timeout=1)
+    assert seq == 0
+    _check(seq, entry)
+    assert reader.read(timeout=0.01) == (None, None)
+
+
+@ring
+def test_wraparound(tmp_path):
+    writer, reader = _ring(tmp_path, n_slots=4)
+    for i in range(11):
+        writer.write(_entry(i))
+        seq, entry = reader.read(timeout=1)
+        assert seq == i
+        _check(seq, entry)
+        # the record is valid until the writer laps its slot
+        assert reader.valid(seq)
+    assert not reader.valid(6)
+    assert reader.valid(7)
+    assert reader.dropped == 0
+
+
+@ring
+def test_overrun_counts_missed_records(tmp_path):
+    writer, reader = _ring(tmp_path, n_slots=4)
+    for i in range(10):
+        writer.write(_entry(i))
+    # records 0-6 were overwritten or are next to be: reading resumes at
+    # the oldest record the writer is not about to overwrite
+    seqs = []
+    while True:
+        seq, entry = reader.read(timeout=0.01)
+        if seq is None:
+            break
+        _check(seq, entry)
+        seqs.append(seq)
+    assert seqs == [7, 8, 9]
+    assert reader.dropped == 7
+
+
+@ring
+@pytest.mark.skipif(not shm.HAVE_FUTEX, reason='no futex syscall')
+def test_futex_wakeup(tmp_path):
+    writer, reader = _ring(tmp_path)
+    reader.from_start = False
+    result = {}
+
+    def read():
+        result['seq'], _ = reader.read(timeout=5)
+        result['t'] = time.monotonic()
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    time.sleep(0.2)
+    assert thread.is_alive()
+    t_write = time.monotonic()
+    writer.write(_entry(0))
+    thread.join(5)
+    assert result['seq'] == 0
+    # woken by the write, well before the reader's 1 s futex timeout
+    assert result['t'] - t_write < 0.5
+
+
+def test_refused_off_x86_64(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(shm, 'RING_SUPPORTED', False)
+    with pytest.raises(RuntimeError, match='x86-64'):
+        RingWriter(str(tmp_path / 'ring'), FIELDS)
+    with pytest.raises(RuntimeError, match='x86-64'):
+        RingReader(str(tmp_path / 'ring'))
+    node = SimpleNamespace(parameters={'shm_streams': {'binned': {}}})
+    with caplog.at_level(logging.WARNING):
+        assert shm.node_ring_writer(node, 'binned', FIELDS) is None
+        assert shm.node_ring_reader(node, b'binned') is None
+        assert shm.redis_every(node, 'binned') == 1
+    assert 'Using Redis for binned' in caplog.text
+    assert not os.path.exists(str(tmp_path / 'ring'))
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import numpy as np
+
+# make the cursor-control library importable
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cursor_control.spike_generator import SpikeGenerator
+
+
+def test_rate():
+    gen = SpikeGenerator(256, 1000, baseline_rate=50., seed=0)
+    n_spikes = sum(int(gen.generate(1000).sum()) for _ in range(20))
+    # 50 Hz over 256 channels and 20 s
+    expected = 50 * 256 * 20
+    assert abs(n_spikes - expected) < 4 * np.sqrt(expected)
+
+
+def test_batches_do_not_repeat():
+    # with the pool the size of a batch, every slice is the same rows
+    gen = SpikeGenerator(64,
+                         1000,
+                         baseline_rate=100.,
+                         pool_size=500,
+                         max_batch=500,
+                         seed=0)
+    first = gen.generate(500).copy()
+    second = gen.generate(500).copy()
+    assert first.sum() and second.sum()
+    # crossings of the two batches coincide about as often as independent
+    # ones would (p² per sample), not in every crossing
+    p = 100 / 1000
+    both = np.count_nonzero(first & second)
+    assert both < 2 * p**2 * first.size
@@ -0,0 +1,76 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# make the cursor-control library importable
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cursor_control.synthesize import synthesize_session, to_stream_entries
+
+FSM = {
+    'cursor_radius': 25,
+    'delay_time_in': {'min': 0, 'max': 0},
+    'delay_time_out': {'min': 0.2, 'max': 0.2},
+    'distance_from_center': 400,
+    'initial_wait_time': 1,
+    'inter_trial_time_failure': {'min': 1., 'max': 1.},
+    'inter_trial_time_in': {'min': 0, 'max': 0},
+    'inter_trial_time_out': {'min': 0, 'max': 0},
+    'recenter': False,
+    'recenter_on_fail': True,
+    'target_angles': [0, 90, 180, 270],
+    'target_diameter': 80,
+    'target_hold_time_in': {'min': 0.5, 'max': 0.5},
+    'target_hold_time_out': {'min': 0.5, 'max': 0.5},
+}
+AUTO_CUE = {
+    'input_rate': 100,
+    'speed': 400,
+    'min_speed': 0.01,
+    'vel_profile': 'gaussian',
+}
+GRAPH = {
+    'parameters': {
+        'total_channels': 4
+    },
+    'nodes': [
+        {
+            'name': 'radialFSM',
+            'parameters': FSM
+        },
+        {
+            'name': 'auto_cue',
+            'parameters': AUTO_CUE
+        },
+    ],
+}
+
+
+# sessions that end in different phases of a trial
+@pytest.mark.parametrize('duration', [3, 7.3, 10])
+def test_trial_streams_agree(duration):
+    session = synthesize_session(GRAPH, duration=duration)
+    streams = to_stream_entries(session, GRAPH)
+    n = session['cursor'].shape[0]
+    assert n == int(duration * 100)
+    assert len(streams[b'binned_spikes'][0][1][b'samples']) == 4
+
+    trials = session['trials']
+    ended = [t for t in trials if t.get('end', n) < n]
+    assert len(ended) >= duration // 3
+    assert len(streams[b'trial_info']) == len(trials)
+    assert len(streams[b'trial_success']) == len(ended)
+    states = [e[b'state'] for _, e in streams[b'state']]
+    assert states.count(b'start_time') == len(trials)
+    assert states.count(b'end_time') == len(ended)
+    success = [
+        np.frombuffer(e[b'success'], np.uint8)[0]
+        for _, e in streams[b'trial_success']
+    ]
+    assert success == [t['success'] for t in ended]
+    # the state and trial streams are written in order
+    for name in (b'state', b'trial_info', b'trial_success'):
+        ids = [int(entry_id.split(b'-')[0]) for entry_id, _ in streams[name]]
+        assert ids == sorted(ids)
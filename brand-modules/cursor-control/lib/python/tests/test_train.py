@@ -0,0 +1,100 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# make the cursor-control library importable
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cursor_control.train import (accumulate_moments, fit_lagged_ridge,
+                                  lagged_chunks, r2_from_moments, solve_ridge)
+
+SEQ_LEN = 4
+
+
+def _data(n=200, n_features=3, n_targets=2, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, n_features))
+    y = (_dense_lagged(X, SEQ_LEN) @ rng.normal(size=(SEQ_LEN * n_features,
+                                                      n_targets)) +
+         rng.normal(size=(n, n_targets)) + 3)
+    return X, y
+
+
+def _dense_lagged(X, seq_len):
+    # row t is [x_t, x_t-1, ..., x_t-seq_len+1], zeros before the first bin
+    padded = np.vstack([np.zeros((seq_len - 1, X.shape[1])), X])
+    return np.hstack([
+        padded[seq_len - 1 - lag:padded.shape[0] - lag]
+        for lag in range(seq_len)
+    ])
+
+
+def _ridge(X, y, alpha):
+    # closed-form ridge with an unpenalized intercept
+    mean_x, mean_y = X.mean(axis=0), y.mean(axis=0)
+    Xc = X - mean_x
+    w = np.linalg.solve(Xc.T @ Xc + alpha * np.eye(X.shape[1]),
+                        Xc.T @ (y - mean_y))
+    return w.T, mean_y - mean_x @ w
+
+
+def _r2(y, y_hat):
+    return np.mean(1 - ((y - y_hat)**2).sum(axis=0) /
+                   ((y - y.mean(axis=0))**2).sum(axis=0))
+
+
+def test_lagged_chunks_match_dense():
+    X, _ = _data()
+    dense = _dense_lagged(X, SEQ_LEN)
+    for start, stop in ((0, None), (2, 150)):
+        chunks = list(lagged_chunks(X, SEQ_LEN, start, stop, chunk_size=7))
+        stop = X.shape[0] if stop is None else stop
+        assert chunks[0][0] == start and chunks[-1][1] == stop
+        np.testing.assert_array_equal(
+            np.vstack([lagged for _, _, lagged in chunks]), dense[start:stop])
+
+
+def test_solve_ridge_matches_closed_form():
+    X, y = _data()
+    alphas = [0.1, 10., 1000.]
+    m, = accumulate_moments(X, y, SEQ_LEN, [0, X.shape[0]], chunk_size=33)
+    coefs, intercepts = solve_ridge(m, alphas)
+    dense = _dense_lagged(X, SEQ_LEN)
+    for alpha, coef, intercept in zip(alphas, coefs, intercepts):
+        ref_coef, ref_intercept = _ridge(dense, y, alpha)
+        np.testing.assert_allclose(coef, ref_coef, rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(intercept, ref_intercept, rtol=1e-8)
+
+
+def test_cv_scores_match_dense_folds():
+    X, y = _data(n=202)
+    alphas = [1., 100.]
+    fit = fit_lagged_ridge(X, y, SEQ_LEN, alphas=alphas, cv=3, chunk_size=50)
+    dense = _dense_lagged(X, SEQ_LEN)
+    # contiguous folds of 68, 67 and 67 rows, like KFold
+    bounds = [0, 68, 135, 202]
+    scores = np.zeros(len(alphas))
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        train = np.r_[0:lo, hi:X.shape[0]]
+        for i, alpha in enumerate(alphas):
+            coef, intercept = _ridge(dense[train], y[train], alpha)
+            scores[i] += _r2(y[lo:hi], dense[lo:hi] @ coef.T + intercept) / 3
+    np.testing.assert_allclose(fit['scores'], scores, rtol=1e-8)
+    coef, intercept = _ridge(dense, y, fit['alpha'])
+    np.testing.assert_allclose(fit['coef'], coef, rtol=1e-8, atol=1e-10)
+
+    # R² from the moments of one fold equals R² of its predictions
+    m = accumulate_moments(X, y, SEQ_LEN, bounds)[0]
+    score, = r2_from_moments(m, coef[None], intercept[None])
+    assert score == pytest.approx(_r2(y[:68], dense[:68] @ coef.T + intercept))
+
+
+def test_matches_sklearn_ridge():
+    linear_model = pytest.importorskip('sklearn.linear_model')
+    X, y = _data()
+    fit = fit_lagged_ridge(X, y, SEQ_LEN, alphas=[50.], cv=2)
+    mdl = linear_model.Ridge(alpha=50.).fit(_dense_lagged(X, SEQ_LEN), y)
+    np.testing.assert_allclose(fit['coef'], mdl.coef_, rtol=1e-6)
+    np.testing.assert_allclose(fit['intercept'], mdl.intercept_, rtol=1e-6)
@@ -2,12 +2,24 @@
 # %%
 import gc
 import logging
+import os
+import sys
 import time
 import json
 
 import numpy as np
 from brand import BRANDNode
 
+# make the cursor-control library importable
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), '..', '..',
+                 'lib', 'python'))
+from cursor_control.hooks import node_hooks
+from cursor_control.metrics import COMPUTE, WAIT
+from cursor_control.trace import NODE_IDS, TRACE_KEY, source_trace, stamp
+from cursor_control.velocity_profiles import make_profile
+
 
 class AutoCue(BRANDNode):
 
@@ -51,18 +63,14 @@ class AutoCue(BRANDNode):
             logging.error('target_list and move_list must be of equal length')
 
         # define auto-cue parameters for different velocity profiles
-        if self.vel_profile == 'triangular':
-            if 'min_speed' not in self.parameters:
-                logging.error(
-                    f"{self.vel_profile} velocity profile requires a 'min_speed' parameter"
-                )
-            self.min_speed = self.parameters['min_speed']
-        if self.vel_profile == 'gaussian':
+        profile_kwargs = {}
+        if self.vel_profile in ['triangular', 'gaussian', 'minimum_jerk']:
             if 'min_speed' not in self.parameters:
                 logging.error(
                     f"{self.vel_profile} velocity profile requires a 'min_speed' parameter"
                 )
             self.min_speed = self.parameters['min_speed']
+            profile_kwargs['min_speed'] = self.min_speed
         if self.vel_profile == 'PD':
             if 'pd_kp' not in self.parameters or 'pd_kd' not in self.parameters:
                 logging.error(
@@ -70,6 +78,17 @@ class AutoCue(BRANDNode):
                 )
             self.Kp = self.parameters['pd_kp']
             self.Kd = self.parameters['pd_kd']
+            profile_kwargs.update(kp=self.Kp,
+                                  kd=self.Kd,
+                                  tol=self.parameters['error_thres'])
+
+        # speeds are computed once per movement and looked up on each tick
+        try:
+            self.profile = make_profile(self.vel_profile, self.speed,
+                                        **profile_kwargs)
+        except ValueError as exc:
+            logging.error(exc)
+            self.profile = None
 
         logging.info(f'Velocity profile: {self.vel_profile}')
 
@@ -87,9 +106,15 @@ class AutoCue(BRANDNode):
         # define timing and sync keys
         self.sync_key = self.parameters['sync_key'].encode()
         self.time_key = self.parameters['time_key'].encode()
+        # add per-hop timestamps to each output entry
+        if 'trace' in self.parameters:
+            self.trace = self.parameters['trace']
+        else:
+            self.trace = False
+        self.hooks = node_hooks(self)
 
-        # initialize input stream entry data
-        self.input_id = '$'
+        # last ID read from the input stream, as passed to XREAD
+        self.input_ids = {self.input_stream: '$'}
 
         logging.info(
             f'Refresh triggered by input from stream: {self.input_stream}')
@@ -109,7 +134,6 @@ class AutoCue(BRANDNode):
 
         # general auto-cue parameters and utility variables
         self.error_thres = self.parameters['error_thres']
-        self.error_last = 0
         self.iter = 0
 
         self.target_init = False
@@ -124,11 +148,12 @@ class AutoCue(BRANDNode):
     def work(self):
 
         # wait for neural data input
-        replies = self.r.xread({self.input_stream: self.input_id},
-                               count=1,
-                               block=0)
+        replies = self.hooks.xread(self.r, self.input_ids, count=1)
+        t_in = time.monotonic_ns()
+        self.hooks.lap(WAIT)
         entries = replies[0][1]
-        self.input_id, entry_data = entries[0]
+        input_id, entry_data = entries[0]
+        self.input_ids[self.input_stream] = input_id
         self.label = json.loads(entry_data[self.sync_key])
 
         # get target location
@@ -202,12 +227,15 @@ class AutoCue(BRANDNode):
 
             # logging.debug(f'Target vec last: ({self.target_last_vec}) --current move vec: ({self.target_last_vec})')
             # update start position for this movement
+            new_movement = False
             if np.any(np.isnan(self.target_last_vec)):
                 self.move_start_vec = self.curr_vec
+                new_movement = True
                 logging.debug(f'New move vec start: ({self.move_start_vec})')
             elif np.linalg.norm(self.target_vec -
                                 self.target_last_vec) > self.error_thres:
                 self.move_start_vec = self.curr_vec
+                new_movement = True
                 logging.debug(f'New move vec start: ({self.move_start_vec})')
             self.target_last_vec = self.target_vec
 
@@ -220,117 +248,32 @@ class AutoCue(BRANDNode):
             #logging.debug(f'target vec: ({self.target_vec}) -- curr vec: ({self.curr_vec}) -- move start vec: ({self.move_start_vec})')
             #logging.debug(f'Total move dist: ({self.total_move_dist})')
 
-            if self.vel_profile == "constant":
-
-                if self.move_mag > self.error_thres:
-                    self.move_dir = self.move_vec / self.move_mag
-                else:
-                    self.move_dir = np.zeros(len(self.move_list),
-                                             dtype=self.move_dtype)
-
-                # if distance to target is less than constant speed delta, cap movement delta at distance to target
-                self.gain = self.move_mag if self.move_mag < self.speed else self.speed
-
-                # movement velocity to apply
-                self.move_vel = self.gain * self.move_dir
-
-            elif self.vel_profile == "triangular":
-
-                # if position is being held (i.e. for a delay)
-                if np.all(self.move_vec == self.total_move_vec):
-                    self.iter = 0
-
-                # compute move direction and triangular speed profile
-                if self.move_mag > self.error_thres and self.total_move_dist > 0:
-                    T = np.ceil(
-                        self.total_move_dist / self.speed
-                    )  # maximum number of iterations to complete movement
-                    self.move_dir = self.move_vec / self.move_mag
-                    # before halfway point
-                    if self.iter < 0.5 * T:
-                        vel_gain = self.iter / (0.25 * T)
-                    # after halfway point
-                    else:
-                        vel_gain = (T - self.iter) / (0.25 * T)
-                    self.move_speed_i = self.min_speed + (
-                        self.speed - self.min_speed) * vel_gain
-                else:
-                    self.move_dir = np.zeros(len(self.move_list),
-                                             dtype=self.target_dtype)
-                    self.move_speed_i = 0
-
-                self.iter += 1
-
-                # check if speed is below minimum threshold and set to minimum value
-                self.move_speed_i = np.maximum(self.move_speed_i,
-                                               self.min_speed)
-
-                # if distance to target is less than speed delta, cap movement delta at distance to target
-                self.gain = self.move_mag if self.move_mag < self.move_speed_i else self.move_speed_i
-
-                logging.debug(f'Movement speed: ({self.move_speed_i})')
-
-                # cursor velocity to apply
-                self.move_vel = self.gain * self.move_dir
+            # build the speed lookup table for a new movement
+            if new_movement and self.profile is not None:
+                self.profile.build(self.total_move_dist)
 
-            elif self.vel_profile == "gaussian":
+            # if position is being held (i.e. for a delay)
+            if np.all(self.move_vec == self.total_move_vec):
+                self.iter = 0
 
-                # if position is being held (i.e. for a delay)
-                if np.all(self.move_vec == self.total_move_vec):
-                    self.iter = 0
-
-                # compute move direction and triangular speed profile
-                if self.move_mag > self.error_thres and self.total_move_dist > 0:
-                    T = np.ceil(
-                        self.total_move_dist / self.speed
-                    )  # maximum number of iterations to complete movement
-                    self.move_dir = self.move_vec / self.move_mag
-
-                    # truncated gaussian parameters
-                    sigma = T / 6
-                    mu = sigma * 3
-                    # NOTE: might be good to save this value somewhere to not compute every loop
-                    scale = sum(
-                        np.exp(-((np.arange(0, T) - mu)**2 / (2 * sigma**2))) /
-                        (sigma * np.sqrt(2 * np.pi)))
-
-                    vel_gain = np.exp(-(
-                        (self.iter - mu)**2 /
-                        (2 * sigma**2))) / (sigma * np.sqrt(2 * np.pi)) / scale
-
-                    self.move_speed_i = self.min_speed + (
-                        self.speed - self.min_speed
-                    ) * vel_gain * T  # should this be T or the sample rate?
-                else:
-                    self.move_dir = np.zeros(len(self.move_list),
-                                             dtype=self.target_dtype)
-                    self.move_speed_i = 0
-
-                self.iter += 1
-
-                # check if speed is below minimum threshold and set to minimum value
-                self.move_speed_i = np.maximum(self.move_speed_i,
-                                               self.min_speed)
-
-                # if distance to target is less than speed delta, cap movement delta at distance to target
-                self.gain = self.move_mag if self.move_mag < self.move_speed_i else self.move_speed_i
-
-                logging.debug(f'Movement speed: ({self.move_speed_i})')
-
-                # cursor velocity to apply
-                self.move_vel = self.gain * self.move_dir
-
-            elif self.vel_profile == "PD":
+            # compute move direction and look up the speed for this iteration
+            if self.profile is not None and self.move_mag > self.error_thres:
+                self.move_dir = self.move_vec / self.move_mag
+                self.move_speed_i = self.profile.speed_at(self.iter)
+            else:
+                self.move_dir = np.zeros(len(self.move_list),
+                                         dtype=self.move_dtype)
+                self.move_speed_i = 0
 
-                self.d_error = self.move_vec - self.error_last
+            self.iter += 1
 
-                self.move_vel = self.Kp * self.error + self.Kd * self.d_error
+            # if distance to target is less than speed delta, cap movement delta at distance to target
+            self.gain = self.move_mag if self.move_mag < self.move_speed_i else self.move_speed_i
 
-                self.error_last = self.error
+            logging.debug(f'Movement speed: ({self.move_speed_i})')
 
-            else:
-                self.move_vel = np.zeros(len(self.move_list),
-                                         dtype=self.move_dtype)
+            # cursor velocity to apply
+            self.move_vel = self.gain * self.move_dir
 
         else:
             self.move_vel = np.zeros(len(self.move_list),
@@ -349,12 +292,21 @@ class AutoCue(BRANDNode):
                 for m, v in zip(self.move_list, self.move_vel)
             }
 
-        self.r.xadd(
-            self.output_stream, {
-                **output_kin, self.sync_key: json.dumps(self.label),
-                self.time_key: np.uint64(time.monotonic_ns()).tobytes(),
-                b'i': self.index.tobytes()
-            })
+        t_out = time.monotonic_ns()
+        output_entry = {
+            **output_kin, self.sync_key: json.dumps(self.label),
+            self.time_key: np.uint64(t_out).tobytes(),
+            b'i': self.index.tobytes()
+        }
+        if self.trace:
+            output_entry[TRACE_KEY] = stamp(
+                source_trace(entry_data, self.time_key), NODE_IDS['auto_cue'],
+                t_in, t_out)
+        self.hooks.lap(COMPUTE)
+        self.r.xadd(self.output_stream,
+                    output_entry,
+                    **self.hooks.trim(self.output_stream))
+        self.hooks.after_tick(self.input_ids)
 
         self.index += np.uint64(1)
 
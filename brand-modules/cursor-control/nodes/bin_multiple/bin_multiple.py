@@ -4,12 +4,25 @@
 import gc
 import json
 import logging
+import os
+import sys
 import time
 
 import numpy as np
 from brand import BRANDNode
 from brand.redis import xread_sync
 
+# make the cursor-control library importable
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), '..', '..',
+                 'lib', 'python'))
+from cursor_control.hooks import node_hooks
+from cursor_control.metrics import COMPUTE, WAIT
+from cursor_control.shm import node_ring_writer, redis_every
+from cursor_control.trace import (HOP, NODE_IDS, NODES, TRACE_KEY,
+                                  source_trace, stamp)
+
 
 class BinThresholds(BRANDNode):
 
@@ -25,6 +38,12 @@ class BinThresholds(BRANDNode):
         self.input_dtype = self.parameters['input_dtype']
         self.output_stream = self.parameters['output_stream']
         self.sync_field = self.parameters['sync_field']
+        # add per-hop timestamps to each output entry
+        if 'trace' in self.parameters:
+            self.trace = self.parameters['trace']
+        else:
+            self.trace = False
+        self.hooks = node_hooks(self)
 
         # initialize input stream entry data
         self.stream_dict = {name.encode(): '$' for name in self.input_streams}
@@ -46,6 +65,16 @@ class BinThresholds(BRANDNode):
             np.int8).tobytes()
         self.output_entry['i'] = self.i
 
+        # shared-memory ring buffer for the output stream if it is listed in
+        # the shm_streams parameter, and every how many entries to also write
+        # to Redis
+        self.ring = node_ring_writer(
+            self, self.output_stream,
+            [('samples', np.int8, (self.window.shape[0], )),
+             ('i', np.uint64, ()), ('ts', np.uint64, ()),
+             ('sync', 'bytes', 256), ('trace', 'bytes', HOP.size * len(NODES))])
+        self.redis_every = redis_every(self, self.output_stream)
+
         logging.info(f'Start spike binning from 1ms to {self.bin_size}ms...')
 
     def run(self):
@@ -55,6 +84,8 @@ class BinThresholds(BRANDNode):
         # count the number of entries we have read into the bin so far
         self.n_entries = 0
 
+        hooks = self.hooks
+        hooks.start()
         while True:
 
             # reset number of entries into the bin
@@ -71,9 +102,11 @@ class BinThresholds(BRANDNode):
                                      sync_dtype=np.uint32,
                                      count=self.bin_size)
             else:
-                streams = self.r.xread(self.stream_dict,
-                                       block=0,
-                                       count=self.bin_size)
+                streams = hooks.xread(self.r,
+                                      self.stream_dict,
+                                      count=self.bin_size)
+            t_in = time.monotonic_ns()
+            hooks.lap(WAIT)
             for i_stream, stream in enumerate(streams):
                 stream_name, stream_entries = stream
                 ch = slice(i_stream * self.chan_per_stream,
@@ -99,14 +132,27 @@ class BinThresholds(BRANDNode):
             sync_dict_json = json.dumps(sync_dict)
 
             # write results to Redis
-            self.output_entry[self.time_key] = np.uint64(
-                time.monotonic_ns()).tobytes()
+            t_out = time.monotonic_ns()
+            self.output_entry[self.time_key] = np.uint64(t_out).tobytes()
             self.output_entry[self.sync_key] = sync_dict_json
             self.output_entry['samples'] = self.window.sum(axis=1).astype(
                 np.int8).tobytes()
             self.output_entry['i'] = np.uint64(self.i).tobytes()
-
-            self.r.xadd(self.output_stream, self.output_entry)
+            if self.trace:
+                # continue from the last entry of the first input stream,
+                # which completed the bin
+                self.output_entry[TRACE_KEY] = stamp(
+                    source_trace(streams[0][1][-1][1], self.time_key),
+                    NODE_IDS['bin_multiple'], t_in, t_out)
+
+            hooks.lap(COMPUTE)
+            if self.ring:
+                self.ring.write(self.output_entry)
+            if self.redis_every and self.i % self.redis_every == 0:
+                self.r.xadd(self.output_stream,
+                            self.output_entry,
+                            **hooks.trim(self.output_stream))
+            hooks.after_tick(self.stream_dict)
 
             self.i += 1
 
@@ -1,14 +1,27 @@
 #!/usr/bin/env python
 import gc
+import json
 import logging
 import time
 import os
 import sys
+import threading
 from struct import unpack
 
 import numpy as np
-import pyglet
 from brand import BRANDNode
+from redis.exceptions import RedisError
+
+# make the cursor-control library importable
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), '..', '..',
+                 'lib', 'python'))
+from cursor_control.hooks import node_hooks
+from cursor_control.metrics import COMPUTE, WAIT
+from cursor_control.scene import (SCENE_FIELD, SCENE_KEY, SCENE_STREAM,
+                                  unpack_scene)
+from cursor_control.trace import NODE_IDS, TRACE_KEY, stamp
 
 # GRAPHICS
 RED = (255, 0, 0)
@@ -18,43 +31,248 @@ WHITE = (255, 255, 255)
 GRAY = (128, 128, 128)
 BLACK = (0, 0, 0)
 
+# target color for each target state
+TARGET_COLORS = {1: YELLOW, 2: GREEN, 3: RED}
+
 # state definition
 STATE_BETWEEN_TRIALS = 0
 STATE_START_TRIAL = 1
 STATE_MOVEMENT = 2
 
-if "DISPLAY" not in os.environ:
-    try:
-        with open(os.path.join(os.path.expanduser('~'), '.DISPLAY'), 'r') as f:
-            os.environ["DISPLAY"] = f.read().splitlines()[0]
-    except FileNotFoundError:
-        logging.error('No display found, exiting')
-        sys.exit(1)
-
-class PygletDisplay(BRANDNode):
-
-    def __init__(self):
+def unpack_shape(frame):
+    # decode a cursorData or targetData entry
+    ups = {
+        b'X': 'f',  # x position
+        b'Y': 'f',  # y position
+        b'radius': 'f',  # radius
+        b'state': 'i',  # state
+    }
+    shape_data = {}
+    for key, fmt in ups.items():
+        shape_data[key.decode()] = unpack(fmt, frame[key])[0]
+    return shape_data
+
+
+def sample_times(t_recv, source_ts):
+    # display-clock times of a batch of entries received together: the
+    # newest is anchored to the receive time and the others keep their
+    # spacing in the writer's timestamps, so that a batch does not look like
+    # samples taken at the same instant
+    source_ts = np.asarray(source_ts, dtype=np.int64)
+    return t_recv - np.maximum(source_ts[-1] - source_ts, 0)
+
+
+class StreamReader(threading.Thread):
+    # keeps the latest entry of each stream so that the render loop never
+    # waits on Redis
+
+    def __init__(self,
+                 r,
+                 streams,
+                 sync_key=b'sync',
+                 time_key=b'ts',
+                 block_ms=100,
+                 callbacks=None,
+                 scene_stream=None,
+                 max_backoff_s=2.):
+        super().__init__(daemon=True)
+        self.r = r
+        self.sync_key = sync_key
+        self.time_key = time_key
+        self.block_ms = block_ms
+        # longest wait between retries while Redis cannot be read
+        self.max_backoff_s = max_backoff_s
+        # functions called with (receive time, decoded entry) for each new
+        # entry of a stream, see `sample_times`
+        self.callbacks = callbacks if callbacks else {}
+        self.stream_ids = {stream: '$' for stream in streams}
+        # latest (entry ID, sync count, decoded entry, receive time, trace) of
+        # each stream, replaced (never modified) on every update so readers
+        # always see a complete entry
+        self.latest = {stream: None for stream in streams}
+        # stream of scene records, each holding the latest cursorData and
+        # targetData
+        self.scene_stream = scene_stream
+        if scene_stream is not None:
+            self.latest[b'cursorData'] = None
+            self.latest[b'targetData'] = None
+        # False while reads fail, so the render loop can tell that what it
+        # draws is no longer updated
+        self.connected = True
+        self.running = True
+
+    def update_scene(self, entry_id, data, t_recv):
+        self.set_scene(entry_id, unpack_scene(data), t_recv)
+
+    def set_scene(self, entry_id, scene, t_recv):
+        if b'cursorData' in self.callbacks:
+            self.callbacks[b'cursorData'](t_recv, scene['cursor'])
+        self.latest[b'cursorData'] = (entry_id, scene['sync'], scene['cursor'],
+                                      t_recv, scene['trace'])
+        self.latest[b'targetData'] = (entry_id, scene['sync'],
+                                      scene['targets'][0], t_recv, None)
+
+    def read(self):
+        # XREAD that retries with exponential backoff while Redis is
+        # unreachable, instead of ending the thread
+        backoff = 0.05
+        while self.running:
+            try:
+                replies = self.r.xread(self.stream_ids, block=self.block_ms)
+            except RedisError as exc:
+                if self.connected:
+                    logging.error(f'Reading {list(self.stream_ids)} failed, '
+                                  f'retrying: {exc}')
+                    self.connected = False
+                time.sleep(backoff)
+                backoff = min(2 * backoff, self.max_backoff_s)
+                continue
+            if not self.connected:
+                logging.info('Reading from Redis again')
+                self.connected = True
+            return replies
+        return []
+
+    def entry_time(self, entry_id, entry_dict):
+        # writer timestamp of an entry in ns, or the time of its entry ID
+        if self.time_key in entry_dict:
+            return int(np.frombuffer(entry_dict[self.time_key], np.uint64)[0])
+        return int(entry_id.split(b'-')[0]) * 1000000
 
-        super().__init__()
-
-        # initialize parameters
-        self.fullscreen = self.parameters['fullscreen']
-        self.window_width = self.parameters['window_width']
-        self.window_height = self.parameters['window_height']
-        self.syncbox_enable = self.parameters['syncbox']
+    def run(self):
+        while self.running:
+            replies = self.read()
+            t_recv = time.monotonic_ns()
+            for stream, entries in replies:
+                if stream == self.scene_stream:
+                    scenes = [
+                        unpack_scene(entry_dict[SCENE_FIELD])
+                        for _, entry_dict in entries
+                    ]
+                    times = sample_times(t_recv,
+                                         [scene['ts'] for scene in scenes])
+                    for (entry_id, _), scene, t in zip(entries, scenes, times):
+                        self.set_scene(entry_id, scene, int(t))
+                    self.stream_ids[stream] = entries[-1][0]
+                    continue
+                if stream in self.callbacks:
+                    times = sample_times(t_recv, [
+                        self.entry_time(entry_id, entry_dict)
+                        for entry_id, entry_dict in entries
+                    ])
+                    for (_, entry_dict), t in zip(entries, times):
+                        self.callbacks[stream](int(t),
+                                               unpack_shape(entry_dict))
+                entry_id, entry_dict = entries[-1]
+                self.stream_ids[stream] = entry_id
+                if self.sync_key in entry_dict:
+                    sync = json.loads(entry_dict[self.sync_key]).get(
+                        'count', -1)
+                else:
+                    sync = -1
+                self.latest[stream] = (entry_id, sync,
+                                       unpack_shape(entry_dict), t_recv,
+                                       entry_dict.get(TRACE_KEY))
+
+    def stop(self):
+        self.running = False
+
+
+class CursorPredictor():
+    # estimates where the cursor will be when a frame is shown, from the
+    # recent history of cursorData samples and the time they were received
+
+    def __init__(self,
+                 mode='extrapolate',
+                 history_len=4,
+                 max_horizon_ms=20,
+                 max_offset=50):
+        self.mode = mode  # 'extrapolate' or 'interpolate'
+        self.max_horizon = max_horizon_ms * 1e6  # ns
+        self.max_offset = max_offset  # pixels
+        self.t = np.zeros(history_len, dtype=np.int64)
+        self.xy = np.zeros((history_len, 2))
+        self.n = 0
+        # (t_last, xy_last, t_prev, xy_prev, velocity, interval), replaced on
+        # every sample so the render thread always sees a consistent state
+        self.state = None
+
+    def add(self, t_ns, cdict):
+        self.t[:-1] = self.t[1:]
+        self.xy[:-1] = self.xy[1:]
+        self.t[-1] = t_ns
+        self.xy[-1] = (cdict['X'], cdict['Y'])
+        self.n = min(self.n + 1, self.t.shape[0])
+        if self.n < 2:
+            self.state = (self.t[-1], self.xy[-1].copy(), self.t[-1],
+                          self.xy[-1].copy(), np.zeros(2), 0)
+            return
+        # least-squares velocity over the history, in pixels/ns
+        t = self.t[-self.n:] - self.t[-1]
+        xy = self.xy[-self.n:]
+        tc = t - t.mean()
+        denom = (tc**2).sum()
+        if denom > 0:
+            vel = (tc[:, None] * (xy - xy.mean(axis=0))).sum(axis=0) / denom
+        else:
+            vel = np.zeros(2)
+        interval = np.median(np.diff(self.t[-self.n:]))
+        self.state = (self.t[-1], self.xy[-1].copy(), self.t[-2],
+                      self.xy[-2].copy(), vel, interval)
+
+    def predict(self, t_ns):
+        if self.state is None:
+            return None
+        t_last, xy_last, t_prev, xy_prev, vel, interval = self.state
+        if self.mode == 'interpolate':
+            # render one sample interval in the past, between the last two
+            # samples
+            if t_last == t_prev:
+                return xy_last
+            alpha = (t_ns - interval - t_prev) / (t_last - t_prev)
+            alpha = min(max(alpha, 0.), 1.)
+            return xy_prev + alpha * (xy_last - xy_prev)
+        # extrapolate along the current velocity, up to the maximum horizon
+        dt = min(max(t_ns - t_last, 0), self.max_horizon)
+        offset = np.clip(vel * dt, -self.max_offset, self.max_offset)
+        return xy_last + offset
+
+
+class PygletBackend():
+    # draws the scene to a pyglet window
+
+    def __init__(self, width, height, fullscreen=True, vsync=True):
+        if "DISPLAY" not in os.environ:
+            try:
+                with open(os.path.join(os.path.expanduser('~'), '.DISPLAY'),
+                          'r') as f:
+                    os.environ["DISPLAY"] = f.read().splitlines()[0]
+            except FileNotFoundError:
+                logging.error('No display found, exiting')
+                sys.exit(1)
+        import pyglet
+        self.pyglet = pyglet
+
+        # callbacks set by the display node
+        self.on_key_press = None
+        self.on_flip = None
 
         # window setup
-        self.window = pyglet.window.Window(width=self.window_width,
-                                           height=self.window_height,
-                                           fullscreen=self.fullscreen)
-        self.x_0 = int(self.window.width / 2)
-        self.y_0 = int(self.window.height / 2)
+        self.window = pyglet.window.Window(width=width,
+                                           height=height,
+                                           fullscreen=fullscreen,
+                                           vsync=vsync)
+        self.width = self.window.width
+        self.height = self.window.height
         self.window.set_location(0, 0)
         # hide mouse
         self.window.set_mouse_visible(False)
 
-        self.on_key_press = self.window.event(self.on_key_press)
-        self.draw_stuff = self.window.event(self.draw_stuff)
+        self.window.push_handlers(on_key_press=self.key_press)
+
+        # call on_flip right after each buffer flip
+        self.window_flip = self.window.flip
+        self.window.flip = self.flip
 
         # create sprites
         self.batch = pyglet.graphics.Batch()
@@ -77,7 +295,7 @@ class PygletDisplay(BRANDNode):
                                                color=WHITE,
                                                batch=self.batch,
                                                group=self.foreground)
-        self.syncbox.y = self.window.height - self.syncbox.height
+        self.syncbox.y = self.height - self.syncbox.height
 
         # keypress label
         self.label = pyglet.text.Label(
@@ -100,12 +318,314 @@ class PygletDisplay(BRANDNode):
                                            batch=self.batch,
                                            group=self.foreground)
 
+    # Pyglet event handlers
+    def key_press(self, symbol, modifiers):
+        if symbol == self.pyglet.window.key.ESCAPE:  # [ESC]
+            self.window.close()
+        elif self.on_key_press is not None:
+            self.on_key_press(symbol, modifiers)
+
+    def flip(self):
+        self.window_flip()
+        if self.on_flip is not None:
+            self.on_flip()
+
+    def clear(self):
+        self.window.clear()
+
+    def draw(self):
+        self.batch.draw()
+
+    def run(self, draw):
+        self.pyglet.clock.schedule(draw)
+        self.pyglet.app.run()
+
+    def exit(self):
+        self.pyglet.app.exit()
+
+
+class HeadlessShape():
+    # stand-in for a pyglet shape that only keeps its properties
+
+    def __init__(self, x=0, y=0, radius=0, width=0, height=0, color=WHITE):
+        self.x = x
+        self.y = y
+        self.radius = radius
+        self.width = width
+        self.height = height
+        self.color = color
+        self.visible = True
+        self.text = ''
+
+    @property
+    def position(self):
+        return (self.x, self.y)
+
+    @position.setter
+    def position(self, position):
+        self.x, self.y = position
+
+
+class HeadlessBackend():
+    # updates the scene the same way as PygletBackend, but records each
+    # frame in memory instead of drawing it. Used to benchmark and profile
+    # the display without a GPU or X server
+
+    frame_dtype = np.dtype([
+        ('t_draw', np.uint64),
+        ('t_flip', np.uint64),
+        ('cursor_x', np.int32),
+        ('cursor_y', np.int32),
+        ('cursor_radius', np.int32),
+        ('cursor_visible', np.bool_),
+        ('target_x', np.int32),
+        ('target_y', np.int32),
+        ('target_radius', np.int32),
+        ('target_color', np.uint8, 3),
+        ('target_visible', np.bool_),
+        ('syncbox_visible', np.bool_),
+    ])
+
+    def __init__(self,
+                 width,
+                 height,
+                 frame_rate=60,
+                 frame_log_len=100000,
+                 render_image=False):
+        self.width = width
+        self.height = height
+        # frames per second, or 0 to draw as fast as possible
+        self.frame_period = int(1e9 / frame_rate) if frame_rate else 0
+
+        # callbacks set by the display node
+        self.on_key_press = None
+        self.on_flip = None
+
+        self.target = HeadlessShape(radius=40, color=RED)
+        self.syncbox = HeadlessShape(width=200, height=200, color=WHITE)
+        self.syncbox.y = self.height - self.syncbox.height
+        self.label = HeadlessShape()
+        self.cursor = HeadlessShape(radius=25, color=WHITE)
+
+        # ring buffer of frame records
+        self.frames = np.zeros(frame_log_len, dtype=self.frame_dtype)
+        self.n_frames = 0
+        self.t_draw = 0
+        # optional image of the latest frame
+        self.image = (np.zeros((height, width, 3), dtype=np.uint8)
+                      if render_image else None)
+        self.running = True
+
+    def clear(self):
+        self.t_draw = time.monotonic_ns()
+        if self.image is not None:
+            self.image[:] = 0
+
+    def draw_circle(self, shape):
+        r = int(shape.radius)
+        x0, x1 = max(shape.x - r, 0), min(shape.x + r + 1, self.width)
+        y0, y1 = max(shape.y - r, 0), min(shape.y + r + 1, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        mask = (xx - shape.x)**2 + (yy - shape.y)**2 <= r**2
+        # image rows run top to bottom, pyglet y runs bottom to top
+        rows = self.image[self.height - y1:self.height - y0, x0:x1]
+        rows[mask[::-1]] = shape.color
+
+    def draw(self):
+        frame = self.frames[self.n_frames % self.frames.shape[0]]
+        frame['t_draw'] = self.t_draw
+        frame['cursor_x'] = self.cursor.x
+        frame['cursor_y'] = self.cursor.y
+        frame['cursor_radius'] = self.cursor.radius
+        frame['cursor_visible'] = self.cursor.visible
+        frame['target_x'] = self.target.x
+        frame['target_y'] = self.target.y
+        frame['target_radius'] = self.target.radius
+        frame['target_color'] = self.target.color
+        frame['target_visible'] = self.target.visible
+        frame['syncbox_visible'] = self.syncbox.visible
+        if self.image is not None:
+            if self.target.visible:
+                self.draw_circle(self.target)
+            if self.syncbox.visible:
+                self.image[:self.syncbox.height, :self.syncbox.width] = (
+                    self.syncbox.color)
+            if self.cursor.visible:
+                self.draw_circle(self.cursor)
+
+    def flip(self):
+        frame = self.frames[self.n_frames % self.frames.shape[0]]
+        frame['t_flip'] = time.monotonic_ns()
+        self.n_frames += 1
+        if self.on_flip is not None:
+            self.on_flip()
+
+    def run(self, draw):
+        t_next = time.monotonic_ns()
+        while self.running:
+            if self.frame_period:
+                # stand-in for waiting on vsync
+                t_next += self.frame_period
+                delay = t_next - time.monotonic_ns()
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+                else:
+                    t_next = time.monotonic_ns()
+            draw()
+            self.flip()
+
+    def get_frames(self):
+        # frame records in the order they were drawn
+        n = self.frames.shape[0]
+        if self.n_frames <= n:
+            return self.frames[:self.n_frames]
+        i = self.n_frames % n
+        return np.concatenate([self.frames[i:], self.frames[:i]])
+
+    def exit(self):
+        self.running = False
+
+
+class PygletDisplay(BRANDNode):
+
+    def __init__(self):
+
+        super().__init__()
+
+        # initialize parameters
+        self.fullscreen = self.parameters['fullscreen']
+        self.window_width = self.parameters['window_width']
+        self.window_height = self.parameters['window_height']
+        self.syncbox_enable = self.parameters['syncbox']
+        if 'vsync' in self.parameters:
+            self.vsync = self.parameters['vsync']
+        else:
+            self.vsync = True
+        # number of frame records to write to Redis at once
+        if 'frame_log_batch' in self.parameters:
+            self.frame_log_batch = self.parameters['frame_log_batch']
+        else:
+            self.frame_log_batch = 10
+
+        # cursor prediction between decoder updates: 'none', 'extrapolate'
+        # or 'interpolate'
+        if 'cursor_prediction' in self.parameters:
+            self.cursor_prediction = self.parameters['cursor_prediction']
+        else:
+            self.cursor_prediction = 'none'
+        if self.cursor_prediction in ['extrapolate', 'interpolate']:
+            self.predictor = CursorPredictor(
+                mode=self.cursor_prediction,
+                history_len=self.parameters.get('prediction_history', 4),
+                max_horizon_ms=self.parameters.get('max_extrapolation_ms',
+                                                   20),
+                max_offset=self.parameters.get('max_extrapolation_px', 50))
+        else:
+            self.predictor = None
+        # whether to log rendered vs. received cursor positions
+        if 'log_cursor_prediction' in self.parameters:
+            self.log_prediction = self.parameters['log_cursor_prediction']
+        else:
+            self.log_prediction = False
+        logging.info(f'Cursor prediction: {self.cursor_prediction}')
+        # add a hop record to the trace of each cursorData entry, on the
+        # first frame that shows it
+        if 'trace' in self.parameters:
+            self.trace = self.parameters['trace']
+        else:
+            self.trace = False
+        # metrics phases of the render loop: wait is the time between frames,
+        # compute the scene update and write the buffer flip and frame log.
+        # Reads are done by the stream reader thread, so the busy_poll_us of
+        # the realtime parameter does not apply
+        self.hooks = node_hooks(self)
+
+        # rendering backend: 'pyglet' draws to a window, 'headless' only
+        # updates and records the scene
+        if 'backend' in self.parameters:
+            self.backend_name = self.parameters['backend']
+        else:
+            self.backend_name = 'pyglet'
+        if self.backend_name == 'headless':
+            self.backend = HeadlessBackend(
+                self.window_width,
+                self.window_height,
+                frame_rate=self.parameters.get('frame_rate', 60),
+                frame_log_len=self.parameters.get('headless_log_len', 100000),
+                render_image=self.parameters.get('headless_render', False))
+        else:
+            self.backend = PygletBackend(self.window_width,
+                                         self.window_height,
+                                         fullscreen=self.fullscreen,
+                                         vsync=self.vsync)
+        self.backend.on_key_press = self.on_key_press
+        # timestamp each frame right after the buffer flip
+        self.backend.on_flip = self.flip
+        logging.info(f'Display backend: {self.backend_name}')
+
+        self.x_0 = int(self.backend.width / 2)
+        self.y_0 = int(self.backend.height / 2)
+
+        # scene
+        self.target = self.backend.target
+        self.syncbox = self.backend.syncbox
+        self.syncbox.visible = False
+        self.label = self.backend.label
+        self.cursor = self.backend.cursor
+
+        # shapes are hidden until the first entries arrive
+        self.target.visible = False
+        self.cursor.visible = False
+
         # define timing and sync keys
         self.sync_key = self.parameters['sync_key'].encode()
         self.time_key = self.parameters['time_key'].encode()
 
-        self.last_id = b'0-0'
-        self.first_read = True
+        # read the scene records of radialFSM (its `scene` parameter) instead
+        # of cursorData and targetData: one stream and one packed field per
+        # update, for displays on another machine than radialFSM
+        if 'scene' in self.parameters:
+            self.scene = self.parameters['scene']
+        else:
+            self.scene = False
+
+        # cursor and target state are fetched in the background
+        callbacks = {}
+        if self.predictor is not None:
+            callbacks[b'cursorData'] = self.predictor.add
+        if self.scene:
+            self.reader = StreamReader(self.r, [SCENE_STREAM],
+                                       callbacks=callbacks,
+                                       scene_stream=SCENE_STREAM)
+            # start from the latest scene, under ID 0-0 since it has no entry
+            # ID, instead of waiting for the next tick
+            scene = self.r.get(SCENE_KEY)
+            if scene is not None:
+                self.reader.update_scene(b'0-0', scene, time.monotonic_ns())
+        else:
+            self.reader = StreamReader(self.r,
+                                       [b'cursorData', b'targetData'],
+                                       sync_key=self.sync_key,
+                                       time_key=self.time_key,
+                                       callbacks=callbacks)
+        self.cursor_entry = None
+        self.target_entry = None
+        self.cdict = None
+        self.tdict = None
+        self.cursor_rendered = None
+
+        # flip timing, used to predict when the next frame will be shown
+        self.t_flip_last = 0
+        self.frame_period = 0
+
+        # per-frame records, written to Redis in batches
+        self.frame = np.uint64(0)
+        self.frame_entry = None
+        self.frame_log = []
+        # (trace, receive time) of a cursor entry not yet shown
+        self.cursor_trace = None
 
     # Getting data from Redis
     def get_mouse_position(self):
@@ -116,110 +636,185 @@ class PygletDisplay(BRANDNode):
 
     # Getting data from Redis
     def get_cursor(self):
-        reply = self.r.xread(streams={'cursorData': '$'}, count=1, block=0)
-        cursorFrame = reply[0][1][0][1]
-        ups = {
-            b'X': 'f',  # x position
-            b'Y': 'f',  # y position
-            b'radius': 'f',  # radius
-            b'state': 'i'  # state
-        }
-        keys = [b'X', b'Y', b'radius', b'state']
-
-        cursor_data = {}
-        for key in keys:
-            cursor_data[key.decode()] = unpack(ups[key], cursorFrame[key])[0]
-        # print(f'cursor_data: {cursor_data}')  # for debugging
-        return cursor_data
+        return self.reader.latest[b'cursorData']
 
     def get_target(self):
-        reply = self.r.xread(streams={'targetData': '$'}, count=1, block=0)
-        targetFrame = reply[0][1][0][1]
-        ups = {
-            b'X': 'f',  # x position
-            b'Y': 'f',  # y position
-            b'radius': 'f',  # width
-            b'state': 'i',  # state: hidden (0), yellow (1), green (2), red (3)
-        }  # un-pack string
-        keys = [b'X', b'Y', b'radius', b'state']
-
-        target_data = {}
-        for key in keys:
-            target_data[key.decode()] = unpack(ups[key], targetFrame[key])[0]
-        # print(f'target_data: {target_data}')  # for debugging
-        return target_data
+        return self.reader.latest[b'targetData']
 
-    # Pyglet event handlers
-    def on_key_press(self, symbol, modifiers):
-        if symbol == pyglet.window.key.ESCAPE:  # [ESC]
-            self.window.close()
-        else:
-            self.r.xadd(
-                b'keypress', {
-                    b'symbol': self.label.text,
-                    self.time_key: np.uint64(time.monotonic_ns()).tobytes()
-                })
-
-    def draw_stuff(self, *args):
-        self.window.clear()
-
-        self.tdict = self.get_target()
-        self.cdict = self.get_cursor()
+    def write_frame_log(self):
+        p = self.r.pipeline(transaction=False)
+        trim = self.hooks.trim(b'display_sync_pulse')
+        for entry in self.frame_log:
+            p.xadd(b'display_sync_pulse', entry, **trim)
+        p.execute()
+        self.frame_log.clear()
 
+    def update_cursor(self, cdict):
         # cursor position
-        self.cursor.x, self.cursor.y = int(self.cdict['X'] +
-                                           self.x_0), int(self.cdict['Y'] +
-                                                          self.y_0)
+        self.set_cursor_position(cdict['X'], cdict['Y'])
 
+        # cursor shape
+        radius = int(cdict['radius'])
+        if radius != self.cursor.radius:
+            self.cursor.radius = radius
+
+        if not self.cursor.visible:
+            self.cursor.visible = True
+
+    def set_cursor_position(self, x, y):
+        position = (int(x + self.x_0), int(y + self.y_0))
+        if position != self.cursor.position:
+            self.cursor.position = position
+
+    def next_flip_time(self, t_now):
+        # estimated time of the vsync that will show the frame being drawn
+        if not self.frame_period:
+            return t_now
+        t_next = self.t_flip_last + self.frame_period
+        if t_next < t_now:
+            n_missed = (t_now - t_next) // self.frame_period + 1
+            t_next += n_missed * self.frame_period
+        return t_next
+
+    def update_target(self, tdict):
         # target position
-        self.target.x, self.target.y = int(self.tdict['X'] +
-                                           self.x_0), int(self.tdict['Y'] +
-                                                          self.y_0)
+        position = (int(tdict['X'] + self.x_0), int(tdict['Y'] + self.y_0))
+        if position != self.target.position:
+            self.target.position = position
 
         # target color
-        if self.tdict['state'] == 1:
-            self.target.color = YELLOW
-        elif self.tdict['state'] == 2:
-            self.target.color = GREEN
-        elif self.tdict['state'] == 3:
-            self.target.color = RED
+        color = TARGET_COLORS.get(tdict['state'], self.target.color)
+        if tuple(color) != tuple(self.target.color):
+            self.target.color = color
 
         # target visibility
-        if self.tdict['state'] == 0:
-            self.target.visible = False
-            self.syncbox.visible = False and self.syncbox_enable
-        else:
-            self.target.visible = True
-            self.syncbox.visible = True and self.syncbox_enable
+        visible = tdict['state'] != 0
+        if visible != self.target.visible:
+            self.target.visible = visible
+            self.syncbox.visible = visible and self.syncbox_enable
 
         #self.center_mark.visible = self.center_mark_enable
 
-        # cursor shape
-        self.cursor.radius = int(self.cdict['radius'])
-
         # target shape
-        self.target.radius = int(self.tdict['radius'])
+        radius = int(tdict['radius'])
+        if radius != self.target.radius:
+            self.target.radius = radius
 
-        # log sync pulse state
+    # Pyglet event handlers
+    def on_key_press(self, symbol, modifiers):
         self.r.xadd(
-            b'display_sync_pulse', {
-                b'state': self.tdict['state'],
+            b'keypress', {
+                b'symbol': self.label.text,
                 self.time_key: np.uint64(time.monotonic_ns()).tobytes()
-            })
+            }, **self.hooks.trim(b'keypress'))
 
-        self.batch.draw()
+    def draw_stuff(self, *args):
+        self.hooks.lap(WAIT)
+        t_draw = np.uint64(time.monotonic_ns())
+        self.backend.clear()
+
+        # only read cached values here, and only touch the shapes when a new
+        # entry has arrived and its values differ from what is on screen
+        cursor_entry = self.get_cursor()
+        target_entry = self.get_target()
+        if cursor_entry is not self.cursor_entry and cursor_entry is not None:
+            cdict = cursor_entry[2]
+            if self.cdict is None or cdict != self.cdict:
+                self.update_cursor(cdict)
+            self.cursor_entry, self.cdict = cursor_entry, cdict
+            if self.trace and cursor_entry[4] is not None:
+                self.cursor_trace = (cursor_entry[4], cursor_entry[3])
+        if target_entry is not self.target_entry and target_entry is not None:
+            tdict = target_entry[2]
+            if self.tdict is None or tdict != self.tdict:
+                self.update_target(tdict)
+            self.target_entry, self.tdict = target_entry, tdict
+
+        # move the cursor to where it is expected to be at the next vsync
+        if self.predictor is not None and self.cdict is not None:
+            xy = self.predictor.predict(self.next_flip_time(int(t_draw)))
+            if xy is not None:
+                self.set_cursor_position(xy[0], xy[1])
+                self.cursor_rendered = xy
+
+        self.backend.draw()
+        self.hooks.lap(COMPUTE)
+
+        if self.tdict is None or self.cdict is None:
+            return
+
+        # record what this frame shows. The post-flip timestamp is added in
+        # flip()
+        self.frame_entry = {
+            b'state': self.tdict['state'],
+            self.time_key: t_draw.tobytes(),
+            b'frame': self.frame.tobytes(),
+            b'cursor_id': self.cursor_entry[0],
+            b'target_id': self.target_entry[0],
+            b'cursor_sync': np.int64(self.cursor_entry[1]).tobytes(),
+            b'target_sync': np.int64(self.target_entry[1]).tobytes(),
+            b't_draw': t_draw.tobytes(),
+        }
+        if self.log_prediction:
+            rendered = (self.cursor_rendered if self.cursor_rendered
+                        is not None else (self.cdict['X'], self.cdict['Y']))
+            self.frame_entry[b'X_true'] = np.float32(self.cdict['X']).tobytes()
+            self.frame_entry[b'Y_true'] = np.float32(self.cdict['Y']).tobytes()
+            self.frame_entry[b'X_rendered'] = np.float32(
+                rendered[0]).tobytes()
+            self.frame_entry[b'Y_rendered'] = np.float32(
+                rendered[1]).tobytes()
+
+    def flip(self):
+        t_flip = np.uint64(time.monotonic_ns())
+
+        # running estimate of the frame period
+        if self.t_flip_last:
+            period = int(t_flip) - self.t_flip_last
+            if not self.frame_period:
+                self.frame_period = period
+            else:
+                self.frame_period += (period - self.frame_period) // 16
+        self.t_flip_last = int(t_flip)
+
+        if self.frame_entry is not None:
+            self.log_frame(t_flip)
+        self.hooks.after_tick()
+
+    def log_frame(self, t_flip):
+        self.frame_entry[b't_flip'] = t_flip.tobytes()
+        if self.cursor_trace is not None:
+            trace, t_recv = self.cursor_trace
+            self.frame_entry[TRACE_KEY] = stamp(trace,
+                                                NODE_IDS['display_centerOut'],
+                                                t_recv, int(t_flip))
+            self.cursor_trace = None
+        self.frame_log.append(self.frame_entry)
+        self.frame_entry = None
+        self.frame += np.uint64(1)
+
+        # log sync pulse state
+        if len(self.frame_log) >= self.frame_log_batch:
+            self.write_frame_log()
 
     def terminate(self, sig, frame):
-        pyglet.app.exit()
+        self.reader.stop()
+        if self.frame_log:
+            self.write_frame_log()
+        if (self.backend_name == 'headless'
+                and 'headless_log_path' in self.parameters):
+            np.save(self.parameters['headless_log_path'],
+                    self.backend.get_frames())
+        self.backend.exit()
         super().terminate(sig, frame)
 
     def run(self):
 
-        logging.info('Starting pyglet display...')
+        logging.info(f'Starting {self.backend_name} display...')
 
-        pyglet.clock.schedule(self.draw_stuff)
+        self.reader.start()
 
-        pyglet.app.run()
+        self.backend.run(self.draw_stuff)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# lag_watchdog.py
+import gc
+import logging
+import os
+import sys
+
+from brand import BRANDNode
+
+# make the cursor-control library importable
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), '..', '..',
+                 'lib', 'python'))
+from cursor_control.lag import LagWatchdog
+
+
+class Watchdog(BRANDNode):
+
+    def __init__(self):
+        super().__init__()
+
+        # alert when a node is more than max_lag_ms behind its input
+        if 'max_lag_ms' in self.parameters:
+            self.max_lag_ms = self.parameters['max_lag_ms']
+        else:
+            self.max_lag_ms = 100
+        # alert when a node is more than max_entries behind its input
+        if 'max_entries' in self.parameters:
+            self.max_entries = self.parameters['max_entries']
+        else:
+            self.max_entries = None
+        # alert when an input has had no new entry for max_age_ms
+        if 'max_age_ms' in self.parameters:
+            self.max_age_ms = self.parameters['max_age_ms']
+        else:
+            self.max_age_ms = None
+        # alert when a node has not reported its lag for stale_s seconds
+        if 'stale_s' in self.parameters:
+            self.stale_s = self.parameters['stale_s']
+        else:
+            self.stale_s = 5.
+        # switch nodes that are behind for `after` reports in a row to
+        # skip-to-latest, when they are more than skip_ms behind. Not set:
+        # never switch
+        if 'skip_ms' in self.parameters:
+            self.skip_ms = self.parameters['skip_ms']
+        else:
+            self.skip_ms = None
+        if 'after' in self.parameters:
+            self.after = self.parameters['after']
+        else:
+            self.after = 3
+
+        self.watchdog = LagWatchdog(self.r,
+                                    max_lag_ms=self.max_lag_ms,
+                                    max_entries=self.max_entries,
+                                    max_age_ms=self.max_age_ms,
+                                    stale_s=self.stale_s,
+                                    skip_ms=self.skip_ms,
+                                    after=self.after)
+        logging.info('Watching consumer lag')
+
+    def run(self):
+        self.watchdog.run()
+
+    def terminate(self, sig, frame):
+        # leave no node in skip-to-latest mode
+        self.watchdog.close()
+        super().terminate(sig, frame)
+
+
+if __name__ == "__main__":
+    gc.disable()
+
+    # setup
+    watchdog = Watchdog()
+
+    # main
+    watchdog.run()
+
+    gc.collect()
@@ -15,12 +15,25 @@ graphics controller.
 import gc
 import json
 import logging
+import os
+import sys
 import time
 from struct import pack
 
 import numpy as np
 from brand import BRANDNode
 
+# make the cursor-control library importable
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), '..', '..',
+                 'lib', 'python'))
+from cursor_control.hooks import node_hooks
+from cursor_control.metrics import COMPUTE, WAIT
+from cursor_control.scene import (SCENE_FIELD, SCENE_KEY, SCENE_STREAM,
+                                  ScenePacker)
+from cursor_control.trace import NODE_IDS, TRACE_KEY, source_trace, stamp
+
 
 # defining the cursors, targets etc
 # define target
@@ -277,10 +290,25 @@ class RadialFSM(BRANDNode):
         # initialize stream info
 
         self.input_stream = self.parameters['input_stream'].encode()
-        self.mouse_id = '$'
+        # last ID read from the input stream, as passed to XREAD
+        self.input_ids = {self.input_stream: '$'}
 
         self.sync_key = self.parameters['sync_key'].encode()
         self.time_key = self.parameters['time_key'].encode()
+        # add per-hop timestamps to each cursorData entry
+        if 'trace' in self.parameters:
+            self.trace = self.parameters['trace']
+        else:
+            self.trace = False
+        # also write the cursor, target and state of each tick as one packed
+        # record to the scene stream and the scene_latest key, for displays
+        # on other machines
+        if 'scene' in self.parameters:
+            self.scene = self.parameters['scene']
+        else:
+            self.scene = False
+        self.scene_packer = ScenePacker() if self.scene else None
+        self.hooks = node_hooks(self)
 
         self.sync_dict = {}
         self.sync_dict_json = json.dumps(self.sync_dict)
@@ -337,15 +365,19 @@ class RadialFSM(BRANDNode):
 
         logging.info('Starting center-out FSM')
 
+        hooks = self.hooks
+        trim = hooks.trim
+        hooks.start()
         # main loop
         while True:
 
             # read from cursor control stream
-            reply = self.r.xread({self.input_stream: self.mouse_id},
-                                 block=0,
-                                 count=1)
+            reply = hooks.xread(self.r, self.input_ids, count=1)
+            t_in = time.monotonic_ns()
+            hooks.lap(WAIT)
             entries = reply[0][1]
-            self.mouse_id, cursorFrame = entries[0]
+            entry_id, cursorFrame = entries[0]
+            self.input_ids[self.input_stream] = entry_id
 
             # pulling data in
             sync_dict_in = json.loads(cursorFrame[self.sync_key].decode())
@@ -413,7 +445,7 @@ class RadialFSM(BRANDNode):
                     self.trial_count += 1
                     self.state_time = self.curr_time
                     self.state_entry[b'state'] = 'start_time'
-                    p.xadd(b'state', self.state_entry)
+                    p.xadd(b'state', self.state_entry, **trim(b'state'))
                     self.trial_info_entry[b'target_X'] = pack('f', self.tgt.x)
                     self.trial_info_entry[b'target_Y'] = pack('f', self.tgt.y)
                     self.trial_info_entry[b'start_X'] = pack(
@@ -429,7 +461,9 @@ class RadialFSM(BRANDNode):
                         'f', self.curs.radius)
                     self.trial_info_entry[b'dwell_time'] = pack(
                         'f', self.target_hold_time)
-                    p.xadd(b'trial_info', self.trial_info_entry)
+                    p.xadd(b'trial_info',
+                           self.trial_info_entry,
+                           **trim(b'trial_info'))
                     logging.info(
                         f'{self.trial_count} - New trial started, '
                         f'reaching for target [{self.tgt.x},{self.tgt.y}]')
@@ -454,10 +488,12 @@ class RadialFSM(BRANDNode):
                     self.tgt.off()
                     self.state_time = self.curr_time
                     self.state_entry[b'state'] = 'end_time'
-                    p.xadd(b'state', self.state_entry)
+                    p.xadd(b'state', self.state_entry, **trim(b'state'))
                     self.trial_success_entry[b'success'] = np.uint8(
                         0).tobytes()
-                    p.xadd(b'trial_success', self.trial_success_entry)
+                    p.xadd(b'trial_success',
+                           self.trial_success_entry,
+                           **trim(b'trial_success'))
                     logging.info(f'{self.trial_count} - Moved during delay'
                                  ', starting new trial')
                     # revert to previous target
@@ -474,7 +510,7 @@ class RadialFSM(BRANDNode):
                     self.state_time = self.curr_time
                     self.last_out_of_target_time = self.curr_time
                     self.state_entry[b'state'] = 'go_cue_time'
-                    p.xadd(b'state', self.state_entry)
+                    p.xadd(b'state', self.state_entry, **trim(b'state'))
                     logging.info(f'{self.trial_count} - Trial go cue')
 
             elif self.state == STATE_MOVEMENT:
@@ -484,10 +520,12 @@ class RadialFSM(BRANDNode):
                     self.tgt.off()
                     self.state_time = self.curr_time
                     self.state_entry[b'state'] = 'end_time'
-                    p.xadd(b'state', self.state_entry)
+                    p.xadd(b'state', self.state_entry, **trim(b'state'))
                     self.trial_success_entry[b'success'] = np.uint8(
                         0).tobytes()
-                    p.xadd(b'trial_success', self.trial_success_entry)
+                    p.xadd(b'trial_success',
+                           self.trial_success_entry,
+                           **trim(b'trial_success'))
                     logging.info(
                         f'{self.trial_count} - Timeout, starting new trial')
                     if self.recenter_on_fail:
@@ -509,10 +547,14 @@ class RadialFSM(BRANDNode):
                             self.tgt.off()
                             self.state_time = self.curr_time
                             self.state_entry[b'state'] = 'end_time'
-                            p.xadd(b'state', self.state_entry)
+                            p.xadd(b'state',
+                                   self.state_entry,
+                                   **trim(b'state'))
                             self.trial_success_entry[b'success'] = np.uint8(
                                 1).tobytes()
-                            p.xadd(b'trial_success', self.trial_success_entry)
+                            p.xadd(b'trial_success',
+                                   self.trial_success_entry,
+                                   **trim(b'trial_success'))
                             logging.info(
                                 f'{self.trial_count} - Target '
                                 f'[{self.tgt.x},{self.tgt.y}] acquired'
@@ -527,16 +569,31 @@ class RadialFSM(BRANDNode):
                         # reset the time over the target
                         self.last_out_of_target_time = self.curr_time
 
-            p.xadd(
-                b'cursorData',
-                self.curs.pack(self.i, self.sync_dict, self.sync_key,
-                               self.time_key))
-            p.xadd(
-                b'targetData',
-                self.tgt.pack(self.i, self.sync_dict, self.sync_key,
-                              self.time_key))
-
+            cursor_entry = self.curs.pack(self.i, self.sync_dict,
+                                          self.sync_key, self.time_key)
+            if self.trace:
+                cursor_entry[TRACE_KEY] = stamp(
+                    source_trace(cursorFrame, self.time_key),
+                    NODE_IDS['radialFSM'], t_in, time.monotonic_ns())
+            p.xadd(b'cursorData', cursor_entry, **trim(b'cursorData'))
+            p.xadd(b'targetData',
+                   self.tgt.pack(self.i, self.sync_dict, self.sync_key,
+                                 self.time_key),
+                   **trim(b'targetData'))
+            if self.scene_packer:
+                scene = self.scene_packer.pack(self.i, self.state,
+                                               self.sync_dict, self.curs,
+                                               [self.tgt],
+                                               cursor_entry.get(TRACE_KEY))
+                p.xadd(SCENE_STREAM, {SCENE_FIELD: scene},
+                       **trim(SCENE_STREAM))
+                p.set(SCENE_KEY, scene)
+
+            hooks.lap(COMPUTE)
             p.execute()
+            # collect between trials, after this tick's outputs are out
+            hooks.after_tick(self.input_ids,
+                             safe_point=self.state == STATE_BETWEEN_TRIALS)
 
             self.i += 1
 
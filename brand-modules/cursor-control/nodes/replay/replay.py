@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# replay.py
+import gc
+import logging
+import os
+import sys
+import time
+
+from brand import BRANDNode
+
+# make the cursor-control library importable
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), '..', '..',
+                 'lib', 'python'))
+from cursor_control.hooks import node_hooks
+from cursor_control.replay import Replayer
+
+
+class Replay(BRANDNode):
+
+    def __init__(self):
+        super().__init__()
+
+        # directory written by cursor_control.recorder, or pickled session
+        self.session = os.path.expanduser(self.parameters['session'])
+        # streams to replay
+        if 'streams' in self.parameters:
+            self.streams = self.parameters['streams']
+        else:
+            self.streams = ['threshold_values']
+        # speed-up relative to the recorded timing, 0 for as fast as possible
+        if 'speed' in self.parameters:
+            self.speed = self.parameters['speed']
+        else:
+            self.speed = 1.
+        # time (us) before each batch is due spent spinning instead of
+        # sleeping
+        if 'spin_us' in self.parameters:
+            self.spin_us = self.parameters['spin_us']
+        else:
+            self.spin_us = 200
+        # entries due within batch_us of each other are written in one
+        # pipeline, of at most max_batch entries
+        if 'batch_us' in self.parameters:
+            self.batch_us = self.parameters['batch_us']
+        else:
+            self.batch_us = 500
+        if 'max_batch' in self.parameters:
+            self.max_batch = self.parameters['max_batch']
+        else:
+            self.max_batch = 256
+        # uint64 field (ns) to pace by instead of the entry IDs (ms)
+        if 'time_field' in self.parameters:
+            self.time_field = self.parameters['time_field']
+        else:
+            self.time_field = None
+        # recorded time (s) to start and stop at
+        if 'start_s' in self.parameters:
+            self.start_s = self.parameters['start_s']
+        else:
+            self.start_s = 0.
+        if 'stop_s' in self.parameters:
+            self.stop_s = self.parameters['stop_s']
+        else:
+            self.stop_s = None
+        # prefix added to the replayed stream names
+        if 'prefix' in self.parameters:
+            self.prefix = self.parameters['prefix']
+        else:
+            self.prefix = ''
+        # batches written more than tolerance_ms late are reported every
+        # report_interval seconds
+        if 'tolerance_ms' in self.parameters:
+            self.tolerance_ms = self.parameters['tolerance_ms']
+        else:
+            self.tolerance_ms = 1.
+        if 'report_interval' in self.parameters:
+            self.report_interval = self.parameters['report_interval']
+        else:
+            self.report_interval = 1.
+
+        self.hooks = node_hooks(self)
+
+        self.replayer = Replayer(
+            self.r,
+            self.session,
+            streams=self.streams,
+            speed=self.speed,
+            spin_us=self.spin_us,
+            batch_us=self.batch_us,
+            max_batch=self.max_batch,
+            time_field=self.time_field,
+            start_s=self.start_s,
+            stop_s=self.stop_s,
+            prefix=self.prefix,
+            trim=self.hooks.trim,
+            report_stream=f'{self.NAME}_timing',
+            report_interval=self.report_interval,
+            tolerance_ms=self.tolerance_ms,
+            hooks=self.hooks)
+        pace = (f'at {self.speed}x speed'
+                if self.speed else 'as fast as possible')
+        logging.info(f'Replaying {self.streams} from {self.session} {pace}')
+
+    def run(self):
+        t = time.monotonic()
+        n = self.replayer.run()
+        logging.info(f'Replayed {n} entries '
+                     f'({self.replayer.position_ns / 1e9:.3f} s recorded) in '
+                     f'{time.monotonic() - t:.3f} s')
+
+
+if __name__ == "__main__":
+    gc.disable()
+
+    # setup
+    replay = Replay()
+
+    # main
+    replay.run()
+
+    gc.collect()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# session_recorder.py
+import gc
+import logging
+import os
+import sys
+import time
+
+from brand import BRANDNode
+
+# make the cursor-control library importable
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), '..', '..',
+                 'lib', 'python'))
+from cursor_control.hooks import node_hooks
+from cursor_control.recorder import SessionRecorder
+
+
+class Recorder(BRANDNode):
+
+    def __init__(self):
+        super().__init__()
+
+        # directory to write the session to. Recording resumes if it already
+        # holds a partial session
+        self.session_dir = os.path.expanduser(self.parameters['session_dir'])
+        # streams to record, or all streams if not set
+        if 'streams' in self.parameters:
+            self.streams = self.parameters['streams']
+        else:
+            self.streams = None
+        if 'exclude_streams' in self.parameters:
+            self.exclude_streams = self.parameters['exclude_streams']
+        else:
+            self.exclude_streams = []
+        # '$' to record only entries added after startup, '0' for all
+        if 'start_id' in self.parameters:
+            self.start_id = str(self.parameters['start_id'])
+        else:
+            self.start_id = '$'
+        # entries read per XRANGE call
+        if 'count' in self.parameters:
+            self.count = self.parameters['count']
+        else:
+            self.count = 1000
+        # entries per chunk file
+        if 'chunk_size' in self.parameters:
+            self.chunk_size = self.parameters['chunk_size']
+        else:
+            self.chunk_size = 10000
+        # maximum time (s) between writes of a stream's buffered entries
+        if 'flush_interval' in self.parameters:
+            self.flush_interval = self.parameters['flush_interval']
+        else:
+            self.flush_interval = 10.
+        # time (s) to wait when no stream has new entries
+        if 'poll_interval' in self.parameters:
+            self.poll_interval = self.parameters['poll_interval']
+        else:
+            self.poll_interval = 0.1
+        # trim recorded entries from Redis, keeping the last keep_s seconds
+        # of each stream. Not set: never trim
+        if 'keep_s' in self.parameters:
+            self.keep_s = self.parameters['keep_s']
+        else:
+            self.keep_s = None
+
+        self.hooks = node_hooks(self)
+
+        self.recorder = SessionRecorder(
+            self.r,
+            self.session_dir,
+            streams=self.streams,
+            exclude_streams=self.exclude_streams,
+            start_id=self.start_id,
+            count=self.count,
+            chunk_size=self.chunk_size,
+            flush_interval=self.flush_interval,
+            keep_s=self.keep_s)
+        logging.info(f'Recording to {self.session_dir}')
+
+    def run(self):
+        hooks = self.hooks
+        hooks.start()
+        while True:
+            if self.recorder.poll() == 0:
+                time.sleep(self.poll_interval)
+            # a poll both reads and writes, so it is all timed as the write
+            # phase
+            hooks.after_tick()
+
+    def terminate(self, sig, frame):
+        # read what is left in the streams and write it to disk
+        self.recorder.drain()
+        self.recorder.close()
+        logging.info(f'Saved session to {self.session_dir}')
+        super().terminate(sig, frame)
+
+
+if __name__ == "__main__":
+    gc.disable()
+
+    # setup
+    recorder = Recorder()
+
+    # main
+    recorder.run()
+
+    gc.collect()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# spike_generator.py
+import gc
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+from brand import BRANDNode
+
+# make the cursor-control library importable
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), '..', '..',
+                 'lib', 'python'))
+from cursor_control.hooks import node_hooks
+from cursor_control.metrics import COMPUTE, WAIT
+from cursor_control.spike_generator import SpikeGenerator
+
+
+class SpikeGeneratorNode(BRANDNode):
+
+    def __init__(self):
+        super().__init__()
+
+        # initialize parameters
+        self.n_channels = self.parameters['n_channels']
+        self.sample_rate = self.parameters['sample_rate']
+        if 'output_stream' in self.parameters:
+            self.output_stream = self.parameters['output_stream'].encode()
+        else:
+            self.output_stream = b'threshold_values'
+        if 'output_field' in self.parameters:
+            self.output_field = self.parameters['output_field'].encode()
+        else:
+            self.output_field = b'thresholds'
+        # samples packed into each entry. bin_multiple reads one sample per
+        # entry
+        if 'samples_per_entry' in self.parameters:
+            self.samples_per_entry = self.parameters['samples_per_entry']
+        else:
+            self.samples_per_entry = 1
+        # samples written per pipeline, by default 1 ms worth
+        if 'batch_size' in self.parameters:
+            self.batch_size = self.parameters['batch_size']
+        else:
+            self.batch_size = max(int(self.sample_rate // 1000), 1)
+        self.batch_size = max(
+            self.batch_size // self.samples_per_entry * self.samples_per_entry,
+            self.samples_per_entry)
+        # largest batch written when catching up, and the backlog (s) after
+        # which samples are dropped instead
+        self.max_batch = 16 * self.batch_size
+        if 'max_backlog' in self.parameters:
+            self.max_backlog = self.parameters['max_backlog']
+        else:
+            self.max_backlog = 1.
+
+        # rate model: 'poisson' or 'cosine'
+        if 'model' in self.parameters:
+            self.model = self.parameters['model']
+        else:
+            self.model = 'poisson'
+        # velocity stream driving cosine-tuned rates
+        if 'velocity_stream' in self.parameters:
+            self.velocity_stream = self.parameters['velocity_stream']
+        else:
+            self.velocity_stream = None
+        if 'velocity_field' in self.parameters:
+            self.velocity_field = self.parameters['velocity_field'].encode()
+        else:
+            self.velocity_field = b'samples'
+        if 'velocity_dtype' in self.parameters:
+            self.velocity_dtype = self.parameters['velocity_dtype']
+        else:
+            self.velocity_dtype = 'float32'
+
+        self.generator = SpikeGenerator(
+            self.n_channels,
+            self.sample_rate,
+            model=self.model,
+            baseline_rate=self.parameters.get('baseline_rate', 10.),
+            modulation_rate=self.parameters.get('modulation_rate', 20.),
+            max_speed=self.parameters.get('max_speed', 1.),
+            pool_size=max(self.parameters.get('pool_size', 2048),
+                          self.max_batch),
+            max_batch=self.max_batch,
+            seed=self.parameters.get('random_seed', None))
+
+        # define timing and sync keys
+        if 'sync_key' in self.parameters:
+            self.sync_key = self.parameters['sync_key'].encode()
+        else:
+            self.sync_key = b'sync'
+        if 'time_key' in self.parameters:
+            self.time_key = self.parameters['time_key'].encode()
+        else:
+            self.time_key = b'ts'
+
+        self.hooks = node_hooks(self)
+
+        # output entry, updated in place for every entry of a batch
+        self.entry = {
+            self.output_field: b'',
+            self.sync_key: b'',
+            self.time_key: b'',
+        }
+        self.i = 0
+
+        logging.info(f'Generating {self.model} threshold crossings on '
+                     f'{self.n_channels} channels at {self.sample_rate} Hz, '
+                     f'{self.batch_size} samples per write')
+
+    def update_velocity(self, reply):
+        # reply to XREVRANGE on the velocity stream
+        if reply:
+            velocity = np.frombuffer(reply[0][1][self.velocity_field],
+                                     dtype=self.velocity_dtype)
+            self.generator.set_velocity(velocity[0], velocity[1])
+
+    def run(self):
+        spe = self.samples_per_entry
+        entry = self.entry
+        hooks = self.hooks
+        p = self.r.pipeline(transaction=False)
+        t0 = time.monotonic_ns()
+        n_sent = 0
+        hooks.start()
+        while True:
+            n_due = int((time.monotonic_ns() - t0) * self.sample_rate // 10**9)
+            n_due -= n_sent
+            if n_due < self.batch_size:
+                time.sleep((self.batch_size - n_due) / self.sample_rate)
+                continue
+            if n_due > self.max_backlog * self.sample_rate:
+                logging.warning(f'{n_due} samples behind, dropping them')
+                n_sent += n_due
+                continue
+            hooks.lap(WAIT)
+
+            n = min(n_due, self.max_batch) // spe * spe
+            spikes = self.generator.generate(n)
+            ts = np.uint64(time.monotonic_ns()).tobytes()
+            entry[self.time_key] = ts
+            trim = hooks.trim(self.output_stream)
+            for k in range(0, n, spe):
+                entry[self.output_field] = spikes[k:k + spe].tobytes()
+                entry[self.sync_key] = b'{"count": %d}' % self.i
+                p.xadd(self.output_stream, entry, **trim)
+                self.i += 1
+            # read the velocity for the next batch in the same round trip
+            if self.velocity_stream:
+                p.xrevrange(self.velocity_stream, '+', '-', count=1)
+            hooks.lap(COMPUTE)
+            replies = p.execute()
+            if self.velocity_stream:
+                self.update_velocity(replies[-1])
+            hooks.after_tick()
+            n_sent += n
+
+
+if __name__ == "__main__":
+    gc.disable()
+
+    # setup
+    spike_generator = SpikeGeneratorNode()
+
+    # main
+    spike_generator.run()
+
+    gc.collect()
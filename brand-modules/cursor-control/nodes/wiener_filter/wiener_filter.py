@@ -13,6 +13,16 @@ import numpy as np
 from brand import BRANDNode
 from sklearn.linear_model import Ridge
 
+# make the cursor-control library importable
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), '..', '..',
+                 'lib', 'python'))
+from cursor_control.hooks import node_hooks
+from cursor_control.metrics import COMPUTE, WAIT
+from cursor_control.shm import node_ring_reader
+from cursor_control.trace import NODE_IDS, TRACE_KEY, source_trace, stamp
+
 NAME = 'wiener_filter'  # name of this node
 
 
@@ -49,6 +59,17 @@ class Decoder(BRANDNode):
             self.time_key = self.parameters['time_key'].encode()
         else:
             self.time_key = b'ts'
+        # add per-hop timestamps to each output entry
+        if 'trace' in self.parameters:
+            self.trace = self.parameters['trace']
+        else:
+            self.trace = False
+        self.hooks = node_hooks(self)
+        # read the input from a shared-memory ring buffer instead of Redis if
+        # it is listed in the shm_streams parameter
+        self.ring = node_ring_reader(self, self.in_stream)
+        if self.ring:
+            self.ring.spin_ns = self.hooks.realtime.busy_poll_ns
 
         self.build()
 
@@ -140,11 +161,25 @@ class Decoder(BRANDNode):
 
         i = 0
         i_in = -1
+        ring = self.ring
+        dropped = 0
+        hooks = self.hooks
+        # the lag of a ring is not checked, since it is not a Redis stream
+        lag_ids = None if ring else stream_dict
+        hooks.start()
         while True:
-            # read from the function generator stream
-            streams = self.r.xread(stream_dict, block=0, count=1)
-            _, stream_entries = streams[0]
-            self.data_id, entry_dict = stream_entries[0]
+            if ring:
+                # entry_dict holds views into the ring
+                seq, entry_dict = ring.read()
+            else:
+                # read from the function generator stream
+                streams = hooks.xread(self.r, stream_dict, count=1)
+            t_in = time.monotonic_ns()
+            hooks.lap(WAIT)
+            if not ring:
+                _, stream_entries = streams[0]
+                self.data_id, entry_dict = stream_entries[0]
+                stream_dict[input_stream] = self.data_id
             # load the input
             neural = np.frombuffer(entry_dict[input_field], dtype=input_dtype)
             if self.zero_masked_chans:
@@ -154,21 +189,37 @@ class Decoder(BRANDNode):
                 # window is the size of ch_mask
                 window[0, :] = neural[self.ch_mask]
             i_in = entry_dict[b'i']
-            stream_dict[input_stream] = self.data_id
+            if ring:
+                if ring.dropped != dropped:
+                    logging.warning(f'{ring.dropped - dropped} input entries '
+                                    'overwritten before they were read')
+                    dropped = ring.dropped
+                if not ring.valid(seq):
+                    logging.warning(f'Input entry {seq} overwritten while '
+                                    'it was read, skipping it')
+                    continue
 
             X[0, :] = window.reshape(1, self.n_features * self.seq_len)
             # generate a prediction
             y[0, :] = self.predict(X).astype(self.out_dtype)[0]
 
             # write results to Redis
-            decoder_entry[self.time_key] = np.uint64(
-                time.monotonic_ns()).tobytes()
+            t_out = time.monotonic_ns()
+            decoder_entry[self.time_key] = np.uint64(t_out).tobytes()
             decoder_entry['i'] = np.uint64(i).tobytes()
             decoder_entry['i_in'] = i_in
             decoder_entry[self.out_field] = y.tobytes()
             if self.sync_key in entry_dict:
                 decoder_entry[self.sync_key] = entry_dict[self.sync_key]
-            self.r.xadd(self.out_stream, decoder_entry)
+            if self.trace:
+                decoder_entry[TRACE_KEY] = stamp(
+                    source_trace(entry_dict, self.time_key),
+                    NODE_IDS['wiener_filter'], t_in, t_out)
+            hooks.lap(COMPUTE)
+            self.r.xadd(self.out_stream,
+                        decoder_entry,
+                        **hooks.trim(self.out_stream))
+            hooks.after_tick(lag_ids)
 
             # shift window along the history axis
             window[1:, :] = window[:-1, :]